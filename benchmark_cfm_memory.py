@@ -0,0 +1,142 @@
+"""
+Peak memory and latency of the S3Gen CFM decoder (the token-to-mel ODE solve) on long outputs, for the euler solver
+against the previous implementation of its loop, which re-staged every estimator input on each step and kept every
+intermediate step alive until the end.
+
+    python benchmark_cfm_memory.py --device cuda --seconds 30
+
+The estimator has random weights, memory and latency don't depend on them. Peak memory is the peak of tensor memory
+allocated during the solve: `torch.cuda.max_memory_allocated` on CUDA, and on CPU the peak total size of the live
+tensors created by the solve, tracked op by op (timed separately, the tracking slows it down).
+"""
+import argparse
+import time
+import types
+import weakref
+
+import torch
+from torch.utils._python_dispatch import TorchDispatchMode
+from torch.utils._pytree import tree_flatten
+
+from chatterbox.models.s3gen import S3Gen
+
+
+MEL_FPS = 50  # S3Gen mel frames per second of audio
+
+
+def legacy_solve_euler(self, x, t_span, mu, mask, spks, cond):
+    "`ConditionalCFM.solve_euler` as it was, for comparison."
+    t, _, dt = t_span[0], t_span[-1], t_span[1] - t_span[0]
+    t = t.unsqueeze(dim=0)
+    sol = []
+    x_in = torch.zeros([2, 80, x.size(2)], device=x.device, dtype=x.dtype)
+    mask_in = torch.zeros([2, 1, x.size(2)], device=x.device, dtype=x.dtype)
+    mu_in = torch.zeros([2, 80, x.size(2)], device=x.device, dtype=x.dtype)
+    t_in = torch.zeros([2], device=x.device, dtype=x.dtype)
+    spks_in = torch.zeros([2, 80], device=x.device, dtype=x.dtype)
+    cond_in = torch.zeros([2, 80, x.size(2)], device=x.device, dtype=x.dtype)
+    for step in range(1, len(t_span)):
+        x_in[:] = x
+        mask_in[:] = mask
+        mu_in[0] = mu
+        t_in[:] = t.unsqueeze(0)
+        spks_in[0] = spks
+        cond_in[0] = cond
+        dphi_dt = self.forward_estimator(x_in, mask_in, mu_in, t_in, spks_in, cond_in)
+        dphi_dt, cfg_dphi_dt = torch.split(dphi_dt, [x.size(0), x.size(0)], dim=0)
+        dphi_dt = ((1.0 + self.inference_cfg_rate) * dphi_dt - self.inference_cfg_rate * cfg_dphi_dt)
+        x = x + dt * dphi_dt
+        t = t + dt
+        sol.append(x)
+        if step < len(t_span) - 1:
+            dt = t_span[step + 1] - t
+    return sol[-1].float()
+
+
+class _LiveTensorPeak(TorchDispatchMode):
+    "Tracks the peak total size of the (CPU) tensor storages created by ops run under it, while they are alive."
+
+    def __init__(self):
+        super().__init__()
+        self._live = {}
+        self.current = 0
+        self.peak = 0
+
+    def _free(self, key):
+        self.current -= self._live.pop(key)
+
+    def __torch_dispatch__(self, func, types, args=(), kwargs=None):
+        out = func(*args, **(kwargs or {}))
+        for t in tree_flatten(out)[0]:
+            if isinstance(t, torch.Tensor):
+                storage = t.untyped_storage()
+                key = storage.data_ptr()
+                if key not in self._live and storage.nbytes() > 0:
+                    self._live[key] = storage.nbytes()
+                    self.current += storage.nbytes()
+                    self.peak = max(self.peak, self.current)
+                    weakref.finalize(storage, self._free, key)
+        return out
+
+
+def run_variant(variant, device, num_frames, n_timesteps, repeats):
+    "Returns (peak memory in bytes, median latency in seconds) of one decoder call."
+    torch.manual_seed(0)
+    decoder = S3Gen().flow.decoder.to(device).eval()
+    if variant == "legacy":
+        decoder.solve_euler = types.MethodType(legacy_solve_euler, decoder)
+
+    mu = torch.randn(1, 80, num_frames, device=device)
+    mask = torch.ones(1, 1, num_frames, device=device)
+    spks = torch.randn(1, 80, device=device)
+    cond = torch.randn(1, 80, num_frames, device=device)
+
+    def solve():
+        decoder(mu, mask, n_timesteps=n_timesteps, spks=spks, cond=cond, solver="euler")
+
+    is_cuda = str(device).startswith("cuda")
+    if is_cuda:
+        solve()  # warm-up
+        torch.cuda.synchronize()
+        torch.cuda.reset_peak_memory_stats()
+        base = torch.cuda.memory_allocated()
+        solve()
+        torch.cuda.synchronize()
+        peak = torch.cuda.max_memory_allocated() - base
+    else:
+        with _LiveTensorPeak() as tracker:
+            solve()
+        peak = tracker.peak
+
+    times = []
+    for _ in range(repeats):
+        if is_cuda:
+            torch.cuda.synchronize()
+        start = time.perf_counter()
+        solve()
+        if is_cuda:
+            torch.cuda.synchronize()
+        times.append(time.perf_counter() - start)
+    return peak, sorted(times)[len(times) // 2]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--device", default="cuda" if torch.cuda.is_available() else "cpu")
+    parser.add_argument("--seconds", type=float, nargs="+", default=[10, 30], help="lengths of generated audio")
+    parser.add_argument("--prompt-seconds", type=float, default=10, help="length of the reference prompt")
+    parser.add_argument("--n-timesteps", type=int, default=10)
+    parser.add_argument("--repeats", type=int, default=3, help="timing runs per configuration (median is reported)")
+    args = parser.parse_args()
+
+    print(f"device={args.device}, n_timesteps={args.n_timesteps}, prompt={args.prompt_seconds}s")
+    print(f"{'seconds':>7} {'frames':>6} {'variant':<8} {'peak MiB':>9} {'latency ms':>11}")
+    for seconds in args.seconds:
+        num_frames = int((seconds + args.prompt_seconds) * MEL_FPS)
+        for variant in ("legacy", "current"):
+            peak, latency = run_variant(variant, args.device, num_frames, args.n_timesteps, args.repeats)
+            print(f"{seconds:>7g} {num_frames:>6} {variant:<8} {peak / 2**20:>9.1f} {1000 * latency:>11.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,106 @@
+"""
+Benchmark the S3Gen CFM decoder's ODE solvers and step counts: latency of token-to-mel and token-to-wav, and the
+distance of the resulting mel-spectrograms to the default 10-step euler solver.
+
+    python benchmark_cfm_solvers.py --device cpu --steps 3 4 5 6 10
+
+Speech tokens are generated once per text with T3, so every configuration renders the same input.
+"""
+import argparse
+import time
+
+import torch
+
+from chatterbox.tts import ChatterboxTTS
+from chatterbox.models.s3gen import CFM_SOLVERS
+
+
+TEXTS = [
+    "Ezreal and Jinx teamed up with Ahri, Yasuo, and Teemo to take down the enemy's Nexus in an epic late-game pentakill.",
+    "The quick brown fox jumps over the lazy dog.",
+    "Last month, we reached a new milestone with two billion views on our YouTube channel.",
+]
+
+BASELINE = ("euler", 10)
+
+
+def _sync(device):
+    if str(device).startswith("cuda"):
+        torch.cuda.synchronize()
+
+
+def _timed(fn, device, repeats):
+    "Returns the output of `fn` and its median runtime over `repeats` runs, in seconds."
+    times = []
+    for _ in range(repeats):
+        _sync(device)
+        start = time.perf_counter()
+        out = fn()
+        _sync(device)
+        times.append(time.perf_counter() - start)
+    return out, sorted(times)[len(times) // 2]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--device", default="cuda" if torch.cuda.is_available() else "cpu")
+    parser.add_argument("--solvers", nargs="+", default=list(CFM_SOLVERS), choices=CFM_SOLVERS)
+    parser.add_argument("--steps", nargs="+", type=int, default=[2, 3, 4, 5, 6, 8, 10])
+    parser.add_argument("--repeats", type=int, default=3, help="timing runs per configuration (median is reported)")
+    parser.add_argument("--audio-prompt", default=None, help="reference clip, defaults to the built-in voice")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    torch.manual_seed(args.seed)
+    model = ChatterboxTTS.from_pretrained(device=args.device)
+    t3_cond, ref_dict = model._get_conditionals(args.audio_prompt, exaggeration=0.5)
+    speech_tokens = [
+        model._generate_speech_tokens(
+            text, t3_cond, repetition_penalty=1.2, min_p=0.05, top_p=1.0, cfg_weight=0.5, temperature=0.8
+        )
+        for text in TEXTS
+    ]
+    num_frames = sum(len(tokens) for tokens in speech_tokens) * model.s3gen.flow.token_mel_ratio
+    print(f"{len(TEXTS)} utterances, {num_frames} mel frames, device={args.device}")
+
+    def run(solver, n_steps):
+        "Total token-to-mel and token-to-wav time over all utterances, and the mels."
+        mels, flow_time, total_time = [], 0.0, 0.0
+        for tokens in speech_tokens:
+            mel, dt = _timed(
+                lambda: model.s3gen.flow_inference(
+                    tokens, ref_dict=ref_dict, finalize=True, n_cfm_timesteps=n_steps, cfm_solver=solver
+                ),
+                args.device,
+                args.repeats,
+            )
+            mels.append(mel.float().cpu())
+            flow_time += dt
+            _, dt = _timed(
+                lambda: model.s3gen.inference(tokens, ref_dict=ref_dict, n_cfm_timesteps=n_steps, cfm_solver=solver),
+                args.device,
+                args.repeats,
+            )
+            total_time += dt
+        return mels, flow_time, total_time
+
+    run(*BASELINE)  # warm-up
+    ref_mels, ref_flow_time, ref_total_time = run(*BASELINE)
+
+    print(f"{'solver':<10} {'steps':>5} {'NFE':>4} {'flow ms':>9} {'s3gen ms':>9} {'speedup':>8} {'mel L1':>8} {'mel RMSE':>9}")
+    for solver in args.solvers:
+        for n_steps in args.steps:
+            if (solver, n_steps) == BASELINE:
+                mels, flow_time, total_time = ref_mels, ref_flow_time, ref_total_time
+            else:
+                mels, flow_time, total_time = run(solver, n_steps)
+            diff = torch.cat([(mel - ref).flatten() for mel, ref in zip(mels, ref_mels)])
+            nfe = n_steps * (2 if solver in ("midpoint", "heun") else 1)
+            print(
+                f"{solver:<10} {n_steps:>5} {nfe:>4} {1000 * flow_time:>9.1f} {1000 * total_time:>9.1f} "
+                f"{ref_total_time / total_time:>7.2f}x {diff.abs().mean():>8.4f} {diff.pow(2).mean().sqrt():>9.4f}"
+            )
+
+
+if __name__ == "__main__":
+    main()
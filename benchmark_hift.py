@@ -0,0 +1,83 @@
+"""
+Throughput of the S3Gen HiFT vocoder (mel to waveform), with and without `S3Gen.optimize_for_inference` (weight norm
+folded into the conv weights, precomputed Snake activations), and the largest difference between their outputs.
+
+    python benchmark_hift.py --device cpu --seconds 5 20
+
+Uses the pretrained vocoder if `--ckpt-dir` is given, random weights otherwise: throughput doesn't depend on them.
+Both variants draw the same random source excitation, so their outputs should match to float rounding.
+"""
+import argparse
+import time
+from pathlib import Path
+
+import torch
+from safetensors.torch import load_file
+
+from chatterbox.models.s3gen import S3Gen, S3GEN_SR
+
+
+MEL_FPS = 50  # S3Gen mel frames per second of audio
+
+
+def load_s3gen(ckpt_dir, device, optimize):
+    torch.manual_seed(0)
+    s3gen = S3Gen()
+    if ckpt_dir is not None:
+        s3gen.load_state_dict(load_file(Path(ckpt_dir) / "s3gen.safetensors"), strict=False)
+    if optimize:
+        s3gen.optimize_for_inference()
+    return s3gen.to(device).eval()
+
+
+def _sync(device):
+    if str(device).startswith("cuda"):
+        torch.cuda.synchronize()
+
+
+def run(s3gen, mel, repeats):
+    "Returns the vocoder output and its median runtime over `repeats` runs, in seconds."
+    times = []
+    for _ in range(repeats):
+        torch.manual_seed(0)  # same source excitation on every run
+        _sync(mel.device)
+        start = time.perf_counter()
+        wav, _ = s3gen.hift_inference(mel)
+        _sync(mel.device)
+        times.append(time.perf_counter() - start)
+    return wav, sorted(times)[len(times) // 2]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--device", default="cuda" if torch.cuda.is_available() else "cpu")
+    parser.add_argument("--seconds", type=float, nargs="+", default=[5, 20], help="lengths of vocoded audio")
+    parser.add_argument("--repeats", type=int, default=3, help="timing runs per configuration (median is reported)")
+    parser.add_argument("--ckpt-dir", default=None, help="directory with s3gen.safetensors")
+    args = parser.parse_args()
+
+    variants = {
+        "baseline": load_s3gen(args.ckpt_dir, args.device, optimize=False),
+        "optimized": load_s3gen(args.ckpt_dir, args.device, optimize=True),
+    }
+
+    print(f"device={args.device}, {'pretrained' if args.ckpt_dir else 'random'} weights")
+    print(f"{'seconds':>7} {'variant':<9} {'ms':>9} {'samples/s':>11} {'speedup':>8} {'max abs diff':>13}")
+    for seconds in args.seconds:
+        mel = torch.randn(1, 80, int(seconds * MEL_FPS), generator=torch.Generator().manual_seed(0))
+        mel = (mel - 6).to(args.device)  # roughly the range of log-mels
+        with torch.inference_mode():
+            for s3gen in variants.values():
+                run(s3gen, mel, 1)  # warm-up
+            ref_wav, ref_time = run(variants["baseline"], mel, args.repeats)
+            for name, s3gen in variants.items():
+                wav, dt = (ref_wav, ref_time) if name == "baseline" else run(s3gen, mel, args.repeats)
+                print(
+                    f"{seconds:>7g} {name:<9} {1000 * dt:>9.1f} {wav.size(1) / dt:>11.0f} {ref_time / dt:>7.2f}x "
+                    f"{(wav - ref_wav).abs().max().item():>13.2e}"
+                )
+    print(f"(real time is {S3GEN_SR} samples/s)")
+
+
+if __name__ == "__main__":
+    main()
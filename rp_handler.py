@@ -2,7 +2,9 @@
 RunPod Serverless Worker for Chatterbox TTS
 Optimized handler with model caching and error handling
 """
+import asyncio
 import runpod
+import threading
 import torch
 import torchaudio as ta
 import base64
@@ -16,6 +18,16 @@ MODEL_CACHE = {
     "english": None,
     "multilingual": None
 }
+MODEL_LOCK = threading.Lock()
+
+# Number of jobs processed at the same time by this worker. Above 1, T3 decoding of concurrent jobs
+# is continuously batched by a scheduler shared by all of them.
+MAX_CONCURRENCY = int(os.environ.get("MAX_CONCURRENCY", "1"))
+
+# Voice conditionals computed from `audio_prompt` clips are cached, so that a returning voice skips the reference
+# embedding. Set CONDS_CACHE_DIR (eg on a network volume) to also keep them on disk across workers and restarts.
+CONDS_CACHE_SIZE = int(os.environ.get("CONDS_CACHE_SIZE", "256"))
+CONDS_CACHE_DIR = os.environ.get("CONDS_CACHE_DIR") or None
 
 def initialize_model(model_type="multilingual"):
     """
@@ -34,6 +46,13 @@ def initialize_model(model_type="multilingual"):
         print(f"✓ Using cached {model_type} model")
         return MODEL_CACHE[model_type]
     
+    with MODEL_LOCK:
+        if MODEL_CACHE[model_type] is None:
+            _load_model(model_type)
+    return MODEL_CACHE[model_type]
+
+
+def _load_model(model_type):
     # Initialize new model
     device = "cuda" if torch.cuda.is_available() else "cpu"
     print(f"⏳ Loading {model_type} model on {device}...")
@@ -50,6 +69,14 @@ def initialize_model(model_type="multilingual"):
         else:
             raise ValueError(f"Invalid model_type: {model_type}")
         
+        if MAX_CONCURRENCY > 1:
+            MODEL_CACHE[model_type].enable_batching(max_batch_size=MAX_CONCURRENCY)
+            print(f"✓ Continuous batching enabled (max batch size: {MAX_CONCURRENCY})")
+
+        if CONDS_CACHE_SIZE > 0:
+            MODEL_CACHE[model_type].enable_conditionals_cache(max_entries=CONDS_CACHE_SIZE, cache_dir=CONDS_CACHE_DIR)
+            print(f"✓ Voice conditionals cache enabled ({CONDS_CACHE_SIZE} entries, dir: {CONDS_CACHE_DIR})")
+        
         load_time = time.time() - start_time
         print(f"✓ {model_type.capitalize()} model loaded in {load_time:.2f}s")
         return MODEL_CACHE[model_type]
@@ -93,7 +120,9 @@ def handler(job):
             "seed": 0 (optional, 0 for random),
             "min_p": 0.05 (optional),
             "top_p": 1.0 (optional),
-            "repetition_penalty": 1.2 (optional)
+            "repetition_penalty": 1.2 (optional),
+            "n_cfm_timesteps": 10 (optional - fewer S3Gen decoder steps are faster, at some cost in quality),
+            "cfm_solver": "euler" (optional - "euler", "midpoint", "heun" or "multistep")
         }
     }
     
@@ -149,15 +178,15 @@ def handler(job):
         min_p = float(job_input.get("min_p", 0.05))
         top_p = float(job_input.get("top_p", 1.0))
         repetition_penalty = float(job_input.get("repetition_penalty", 1.2))
+        n_cfm_timesteps = int(job_input.get("n_cfm_timesteps", 10))
+        cfm_solver = job_input.get("cfm_solver")
         
         print(f"⚙️  Parameters: exaggeration={exaggeration}, cfg_weight={cfg_weight}, temp={temperature}")
         
-        # Set seed if provided
+        # Seed this job's own RNG if provided: the global one is shared by concurrent jobs
         if seed != 0:
-            torch.manual_seed(seed)
-            if torch.cuda.is_available():
-                torch.cuda.manual_seed(seed)
             print(f"🎲 Seed: {seed}")
+        seed = seed if seed != 0 else None
         
         # Handle audio prompt for voice cloning
         audio_prompt_path = None
@@ -181,7 +210,10 @@ def handler(job):
                 cfg_weight=cfg_weight,
                 min_p=min_p,
                 top_p=top_p,
-                repetition_penalty=repetition_penalty
+                repetition_penalty=repetition_penalty,
+                n_cfm_timesteps=n_cfm_timesteps,
+                cfm_solver=cfm_solver,
+                seed=seed,
             )
             sample_rate = model.sr
             language_used = "en"
@@ -203,6 +235,9 @@ def handler(job):
                 "exaggeration": exaggeration,
                 "temperature": temperature,
                 "cfg_weight": cfg_weight,
+                "n_cfm_timesteps": n_cfm_timesteps,
+                "cfm_solver": cfm_solver,
+                "seed": seed,
             }
             
             if audio_prompt_path:
@@ -250,8 +285,21 @@ def handler(job):
         return {"error": str(e)}
 
 
+async def async_handler(job):
+    """Runs `handler` in a worker thread so several jobs can be in flight at once"""
+    return await asyncio.to_thread(handler, job)
+
+
+def concurrency_modifier(current_concurrency):
+    return MAX_CONCURRENCY
+
+
 # Start the serverless worker
 if __name__ == "__main__":
     print("🚀 Starting Chatterbox TTS RunPod Worker...")
     print(f"🔧 Device: {'CUDA' if torch.cuda.is_available() else 'CPU'}")
-    runpod.serverless.start({"handler": handler})
+    if MAX_CONCURRENCY > 1:
+        print(f"🔀 Concurrency: {MAX_CONCURRENCY} jobs")
+        runpod.serverless.start({"handler": async_handler, "concurrency_modifier": concurrency_modifier})
+    else:
+        runpod.serverless.start({"handler": handler})
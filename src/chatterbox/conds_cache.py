@@ -0,0 +1,101 @@
+import hashlib
+import logging
+import os
+import threading
+from collections import OrderedDict
+from pathlib import Path
+
+
+logger = logging.getLogger(__name__)
+
+
+class ConditionalsCache:
+    """
+    LRU cache of voice `Conditionals`, optionally backed by a directory of `Conditionals.save` files, so that a
+    reference clip that was seen before skips `prepare_conditionals` (audio loading, resampling, S3Gen reference
+    embedding, S3 prompt tokens and the voice encoder).
+
+    Entries are keyed by a hash of the reference file's bytes and of the parameters the conditionals depend on,
+    except exaggeration, which is cheap to swap in afterwards. Thread-safe.
+    """
+
+    def __init__(self, conds_cls, device, max_entries=64, cache_dir=None):
+        """
+        Args:
+            conds_cls: the `Conditionals` class to load entries from `cache_dir` with.
+            device: device to move entries loaded from `cache_dir` to.
+            max_entries: number of entries kept in memory.
+            cache_dir: if given, entries are also saved there and survive restarts. Never evicted.
+        """
+        self.conds_cls = conds_cls
+        self.device = device
+        self.max_entries = max_entries
+        self.cache_dir = Path(cache_dir) if cache_dir is not None else None
+        if self.cache_dir is not None:
+            self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(wav_fpath, *params) -> str:
+        "Hash of the contents of `wav_fpath` and of `params`."
+        h = hashlib.sha256()
+        with open(wav_fpath, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                h.update(block)
+        h.update(repr(params).encode())
+        return h.hexdigest()
+
+    def get(self, key):
+        "Returns the cached `Conditionals` for `key`, or None."
+        with self._lock:
+            conds = self._entries.get(key)
+            if conds is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return conds
+
+        fpath = self._fpath(key)
+        if fpath is not None and fpath.exists():
+            try:
+                conds = self.conds_cls.load(fpath, map_location="cpu").to(self.device)
+            except Exception:
+                logger.exception(f"failed to load cached conditionals from {fpath}")
+            else:
+                with self._lock:
+                    self.hits += 1
+                    self._insert(key, conds)
+                return conds
+
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def put(self, key, conds):
+        with self._lock:
+            self._insert(key, conds)
+        fpath = self._fpath(key)
+        if fpath is not None and not fpath.exists():
+            # write then rename, so that concurrent readers never see a partial file
+            tmp_fpath = fpath.with_suffix(f".{os.getpid()}.{threading.get_ident()}.tmp")
+            conds.save(tmp_fpath)
+            os.replace(tmp_fpath, fpath)
+
+    def clear(self):
+        "Empty the in-memory cache. Files in `cache_dir` are kept."
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _insert(self, key, conds):
+        self._entries[key] = conds
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def _fpath(self, key):
+        return self.cache_dir / f"{key}.pt" if self.cache_dir is not None else None
@@ -1,2 +1,3 @@
 from .s3gen import S3Token2Wav as S3Gen
 from .const import S3GEN_SR
+from .flow_matching import CFM_SOLVERS
@@ -230,7 +230,28 @@ class ConditionalDecoder(nn.Module):
                 if m.bias is not None:
                     nn.init.constant_(m.bias, 0)
 
-    def forward(self, x, mask, mu, t, spks=None, cond=None):
+    def embed_time(self, t):
+        "Time-MLP output for the timesteps `t` (batch_size,), as used by the blocks."
+        t = self.time_embeddings(t).to(self.time_mlp.linear_1.weight.dtype)
+        return self.time_mlp(t)
+
+    def make_context(self, mask, dtype):
+        """
+        The masks and attention biases of every resolution for `mask` (batch_size, 1, time), for `forward`. They
+        only depend on the mask, so an ODE solve can compute them once instead of once per block and step.
+        """
+        masks = [mask]
+        for _ in range(len(self.down_blocks) - 1):
+            masks.append(masks[-1][:, :, ::2])
+        attn_biases = []
+        for mask_i in masks:
+            attn_mask = add_optional_chunk_mask(
+                mask_i.transpose(1, 2), mask_i.bool(), False, False, 0, self.static_chunk_size, -1
+            )
+            attn_biases.append(mask_to_bias(attn_mask == 1, dtype))
+        return {"masks": masks, "attn_biases": attn_biases}
+
+    def forward(self, x, mask, mu, t, spks=None, cond=None, context=None, t_emb=None):
         """Forward pass of the UNet1DConditional model.
 
         Args:
@@ -239,6 +260,8 @@ class ConditionalDecoder(nn.Module):
             t (_type_): shape (batch_size)
             spks (_type_, optional): shape: (batch_size, condition_channels). Defaults to None.
             cond (_type_, optional): placeholder for future use. Defaults to None.
+            context (dict, optional): `make_context(mask, x.dtype)`, if precomputed.
+            t_emb (torch.Tensor, optional): `embed_time(t)`, if precomputed. `t` is then unused.
 
         Raises:
             ValueError: _description_
@@ -248,8 +271,10 @@ class ConditionalDecoder(nn.Module):
             _type_: _description_
         """
 
-        t = self.time_embeddings(t).to(t.dtype)
-        t = self.time_mlp(t)
+        t = self.embed_time(t) if t_emb is None else t_emb
+        if context is None:
+            context = self.make_context(mask, x.dtype)
+        masks, attn_biases = context["masks"], context["attn_biases"]
 
         x = pack([x, mu], "b * t")[0]
 
@@ -260,54 +285,42 @@ class ConditionalDecoder(nn.Module):
             x = pack([x, cond], "b * t")[0]
 
         hiddens = []
-        masks = [mask]
-        for resnet, transformer_blocks, downsample in self.down_blocks:
-            mask_down = masks[-1]
+        for i, (resnet, transformer_blocks, downsample) in enumerate(self.down_blocks):
+            mask_down = masks[i]
             x = resnet(x, mask_down, t)
             x = rearrange(x, "b c t -> b t c").contiguous()
-            # attn_mask = torch.matmul(mask_down.transpose(1, 2).contiguous(), mask_down)
-            attn_mask = add_optional_chunk_mask(x, mask_down.bool(), False, False, 0, self.static_chunk_size, -1)
-            attn_mask = mask_to_bias(attn_mask == 1, x.dtype)
             for transformer_block in transformer_blocks:
                 x = transformer_block(
                     hidden_states=x,
-                    attention_mask=attn_mask,
+                    attention_mask=attn_biases[i],
                     timestep=t,
                 )
             x = rearrange(x, "b t c -> b c t").contiguous()
             hiddens.append(x)  # Save hidden states for skip connections
             x = downsample(x * mask_down)
-            masks.append(mask_down[:, :, ::2])
-        masks = masks[:-1]
         mask_mid = masks[-1]
 
         for resnet, transformer_blocks in self.mid_blocks:
             x = resnet(x, mask_mid, t)
             x = rearrange(x, "b c t -> b t c").contiguous()
-            # attn_mask = torch.matmul(mask_mid.transpose(1, 2).contiguous(), mask_mid)
-            attn_mask = add_optional_chunk_mask(x, mask_mid.bool(), False, False, 0, self.static_chunk_size, -1)
-            attn_mask = mask_to_bias(attn_mask == 1, x.dtype)
             for transformer_block in transformer_blocks:
                 x = transformer_block(
                     hidden_states=x,
-                    attention_mask=attn_mask,
+                    attention_mask=attn_biases[-1],
                     timestep=t,
                 )
             x = rearrange(x, "b t c -> b c t").contiguous()
 
-        for resnet, transformer_blocks, upsample in self.up_blocks:
-            mask_up = masks.pop()
+        for i, (resnet, transformer_blocks, upsample) in enumerate(self.up_blocks):
+            mask_up = masks[-1 - i]
             skip = hiddens.pop()
             x = pack([x[:, :, :skip.shape[-1]], skip], "b * t")[0]
             x = resnet(x, mask_up, t)
             x = rearrange(x, "b c t -> b t c").contiguous()
-            # attn_mask = torch.matmul(mask_up.transpose(1, 2).contiguous(), mask_up)
-            attn_mask = add_optional_chunk_mask(x, mask_up.bool(), False, False, 0, self.static_chunk_size, -1)
-            attn_mask = mask_to_bias(attn_mask == 1, x.dtype)
             for transformer_block in transformer_blocks:
                 x = transformer_block(
                     hidden_states=x,
-                    attention_mask=attn_mask,
+                    attention_mask=attn_biases[-1 - i],
                     timestep=t,
                 )
             x = rearrange(x, "b t c -> b c t").contiguous()
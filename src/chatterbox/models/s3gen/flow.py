@@ -13,6 +13,9 @@
 # limitations under the License.
 import logging
 import random
+import threading
+import weakref
+from collections import OrderedDict
 from typing import Dict, Optional
 
 logger = logging.getLogger(__name__)
@@ -23,6 +26,10 @@ from .utils.mask import make_pad_mask
 from .configs import CFM_PARAMS
 
 
+# number of reference prompts whose states are kept around, see `CausalMaskedDiffWithXvec._prompt_states`
+PROMPT_CACHE_SIZE = 32
+
+
 class MaskedDiffWithXvec(torch.nn.Module):
     def __init__(
         self,
@@ -132,7 +139,9 @@ class MaskedDiffWithXvec(torch.nn.Module):
                   prompt_feat,
                   prompt_feat_len,
                   embedding,
-                  flow_cache):
+                  flow_cache,
+                  n_timesteps=10,
+                  solver=None):
         if self.fp16 is True:
             prompt_feat = prompt_feat.half()
             embedding = embedding.half()
@@ -171,9 +180,10 @@ class MaskedDiffWithXvec(torch.nn.Module):
             mask=mask.unsqueeze(1),
             spks=embedding,
             cond=conds,
-            n_timesteps=10,
+            n_timesteps=n_timesteps,
             prompt_len=mel_len1,
-            flow_cache=flow_cache
+            flow_cache=flow_cache,
+            solver=solver,
         )
         feat = feat[:, :, mel_len1:]
         assert feat.shape[2] == mel_len2
@@ -238,9 +248,16 @@ class CausalMaskedDiffWithXvec(torch.nn.Module):
         self.token_mel_ratio = token_mel_ratio
         self.pre_lookahead_len = pre_lookahead_len
 
-        # FIXME: this was missing - just putting it in as false
+        # set by `S3Token2Wav.set_dtype`
         self.fp16 = False
 
+        # LRU of the states of reference prompts, see `_prompt_states`: id(prompt_token) -> (weakref(prompt_token),
+        # weakref(embedding), states)
+        self.prompt_cache_size = PROMPT_CACHE_SIZE
+        self._prompt_cache = OrderedDict()
+        # guards `_prompt_cache`, which concurrent `inference` calls (from several threads) share
+        self._prompt_cache_lock = threading.Lock()
+
     @torch.inference_mode()
     def inference(self,
                   token,
@@ -250,41 +267,120 @@ class CausalMaskedDiffWithXvec(torch.nn.Module):
                   prompt_feat,
                   prompt_feat_len,
                   embedding,
-                  finalize):
-        if self.fp16 is True:
-            prompt_feat = prompt_feat.half()
-            embedding = embedding.half()
-
-        assert token.shape[0] == 1
-        # xvec projection
-        embedding = F.normalize(embedding, dim=1)
-        embedding = self.spk_embed_affine_layer(embedding)
+                  finalize,
+                  n_timesteps=10,
+                  solver=None,
+                  noise_seeds=None):
+        if token.size(0) == 1 and self.prompt_cache_size > 0:
+            # the reference prompt's states are computed once per reference, and only the new tokens are embedded
+            prompt = self._prompt_states(prompt_token, prompt_token_len, prompt_feat, prompt_feat_len, embedding)
+            embedding, prompt_feat = prompt["embedding"], prompt["feat"]
+            token = self._embed_tokens(token, token_len)
+            h, h_masks = self.encoder(token, token_len, prefix=prompt["encoder"])
+            token_len = prompt_token_len + token_len
+        else:
+            # the reference's mels and x-vector are fp32, the flow may run in half precision (see `fp16`)
+            dtype = self.spk_embed_affine_layer.weight.dtype
+            prompt_feat, embedding = prompt_feat.to(dtype), embedding.to(dtype)
+            embedding = self._project_xvector(embedding)
 
-        # concat text and prompt_text
-        token, token_len = torch.concat([prompt_token, token], dim=1), prompt_token_len + token_len
-        mask = (~make_pad_mask(token_len)).unsqueeze(-1).to(embedding)
-        token = self.input_embedding(torch.clamp(token, min=0, max=self.input_embedding.num_embeddings-1)) * mask
+            # concat text and prompt_text
+            token = _concat_padded(prompt_token, prompt_token_len, token, token_len)
+            token_len = prompt_token_len + token_len
+            token = self._embed_tokens(token, token_len)
 
-        # text encode
-        h, h_lengths = self.encoder(token, token_len)
+            # text encode
+            h, h_masks = self.encoder(token, token_len)
+        h_lengths = token_len * self.token_mel_ratio
         if finalize is False:
-            h = h[:, :-self.pre_lookahead_len * self.token_mel_ratio]
-        mel_len1, mel_len2 = prompt_feat.shape[1], h.shape[1] - prompt_feat.shape[1]
+            h_lengths = h_lengths - self.pre_lookahead_len * self.token_mel_ratio
+            h = h[:, :h_lengths.max()]
+        if prompt_feat_len is None:
+            prompt_feat_len = torch.full_like(prompt_token_len, prompt_feat.shape[1])
+        mel_len1, mel_len2 = prompt_feat_len.tolist(), (h_lengths.cpu() - prompt_feat_len.cpu()).tolist()
         h = self.encoder_proj(h)
 
         # get conditions
-        conds = torch.zeros([1, mel_len1 + mel_len2, self.output_size], device=token.device).to(h.dtype)
-        conds[:, :mel_len1] = prompt_feat
+        conds = torch.zeros([h.size(0), h.size(1), self.output_size], device=h.device).to(h.dtype)
+        for k, n in enumerate(mel_len1):
+            conds[k, :n] = prompt_feat[k, :n]
         conds = conds.transpose(1, 2)
 
-        mask = (~make_pad_mask(torch.tensor([mel_len1 + mel_len2]))).to(h)
+        mask = (~make_pad_mask(h_lengths, h.size(1))).to(h)
         feat, _ = self.decoder(
             mu=h.transpose(1, 2).contiguous(),
             mask=mask.unsqueeze(1),
             spks=embedding,
             cond=conds,
-            n_timesteps=10
+            n_timesteps=n_timesteps,
+            solver=solver,
+            noise_seeds=noise_seeds,
         )
-        feat = feat[:, :, mel_len1:]
-        assert feat.shape[2] == mel_len2
-        return feat.float(), None  # NOTE jrm: why are they returning None here?
+        if len(mel_len1) == 1:
+            feat = feat[:, :, mel_len1[0]:]
+            assert feat.shape[2] == mel_len2[0]
+        else:
+            # drop each row's prompt region, left-aligning the generated mels
+            out = feat.new_zeros(feat.size(0), feat.size(1), max(mel_len2))
+            for k, (n1, n2) in enumerate(zip(mel_len1, mel_len2)):
+                out[k, :, :n2] = feat[k, :, n1:n1 + n2]
+            feat = out
+        return feat.float(), torch.tensor(mel_len2, device=feat.device)
+
+    def _project_xvector(self, embedding):
+        # xvec projection
+        embedding = F.normalize(embedding, dim=1)
+        return self.spk_embed_affine_layer(embedding)
+
+    def _embed_tokens(self, token, token_len):
+        mask = (~make_pad_mask(token_len, token.size(1))).unsqueeze(-1).to(self.spk_embed_affine_layer.weight)
+        return self.input_embedding(torch.clamp(token, min=0, max=self.input_embedding.num_embeddings-1)) * mask
+
+    def _prompt_states(self, prompt_token, prompt_token_len, prompt_feat, prompt_feat_len, embedding):
+        """
+        What `inference` needs of a reference prompt that does not depend on the tokens that follow it: the
+        projected x-vector, the prompt mels (the start of the decoder's `cond`) and the encoder's `prefix_states`.
+
+        They are computed once per reference (the `prompt_token` and `embedding` tensors of a ref dict) and kept in
+        an LRU cache. Ref dicts are assumed not to be modified in place once they have been used for inference.
+        Concurrent misses on the same reference both compute its states, the last one is kept.
+        """
+        key = id(prompt_token)
+        dtype = self.spk_embed_affine_layer.weight.dtype
+        with self._prompt_cache_lock:
+            entry = self._prompt_cache.get(key)
+            if (
+                entry is not None
+                and entry[0]() is prompt_token
+                and entry[1]() is embedding
+                and entry[2]["embedding"].dtype == dtype
+                and entry[2]["embedding"].device == embedding.device
+            ):
+                self._prompt_cache.move_to_end(key)
+                return entry[2]
+
+        n_feat = prompt_feat.size(1) if prompt_feat_len is None else int(prompt_feat_len[0])
+        states = {
+            "embedding": self._project_xvector(embedding.to(dtype)),
+            "feat": prompt_feat[:, :n_feat].to(dtype),
+            "encoder": self.encoder.prefix_states(
+                self._embed_tokens(prompt_token[:, :prompt_token_len[0]], prompt_token_len)
+            ),
+        }
+        with self._prompt_cache_lock:
+            self._prompt_cache[key] = (weakref.ref(prompt_token), weakref.ref(embedding), states)
+            while len(self._prompt_cache) > self.prompt_cache_size:
+                self._prompt_cache.popitem(last=False)
+        return states
+
+
+def _concat_padded(a, a_lens, b, b_lens):
+    "Concatenate the rows of right-padded `a` and `b` along dim 1, skipping the padding. The result is right-padded."
+    if a.size(0) == 1:
+        return torch.concat([a[:, :a_lens[0]], b[:, :b_lens[0]]], dim=1)
+    a_lens, b_lens = a_lens.tolist(), b_lens.tolist()
+    out = a.new_zeros(a.size(0), max(m + n for m, n in zip(a_lens, b_lens)), *a.shape[2:])
+    for k, (m, n) in enumerate(zip(a_lens, b_lens)):
+        out[k, :m] = a[k, :m]
+        out[k, m:m + n] = b[k, :n]
+    return out
@@ -12,10 +12,27 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 import threading
+from collections import OrderedDict
+
 import torch
 import torch.nn.functional as F
 from .matcha.flow_matching import BASECFM
 from .configs import CFM_PARAMS
+from .utils.buckets import length_bucket
+
+
+# ODE solvers available for inference, see `ConditionalCFM.solve`
+CFM_SOLVERS = ("euler", "midpoint", "heun", "multistep")
+
+# number of timestep schedules whose estimator time embeddings are kept around
+TIME_EMB_CACHE_SIZE = 16
+
+# the noise bank `CausalConditionalCFM` starts from: default seed, and the number of mel frames it's generated (and
+# grown) by, 5 min of audio
+NOISE_SEED = 0
+NOISE_BLOCK_LEN = 50 * 300
+# number of per-request noise banks (see `CausalConditionalCFM.forward`) kept around
+NOISE_BANK_CACHE_SIZE = 8
 
 
 class ConditionalCFM(BASECFM):
@@ -33,9 +50,37 @@ class ConditionalCFM(BASECFM):
         # Just change the architecture of the estimator here
         self.estimator = estimator
         self.lock = threading.Lock()
+        # estimator time embeddings of recent schedules, see `_time_embeddings`
+        self._time_emb_cache = OrderedDict()
+        # guards the module's LRU caches, which concurrent calls (from several threads) share
+        self._cache_lock = threading.Lock()
+        # see `enable_length_buckets`
+        self.length_buckets = None
+        self._bucket_estimator = None
+
+    def enable_length_buckets(self, buckets, compile=True, mode=None):
+        """
+        Opt in to running the estimator on a fixed set of lengths only: inputs are right-padded (and masked out) to
+        the smallest of `buckets` that fits them, so a compiled estimator is specialised once per bucket (and batch
+        size) instead of once per request length. The padding is masked everywhere in the estimator, so outputs
+        are unchanged up to float rounding. Inputs longer than the largest bucket run as they are, eagerly.
+
+        Args:
+            buckets: lengths in mel frames.
+            compile: run the estimator through `torch.compile` (with `dynamic=False`) on bucketed inputs.
+            mode: `torch.compile` mode.
+        """
+        self.length_buckets = tuple(sorted(buckets))
+        self._bucket_estimator = None
+        if compile and isinstance(self.estimator, torch.nn.Module):
+            self._bucket_estimator = torch.compile(self.estimator, mode=mode, dynamic=False)
+            # one specialisation per bucket for each of the CFG batch sizes (2 and 2B)
+            torch._dynamo.config.cache_size_limit = max(
+                torch._dynamo.config.cache_size_limit, 4 * len(self.length_buckets)
+            )
 
     @torch.inference_mode()
-    def forward(self, mu, mask, n_timesteps, temperature=1.0, spks=None, cond=None, prompt_len=0, flow_cache=torch.zeros(1, 80, 0, 2)):
+    def forward(self, mu, mask, n_timesteps, temperature=1.0, spks=None, cond=None, prompt_len=0, flow_cache=torch.zeros(1, 80, 0, 2), solver=None):
         """Forward diffusion
 
         Args:
@@ -48,6 +93,7 @@ class ConditionalCFM(BASECFM):
             spks (torch.Tensor, optional): speaker ids. Defaults to None.
                 shape: (batch_size, spk_emb_dim)
             cond: Not used but kept for future purposes
+            solver (str, optional): one of `CFM_SOLVERS`. Defaults to `cfm_params.solver`.
 
         Returns:
             sample: generated mel-spectrogram
@@ -67,7 +113,30 @@ class ConditionalCFM(BASECFM):
         t_span = torch.linspace(0, 1, n_timesteps + 1, device=mu.device, dtype=mu.dtype)
         if self.t_scheduler == 'cosine':
             t_span = 1 - torch.cos(t_span * 0.5 * torch.pi)
-        return self.solve_euler(z, t_span=t_span, mu=mu, mask=mask, spks=spks, cond=cond), flow_cache
+        return self.solve(z, t_span=t_span, mu=mu, mask=mask, spks=spks, cond=cond, solver=solver), flow_cache
+
+    def solve(self, x, t_span, mu, mask, spks, cond, solver=None):
+        """
+        Integrate the flow ODE from the noise `x` over `t_span` with the given solver:
+        - "euler": first order, one estimator pass per step.
+        - "midpoint", "heun": second order, two estimator passes per step.
+        - "multistep": second order Adams-Bashforth (the velocity form of DPM-Solver++(2M)), reusing the previous
+          step's velocity, so one estimator pass per step.
+        The second order solvers hold up much better at low step counts, eg "multistep" with 4-5 steps against
+        "euler" with 10.
+        """
+        solver = solver or self.solver
+        if solver not in CFM_SOLVERS:
+            raise ValueError(f"Unknown CFM solver '{solver}', expected one of {CFM_SOLVERS}")
+
+        num_frames = x.size(2)
+        bucket = length_bucket(num_frames, self.length_buckets)
+        if bucket is not None and bucket > num_frames:
+            pad = (0, bucket - num_frames)
+            x, mu, mask = F.pad(x, pad), F.pad(mu, pad), F.pad(mask, pad)
+            cond = F.pad(cond, pad) if cond is not None else None
+        x = getattr(self, f"solve_{solver}")(x, t_span=t_span, mu=mu, mask=mask, spks=spks, cond=cond)
+        return x[:, :, :num_frames]
 
     def solve_euler(self, x, t_span, mu, mask, spks, cond):
         """
@@ -84,55 +153,155 @@ class ConditionalCFM(BASECFM):
                 shape: (batch_size, spk_emb_dim)
             cond: Not used but kept for future purposes
         """
-        t, _, dt = t_span[0], t_span[-1], t_span[1] - t_span[0]
-        t = t.unsqueeze(dim=0)
+        # the timesteps as the euler updates accumulate them
+        ts, dts = [t_span[:1]], []
+        for step in range(1, len(t_span)):
+            dts.append(t_span[step] - ts[-1])
+            ts.append(ts[-1] + dts[-1])
 
-        # I am storing this because I can later plot it by putting a debugger here and saving it to a file
-        # Or in future might add like a return_all_steps flag
-        sol = []
+        # x is updated in place, and no intermediate steps are kept, so the only allocations per step are the
+        # estimator's own
+        x = x.clone()
+        cfg_inputs = self._cfg_inputs(x, mu, mask, spks, cond, torch.cat(ts[:-1]))
+        for step, dt in enumerate(dts):
+            dphi_dt = self._cfg_velocity(cfg_inputs, x, step)
+            x.add_(dphi_dt.mul_(dt))
 
-        # Do not use concat, it may cause memory format changed and trt infer with wrong results!
-        x_in = torch.zeros([2, 80, x.size(2)], device=x.device, dtype=x.dtype)
-        mask_in = torch.zeros([2, 1, x.size(2)], device=x.device, dtype=x.dtype)
-        mu_in = torch.zeros([2, 80, x.size(2)], device=x.device, dtype=x.dtype)
-        t_in = torch.zeros([2], device=x.device, dtype=x.dtype)
-        spks_in = torch.zeros([2, 80], device=x.device, dtype=x.dtype)
-        cond_in = torch.zeros([2, 80, x.size(2)], device=x.device, dtype=x.dtype)
+        return x.float()
+
+    def solve_midpoint(self, x, t_span, mu, mask, spks, cond):
+        "Explicit midpoint (RK2) solver, arguments as in `solve_euler`."
+        t, dt = t_span[:-1], t_span[1:] - t_span[:-1]
+        # estimator timesteps, two per step
+        cfg_inputs = self._cfg_inputs(x, mu, mask, spks, cond, torch.stack([t, t + 0.5 * dt], dim=1).flatten())
+        for step in range(len(dt)):
+            k1 = self._cfg_velocity(cfg_inputs, x, 2 * step)
+            k2 = self._cfg_velocity(cfg_inputs, x + 0.5 * dt[step] * k1, 2 * step + 1)
+            x = x + dt[step] * k2
+        return x.float()
+
+    def solve_heun(self, x, t_span, mu, mask, spks, cond):
+        "Heun (explicit trapezoidal) solver, arguments as in `solve_euler`."
+        t, dt = t_span[:-1], t_span[1:] - t_span[:-1]
+        # estimator timesteps, two per step
+        cfg_inputs = self._cfg_inputs(x, mu, mask, spks, cond, torch.stack([t, t + dt], dim=1).flatten())
+        for step in range(len(dt)):
+            k1 = self._cfg_velocity(cfg_inputs, x, 2 * step)
+            x_next = x + 0.5 * dt[step] * k1  # before the next estimator call, which may reuse k1's memory
+            k2 = self._cfg_velocity(cfg_inputs, x + dt[step] * k1, 2 * step + 1)
+            x = x_next + 0.5 * dt[step] * k2
+        return x.float()
+
+    def solve_multistep(self, x, t_span, mu, mask, spks, cond):
+        """
+        Second order multistep solver, arguments as in `solve_euler`. The first step is an euler step, later ones
+        extrapolate linearly from the current and previous velocities (variable step Adams-Bashforth 2).
+        """
+        cfg_inputs = self._cfg_inputs(x, mu, mask, spks, cond, t_span[:-1])
+        prev_k, prev_dt = None, None
         for step in range(1, len(t_span)):
-            # Classifier-Free Guidance inference introduced in VoiceBox
-            x_in[:] = x
-            mask_in[:] = mask
-            mu_in[0] = mu
-            t_in[:] = t.unsqueeze(0)
-            spks_in[0] = spks
-            cond_in[0] = cond
-            dphi_dt = self.forward_estimator(
-                x_in, mask_in,
-                mu_in, t_in,
-                spks_in,
-                cond_in
-            )
-            dphi_dt, cfg_dphi_dt = torch.split(dphi_dt, [x.size(0), x.size(0)], dim=0)
-            dphi_dt = ((1.0 + self.inference_cfg_rate) * dphi_dt - self.inference_cfg_rate * cfg_dphi_dt)
-            x = x + dt * dphi_dt
-            t = t + dt
-            sol.append(x)
-            if step < len(t_span) - 1:
-                dt = t_span[step + 1] - t
+            dt = t_span[step] - t_span[step - 1]
+            k = self._cfg_velocity(cfg_inputs, x, step - 1)
+            if prev_k is None:
+                x = x + dt * k
+                prev_k = k.clone()
+            else:
+                r = dt / prev_dt
+                x = x + dt * ((1 + 0.5 * r) * k - 0.5 * r * prev_k)
+                prev_k.copy_(k)
+            prev_dt = dt
+        return x.float()
 
-        return sol[-1].float()
+    def _cfg_inputs(self, x, mu, mask, spks, cond, ts):
+        """
+        Batch-2B estimator inputs for `_cfg_velocity`: the B conditional rows, then the B unconditional ones, for
+        the estimator timesteps `ts` of the solve. Everything but `x` and `t` is constant over the solve, so it is
+        staged here once, along with the estimator's masks and the time embeddings of `ts`; the unconditional rows
+        stay zero.
+        """
+        b = x.size(0)
+        # Do not use concat, it may cause memory format changed and trt infer with wrong results!
+        x_in = torch.zeros([2 * b, 80, x.size(2)], device=x.device, dtype=x.dtype)
+        mask_in = torch.zeros([2 * b, 1, x.size(2)], device=x.device, dtype=x.dtype)
+        mu_in = torch.zeros([2 * b, 80, x.size(2)], device=x.device, dtype=x.dtype)
+        t_in = torch.zeros([2 * b], device=x.device, dtype=x.dtype)
+        spks_in = torch.zeros([2 * b, 80], device=x.device, dtype=x.dtype)
+        cond_in = torch.zeros([2 * b, 80, x.size(2)], device=x.device, dtype=x.dtype)
+        mask_in.view(2, b, 1, -1)[:] = mask
+        mu_in[:b] = mu
+        spks_in[:b] = spks
+        cond_in[:b] = cond
+        context, t_embs = None, None
+        if isinstance(self.estimator, torch.nn.Module):
+            context = self.estimator.make_context(mask_in, x.dtype)
+            t_embs = self._time_embeddings(ts)
+        return x_in, mask_in, mu_in, t_in, spks_in, cond_in, ts, context, t_embs
+
+    def _time_embeddings(self, ts):
+        """
+        The estimator's time-MLP outputs for the timesteps `ts` (n,), as (n, 1, dim). They only depend on the
+        timesteps, ie on the schedule, so they are cached across calls.
+        """
+        key = (tuple(ts.tolist()), ts.dtype, ts.device)
+        with self._cache_lock:
+            t_embs = self._time_emb_cache.get(key)
+            if t_embs is not None:
+                self._time_emb_cache.move_to_end(key)
+                return t_embs
+        t_embs = self.estimator.embed_time(ts).unsqueeze(1)
+        with self._cache_lock:
+            self._time_emb_cache[key] = t_embs
+            while len(self._time_emb_cache) > TIME_EMB_CACHE_SIZE:
+                self._time_emb_cache.popitem(last=False)
+        return t_embs
+
+    def _apply(self, fn, *args, **kwargs):
+        # `.to()`, `.half()` etc.: cached time embeddings have the estimator's former dtype / device
+        with self._cache_lock:
+            self._time_emb_cache.clear()
+        return super()._apply(fn, *args, **kwargs)
+
+    def _load_from_state_dict(self, *args, **kwargs):
+        # cached time embeddings were computed with the former weights
+        with self._cache_lock:
+            self._time_emb_cache.clear()
+        return super()._load_from_state_dict(*args, **kwargs)
 
-    def forward_estimator(self, x, mask, mu, t, spks, cond):
+    def _cfg_velocity(self, cfg_inputs, x, step):
+        """
+        Estimate the flow velocity at (x, `ts[step]`), with classifier-free guidance. The result may share memory
+        with the estimator buffers, so it is only valid until the next call.
+        """
+        x_in, mask_in, mu_in, t_in, spks_in, cond_in, ts, context, t_embs = cfg_inputs
+        # Classifier-Free Guidance inference introduced in VoiceBox
+        x_in.view(2, *x.shape)[:] = x
+        t_in[:] = ts[step]
+        dphi_dt = self.forward_estimator(
+            x_in, mask_in,
+            mu_in, t_in,
+            spks_in,
+            cond_in,
+            context=context,
+            t_emb=t_embs[step].expand(t_in.size(0), -1) if t_embs is not None else None,
+        )
+        dphi_dt, cfg_dphi_dt = torch.split(dphi_dt, [x.size(0), x.size(0)], dim=0)
+        # combined in place, in the estimator output
+        return dphi_dt.mul_(1.0 + self.inference_cfg_rate).sub_(cfg_dphi_dt, alpha=self.inference_cfg_rate)
+
+    def forward_estimator(self, x, mask, mu, t, spks, cond, context=None, t_emb=None):
         if isinstance(self.estimator, torch.nn.Module):
-            return self.estimator.forward(x, mask, mu, t, spks, cond)
+            estimator = self.estimator
+            if self._bucket_estimator is not None and x.size(2) in self.length_buckets:
+                estimator = self._bucket_estimator
+            return estimator(x, mask, mu, t, spks, cond, context=context, t_emb=t_emb)
         else:
             with self.lock:
-                self.estimator.set_input_shape('x', (2, 80, x.size(2)))
-                self.estimator.set_input_shape('mask', (2, 1, x.size(2)))
-                self.estimator.set_input_shape('mu', (2, 80, x.size(2)))
-                self.estimator.set_input_shape('t', (2,))
-                self.estimator.set_input_shape('spks', (2, 80))
-                self.estimator.set_input_shape('cond', (2, 80, x.size(2)))
+                self.estimator.set_input_shape('x', (x.size(0), 80, x.size(2)))
+                self.estimator.set_input_shape('mask', (x.size(0), 1, x.size(2)))
+                self.estimator.set_input_shape('mu', (x.size(0), 80, x.size(2)))
+                self.estimator.set_input_shape('t', (x.size(0),))
+                self.estimator.set_input_shape('spks', (x.size(0), 80))
+                self.estimator.set_input_shape('cond', (x.size(0), 80, x.size(2)))
                 # run trt engine
                 self.estimator.execute_v2([x.contiguous().data_ptr(),
                                            mask.contiguous().data_ptr(),
@@ -188,10 +357,54 @@ class ConditionalCFM(BASECFM):
 class CausalConditionalCFM(ConditionalCFM):
     def __init__(self, in_channels=240, cfm_params=CFM_PARAMS, n_spks=1, spk_emb_dim=80, estimator=None):
         super().__init__(in_channels, cfm_params, n_spks, spk_emb_dim, estimator)
-        self.rand_noise = torch.randn([1, 80, 50 * 300])
+        # the same noise on every call, so that outputs only depend on the inputs; it follows the module's device and
+        # dtype, and grows with the inputs (see `_noise_bank`)
+        self.noise_seed = NOISE_SEED
+        self.register_buffer("rand_noise", self.generate_noise(NOISE_SEED, NOISE_BLOCK_LEN), persistent=False)
+        # LRU of the noise banks of per-request seeds: seed -> noise
+        self._seeded_noise = OrderedDict()
+
+    @staticmethod
+    def generate_noise(seed: int, num_frames: int) -> torch.Tensor:
+        """
+        The (1, 80, n) noise bank of `seed`, with n the multiple of `NOISE_BLOCK_LEN` that fits `num_frames`. It's
+        drawn on CPU, so it's the same on every device, and a block at a time, so a longer bank of the same seed
+        starts with a shorter one.
+        """
+        generator = torch.Generator().manual_seed(seed)
+        num_blocks = max(1, -(-num_frames // NOISE_BLOCK_LEN))
+        return torch.cat([torch.randn([1, 80, NOISE_BLOCK_LEN], generator=generator) for _ in range(num_blocks)], dim=2)
+
+    def set_noise_seed(self, seed: int):
+        "Regenerate the default noise bank from `seed`, in place on the module's device and dtype."
+        self.noise_seed = seed
+        self.rand_noise = self.generate_noise(seed, self.rand_noise.size(2)).to(self.rand_noise)
+
+    def _noise_bank(self, seed, num_frames):
+        """
+        A noise bank of at least `num_frames` frames, on the module's device and dtype: the default one if `seed` is
+        None, otherwise the (cached) one of `seed`. Banks that are too short are regenerated, longer.
+        """
+        if seed is None:
+            if self.rand_noise.size(2) < num_frames:
+                self.rand_noise = self.generate_noise(self.noise_seed, num_frames).to(self.rand_noise)
+            return self.rand_noise
+
+        with self._cache_lock:
+            noise = self._seeded_noise.get(seed)
+            if noise is not None and noise.size(2) >= num_frames and noise.device == self.rand_noise.device \
+                    and noise.dtype == self.rand_noise.dtype:
+                self._seeded_noise.move_to_end(seed)
+                return noise
+        noise = self.generate_noise(seed, num_frames).to(self.rand_noise)
+        with self._cache_lock:
+            self._seeded_noise[seed] = noise
+            while len(self._seeded_noise) > NOISE_BANK_CACHE_SIZE:
+                self._seeded_noise.popitem(last=False)
+        return noise
 
     @torch.inference_mode()
-    def forward(self, mu, mask, n_timesteps, temperature=1.0, spks=None, cond=None):
+    def forward(self, mu, mask, n_timesteps, temperature=1.0, spks=None, cond=None, solver=None, noise_seeds=None):
         """Forward diffusion
 
         Args:
@@ -204,15 +417,26 @@ class CausalConditionalCFM(ConditionalCFM):
             spks (torch.Tensor, optional): speaker ids. Defaults to None.
                 shape: (batch_size, spk_emb_dim)
             cond: Not used but kept for future purposes
+            solver (str, optional): one of `CFM_SOLVERS`. Defaults to `cfm_params.solver`.
+            noise_seeds (list, optional): a seed (or None for the default noise bank) per row, to start each row from
+                its own reproducible noise. Defaults to the default noise bank for every row.
 
         Returns:
             sample: generated mel-spectrogram
                 shape: (batch_size, n_feats, mel_timesteps)
         """
 
-        z = self.rand_noise[:, :, :mu.size(2)].to(mu.device).to(mu.dtype) * temperature
+        num_frames = mu.size(2)
+        if noise_seeds is None:
+            # the same noise for every row, so rows come out as they would on their own
+            z = self._noise_bank(None, num_frames)[:, :, :num_frames].expand(mu.size(0), -1, -1)
+        else:
+            assert len(noise_seeds) == mu.size(0), "expected one noise seed (or None) per row"
+            z = torch.cat([self._noise_bank(seed, num_frames)[:, :, :num_frames] for seed in noise_seeds])
+        z = z.to(mu) * temperature
         # fix prompt and overlap part mu and z
-        t_span = torch.linspace(0, 1, n_timesteps + 1, device=mu.device, dtype=mu.dtype)
+        # (the schedule stays fp32 when the decoder runs in half precision, its time embeddings are sensitive to it)
+        t_span = torch.linspace(0, 1, n_timesteps + 1, device=mu.device, dtype=torch.float32)
         if self.t_scheduler == 'cosine':
             t_span = 1 - torch.cos(t_span * 0.5 * torch.pi)
-        return self.solve_euler(z, t_span=t_span, mu=mu, mask=mask, spks=spks, cond=cond), None
+        return self.solve(z, t_span=t_span, mu=mu, mask=mask, spks=spks, cond=cond, solver=solver), None
@@ -17,19 +17,21 @@
 
 """HIFI-GAN"""
 
-from typing import Dict, Optional, List
+from typing import Dict, Iterator, Optional, List, Tuple
 import numpy as np
 from scipy.signal import get_window
 import torch
 import torch.nn.functional as F
 from torch.nn import Conv1d
 from torch.nn import ConvTranspose1d
-from torch.nn.utils import remove_weight_norm
+from torch.nn.utils import parametrize
 from torch.nn.utils.parametrizations import weight_norm
 from torch.distributions.uniform import Uniform
 from torch import nn, sin, pow
 from torch.nn import Parameter
 
+from .utils.buckets import length_bucket
+
 
 class Snake(nn.Module):
     '''
@@ -69,6 +71,19 @@ class Snake(nn.Module):
         self.alpha.requires_grad = alpha_trainable
 
         self.no_div_by_zero = 0.000000001
+        self.fused = False
+
+    def fuse(self):
+        '''
+        Precompute alpha and its reciprocal in [1, C, 1] buffers, for inference: forward then takes 4 elementwise
+        ops instead of 8. Later updates of the alpha parameter are ignored.
+        '''
+        alpha = self.alpha.detach()
+        if self.alpha_logscale:
+            alpha = torch.exp(alpha)
+        self.register_buffer("alpha_fused", alpha.view(1, -1, 1).clone(), persistent=False)
+        self.register_buffer("inv_alpha_fused", (1.0 / (alpha + self.no_div_by_zero)).view(1, -1, 1), persistent=False)
+        self.fused = True
 
     def forward(self, x):
         '''
@@ -76,6 +91,9 @@ class Snake(nn.Module):
         Applies the function to the input elementwise.
         Snake ∶= x + 1/a * sin^2 (xa)
         '''
+        if self.fused:
+            return torch.addcmul(x, torch.sin(x * self.alpha_fused).square_(), self.inv_alpha_fused)
+
         alpha = self.alpha.unsqueeze(0).unsqueeze(-1) # line up with x to [B, C, T]
         if self.alpha_logscale:
             alpha = torch.exp(alpha)
@@ -85,6 +103,13 @@ class Snake(nn.Module):
 
 
 
+def _remove_weight_norm(module: nn.Module):
+    "Replace the weight norm parametrizations under `module` by the weights they compute."
+    for m in module.modules():
+        if parametrize.is_parametrized(m, "weight"):
+            parametrize.remove_parametrizations(m, "weight", leave_parametrized=True)
+
+
 def get_padding(kernel_size, dilation=1):
     return int((kernel_size * dilation - dilation) / 2)
 
@@ -161,9 +186,12 @@ class ResBlock(torch.nn.Module):
         return x
 
     def remove_weight_norm(self):
-        for idx in range(len(self.convs1)):
-            remove_weight_norm(self.convs1[idx])
-            remove_weight_norm(self.convs2[idx])
+        _remove_weight_norm(self)
+
+
+def _randn_like(x, generator=None):
+    "`torch.randn_like`, drawing from `generator` if given."
+    return torch.randn(x.shape, generator=generator, dtype=x.dtype, device=x.device)
 
 
 class SineGen(torch.nn.Module):
@@ -197,10 +225,31 @@ class SineGen(torch.nn.Module):
         uv = (f0 > self.voiced_threshold).type(torch.float32)
         return uv
 
+    def initial_phase(self, batch_size, device, generator=None):
+        """
+        Random initial phases of the harmonics, [B, harmonic_num + 1, 1], drawn from `generator` if given. The
+        fundamental starts at 0.
+        """
+        shape = (batch_size, self.harmonic_num + 1, 1)
+        if generator is None:
+            phase_vec = Uniform(low=-np.pi, high=np.pi).sample(sample_shape=shape).to(device)
+        else:
+            phase_vec = (2 * torch.rand(shape, generator=generator, device=generator.device) - 1).to(device) * np.pi
+        phase_vec[:, 0, :] = 0
+        return phase_vec
+
+    def next_phase(self, f0, phase_vec):
+        "Phases after `f0` [B, 1, sample_len] starting from `phase_vec`, ie where to continue the sine waves from."
+        harmonics = torch.arange(1, self.harmonic_num + 2, device=f0.device, dtype=torch.float64).view(1, -1, 1)
+        cycles = f0.double().sum(dim=-1, keepdim=True) * harmonics / self.sampling_rate
+        return (phase_vec + 2 * np.pi * (cycles % 1)).to(phase_vec.dtype)
+
     @torch.no_grad()
-    def forward(self, f0):
+    def forward(self, f0, phase_vec=None, generator=None):
         """
         :param f0: [B, 1, sample_len], Hz
+        :param phase_vec: [B, harmonic_num + 1, 1], initial phases (random by default, see `initial_phase`)
+        :param generator: RNG of the random phases and noise, the global one by default
         :return: [B, 1, sample_len]
         """
 
@@ -209,9 +258,8 @@ class SineGen(torch.nn.Module):
             F_mat[:, i: i + 1, :] = f0 * (i + 1) / self.sampling_rate
 
         theta_mat = 2 * np.pi * (torch.cumsum(F_mat, dim=-1) % 1)
-        u_dist = Uniform(low=-np.pi, high=np.pi)
-        phase_vec = u_dist.sample(sample_shape=(f0.size(0), self.harmonic_num + 1, 1)).to(F_mat.device)
-        phase_vec[:, 0, :] = 0
+        if phase_vec is None:
+            phase_vec = self.initial_phase(f0.size(0), F_mat.device, generator)
 
         # generate sine waveforms
         sine_waves = self.sine_amp * torch.sin(theta_mat + phase_vec)
@@ -223,7 +271,7 @@ class SineGen(torch.nn.Module):
         #        std = self.sine_amp/3 -> max value ~ self.sine_amp
         # .       for voiced regions is self.noise_std
         noise_amp = uv * self.noise_std + (1 - uv) * self.sine_amp / 3
-        noise = noise_amp * torch.randn_like(sine_waves)
+        noise = noise_amp * _randn_like(sine_waves, generator)
 
         # first: set the unvoiced part to 0 by uv
         # then: additive noise
@@ -264,22 +312,24 @@ class SourceModuleHnNSF(torch.nn.Module):
         self.l_linear = torch.nn.Linear(harmonic_num + 1, 1)
         self.l_tanh = torch.nn.Tanh()
 
-    def forward(self, x):
+    def forward(self, x, phase_vec=None, generator=None):
         """
         Sine_source, noise_source = SourceModuleHnNSF(F0_sampled)
         F0_sampled (batchsize, length, 1)
+        phase_vec: initial phases of the harmonics, see `SineGen`
+        generator: RNG of the random phases and noise, the global one by default
         Sine_source (batchsize, length, 1)
         noise_source (batchsize, length 1)
         """
         # source for harmonic branch
         with torch.no_grad():
-            sine_wavs, uv, _ = self.l_sin_gen(x.transpose(1, 2))
+            sine_wavs, uv, _ = self.l_sin_gen(x.transpose(1, 2), phase_vec, generator)
             sine_wavs = sine_wavs.transpose(1, 2)
             uv = uv.transpose(1, 2)
         sine_merge = self.l_tanh(self.l_linear(sine_wavs))
 
         # source for noise branch, in the same shape as uv
-        noise = torch.randn_like(uv) * self.sine_amp / 3
+        noise = _randn_like(uv, generator) * self.sine_amp / 3
         return sine_merge, noise, uv
 
 
@@ -351,7 +401,7 @@ class HiFTGenerator(nn.Module):
         self.source_downs = nn.ModuleList()
         self.source_resblocks = nn.ModuleList()
         downsample_rates = [1] + upsample_rates[::-1][:-1]
-        downsample_cum_rates = np.cumprod(downsample_rates)
+        downsample_cum_rates = np.cumprod(downsample_rates).tolist()  # python ints, numpy scalars break torch.compile
         for i, (u, k, d) in enumerate(zip(downsample_cum_rates[::-1], source_resblock_kernel_sizes, source_resblock_dilation_sizes)):
             if u == 1:
                 self.source_downs.append(
@@ -378,20 +428,40 @@ class HiFTGenerator(nn.Module):
         self.reflection_pad = nn.ReflectionPad1d((1, 0))
         self.stft_window = torch.from_numpy(get_window("hann", istft_params["n_fft"], fftbins=True).astype(np.float32))
         self.f0_predictor = f0_predictor
+        # see `enable_length_buckets`
+        self.length_buckets = None
+        self._bucket_decode_spectrum = None
+
+    def enable_length_buckets(self, buckets, compile=True, mode=None):
+        """
+        Opt in to vocoding a fixed set of lengths only: `inference` pads the mel (repeating its last frame) to the
+        smallest of `buckets` that fits it and trims the output back, so a compiled `decode_spectrum` is specialised
+        once per bucket instead of once per request length. The vocoder isn't causal, so the padding changes the last
+        few frames of audio slightly. Inputs longer than the largest bucket run as they are, eagerly.
+
+        Args:
+            buckets: lengths in mel frames.
+            compile: run `decode_spectrum` through `torch.compile` (with `dynamic=False`) on bucketed inputs.
+            mode: `torch.compile` mode.
+        """
+        self.length_buckets = tuple(sorted(buckets))
+        self._bucket_decode_spectrum = None
+        if compile:
+            # the iSTFT stays eager: inductor miscompiles it on CPU
+            self._bucket_decode_spectrum = torch.compile(self.decode_spectrum, mode=mode, dynamic=False)
+            torch._dynamo.config.cache_size_limit = max(
+                torch._dynamo.config.cache_size_limit, 2 * len(self.length_buckets)
+            )
 
     def remove_weight_norm(self):
-        print('Removing weight norm...')
-        for l in self.ups:
-            remove_weight_norm(l)
-        for l in self.resblocks:
-            l.remove_weight_norm()
-        remove_weight_norm(self.conv_pre)
-        remove_weight_norm(self.conv_post)
-        self.m_source.remove_weight_norm()
-        for l in self.source_downs:
-            remove_weight_norm(l)
-        for l in self.source_resblocks:
-            l.remove_weight_norm()
+        "Fold the weight norm of all convs (including the f0 predictor's) into plain weights, for inference."
+        _remove_weight_norm(self)
+
+    def fuse_snake(self):
+        "Precompute the parameters of all Snake activations, see `Snake.fuse`."
+        for module in self.modules():
+            if isinstance(module, Snake):
+                module.fuse()
 
     def _stft(self, x):
         spec = torch.stft(
@@ -410,10 +480,17 @@ class HiFTGenerator(nn.Module):
         return inverse_transform
 
     def decode(self, x: torch.Tensor, s: torch.Tensor = torch.zeros(1, 1, 0)) -> torch.Tensor:
-        s_stft_real, s_stft_imag = self._stft(s.squeeze(1))
-        s_stft = torch.cat([s_stft_real, s_stft_imag], dim=1)
+        magnitude, phase = self.decode_spectrum(x, s)
+        return self._spectrum_to_speech(magnitude, phase)
+
+    def decode_spectrum(self, x: torch.Tensor, s: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+        "The network part of `decode`: mel and source excitation to the magnitude and phase of the output's STFT."
+        # the STFTs and the f0/source path run in fp32, the rest of the network may run in half precision
+        dtype = self.conv_pre.weight.dtype
+        s_stft_real, s_stft_imag = self._stft(s.squeeze(1).float())
+        s_stft = torch.cat([s_stft_real, s_stft_imag], dim=1).to(dtype)
 
-        x = self.conv_pre(x)
+        x = self.conv_pre(x.to(dtype))
         for i in range(self.num_upsamples):
             x = F.leaky_relu(x, self.lrelu_slope)
             x = self.ups[i](x)
@@ -435,10 +512,12 @@ class HiFTGenerator(nn.Module):
             x = xs / self.num_kernels
 
         x = F.leaky_relu(x)
-        x = self.conv_post(x)
+        x = self.conv_post(x).float()
         magnitude = torch.exp(x[:, :self.istft_params["n_fft"] // 2 + 1, :])
         phase = torch.sin(x[:, self.istft_params["n_fft"] // 2 + 1:, :])  # actually, sin is redundancy
+        return magnitude, phase
 
+    def _spectrum_to_speech(self, magnitude, phase):
         x = self._istft(magnitude, phase)
         x = torch.clamp(x, -self.audio_limit, self.audio_limit)
         return x
@@ -460,15 +539,80 @@ class HiFTGenerator(nn.Module):
         return generated_speech, f0
 
     @torch.inference_mode()
-    def inference(self, speech_feat: torch.Tensor, cache_source: torch.Tensor = torch.zeros(1, 1, 0)) -> torch.Tensor:
+    def inference(
+        self,
+        speech_feat: torch.Tensor,
+        cache_source: torch.Tensor = torch.zeros(1, 1, 0),
+        generator: Optional[torch.Generator] = None,
+    ) -> torch.Tensor:
+        "`generator` is the RNG of the source excitation, the global one by default."
+        num_frames = speech_feat.size(2)
+        bucket = length_bucket(num_frames, self.length_buckets)
+        if bucket is not None and bucket > num_frames:
+            speech_feat = F.pad(speech_feat, (0, bucket - num_frames), mode="replicate")
         # mel->f0
         f0 = self.f0_predictor(speech_feat)
         # f0->source
         s = self.f0_upsamp(f0[:, None]).transpose(1, 2)  # bs,n,t
-        s, _, _ = self.m_source(s)
+        s, _, _ = self.m_source(s, generator=generator)
         s = s.transpose(1, 2)
         # use cache_source to avoid glitch
         if cache_source.shape[2] != 0:
             s[:, :, :cache_source.shape[2]] = cache_source
-        generated_speech = self.decode(x=speech_feat, s=s)
+        if bucket is not None and self._bucket_decode_spectrum is not None:
+            generated_speech = self._spectrum_to_speech(*self._bucket_decode_spectrum(speech_feat, s))
+        else:
+            generated_speech = self.decode(x=speech_feat, s=s)
+        if bucket is not None:
+            num_samples = num_frames * int(self.f0_upsamp.scale_factor)
+            generated_speech, s = generated_speech[:, :num_samples], s[:, :, :num_samples]
         return generated_speech, s
+
+    @torch.inference_mode()
+    def inference_chunked(
+        self,
+        speech_feat: torch.Tensor,
+        chunk_len: int = 100,
+        context_len: int = 16,
+        overlap_len: int = 2,
+        generator: Optional[torch.Generator] = None,
+    ) -> Iterator[torch.Tensor]:
+        """
+        Chunked `inference`, for long inputs and streaming: vocodes `chunk_len` mel frames at a time, each with up to
+        `context_len` frames of context on both sides, and yields audio chunks [B, samples] as soon as they are
+        ready. Peak memory depends on the chunk size instead of the input length.
+
+        The source excitation of the frames a window shares with the previous one is carried over (as `cache_source`
+        in `inference`), and the harmonics of its new frames continue from the phases they ended at, so the
+        excitation is one continuous signal. Consecutive windows are crossfaded over `overlap_len` frames.
+        `generator` is the RNG of the excitation, the global one by default.
+        """
+        assert 0 < overlap_len <= context_len and overlap_len < chunk_len
+        hop_len = int(self.f0_upsamp.scale_factor)
+        num_frames = speech_feat.size(2)
+        source, source_start, source_end = None, 0, 0  # the previous window's source, and its span in frames
+        phase_vec = self.m_source.l_sin_gen.initial_phase(speech_feat.size(0), speech_feat.device, generator)
+        tail = None  # the previous window's audio over the overlap, to be crossfaded
+
+        for start in range(0, num_frames, chunk_len):
+            end = min(start + chunk_len, num_frames)
+            window_start, window_end = max(0, start - context_len), min(num_frames, end + context_len)
+            window = speech_feat[:, :, window_start:window_end]
+
+            # mel->f0->source, for the frames the previous window hasn't covered
+            f0 = self.f0_predictor(window)
+            f0 = self.f0_upsamp(f0[:, None, max(0, source_end - window_start):])
+            s, _, _ = self.m_source(f0.transpose(1, 2), phase_vec, generator)
+            phase_vec = self.m_source.l_sin_gen.next_phase(f0, phase_vec)
+            s = s.transpose(1, 2)
+            if source is not None:
+                s = torch.cat([source[:, :, (window_start - source_start) * hop_len:], s], dim=2)
+            source, source_start, source_end = s, window_start, window_end
+
+            wav = self.decode(x=window, s=s)
+            wav = wav[:, (start - window_start) * hop_len:(min(end + overlap_len, num_frames) - window_start) * hop_len]
+            if tail is not None:
+                fade_out = torch.linspace(1, 0, tail.size(1), device=wav.device, dtype=wav.dtype)
+                wav[:, :tail.size(1)] = wav[:, :tail.size(1)] * (1 - fade_out) + tail * fade_out
+            wav, tail = wav[:, :(end - start) * hop_len], wav[:, (end - start) * hop_len:]
+            yield wav
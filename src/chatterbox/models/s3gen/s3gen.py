@@ -17,8 +17,9 @@ import logging
 import numpy as np
 import torch
 import torchaudio as ta
+from torch.nn.utils.rnn import pad_sequence
 from functools import lru_cache
-from typing import Optional
+from typing import Iterable, Iterator, List, Optional
 
 from ..s3tokenizer import S3_SR, SPEECH_VOCAB_SIZE, S3Tokenizer
 from .const import S3GEN_SR
@@ -33,6 +34,20 @@ from .decoder import ConditionalDecoder
 from .configs import CFM_PARAMS
 
 
+# incremental token-to-wav (see `S3Token2Wav.inference_stream`), same settings as CosyVoice2's streaming mode
+STREAM_TOKEN_HOP_LEN = 25  # tokens rendered per window, ie 1s of audio
+STREAM_MEL_CACHE_LEN = 8  # mel frames re-vocoded at the start of each window
+HIFT_HOP_LEN = 480  # output samples per mel frame
+STREAM_SOURCE_CACHE_LEN = STREAM_MEL_CACHE_LEN * HIFT_HOP_LEN
+
+# mel frames vocoded at a time by `S3Token2Wav.hift_inference_chunked`, ie 2s of audio
+HIFT_CHUNK_LEN = 100
+# default lengths (in mel frames) for `S3Token2Wav.enable_length_buckets`: the flow decoder sees the reference prompt
+# and the generated mel, the vocoder only the generated mel
+FLOW_LENGTH_BUCKETS = (256, 384, 512, 768, 1024, 1536, 2048, 3072)
+HIFT_LENGTH_BUCKETS = (128, 256, 384, 512, 768, 1024, 1536, 2048)
+
+
 def drop_invalid_tokens(x):
     assert len(x.shape) <= 2 and x.shape[0] == 1, "only batch size of one allowed for now"
     return x[x < SPEECH_VOCAB_SIZE]
@@ -165,6 +180,9 @@ class S3Token2Mel(torch.nn.Module):
         # pre-computed ref embedding (prod API)
         ref_dict: Optional[dict] = None,
         finalize: bool = False,
+        n_cfm_timesteps: int = 10,
+        cfm_solver: Optional[str] = None,
+        noise_seed: Optional[int] = None,
     ):
         """
         Generate waveforms from S3 speech tokens and a reference waveform, which the speaker timbre is inferred from.
@@ -173,7 +191,7 @@ class S3Token2Mel(torch.nn.Module):
         - The speaker encoder accepts 16 kHz waveform.
         - S3TokenizerV2 accepts 16 kHz waveform.
         - The mel-spectrogram for the reference assumes 24 kHz input signal.
-        - This function is designed for batch_size=1 only.
+        - This function is designed for batch_size=1 only, see `forward_batch` for batches.
 
         Args
         ----
@@ -181,18 +199,16 @@ class S3Token2Mel(torch.nn.Module):
         - `ref_wav`: reference waveform (`torch.Tensor` with shape=[B=1, T])
         - `ref_sr`: reference sample rate
         - `finalize`: whether streaming is finished or not. Note that if False, the last 3 tokens will be ignored.
+        - `n_cfm_timesteps`: number of ODE steps of the CFM decoder. Fewer steps are faster, at some cost in quality.
+        - `cfm_solver`: ODE solver of the CFM decoder, one of `CFM_SOLVERS` (default: euler)
+        - `noise_seed`: seed of the noise the CFM decoder starts from (default: its fixed noise bank)
         """
         assert (ref_wav is None) ^ (ref_dict is None), f"Must provide exactly one of ref_wav or ref_dict (got {ref_wav} and {ref_dict})"
 
         if ref_dict is None:
             ref_dict = self.embed_ref(ref_wav, ref_sr)
         else:
-            # type/device casting (all values will be numpy if it's from a prod API call)
-            for rk in list(ref_dict):
-                if isinstance(ref_dict[rk], np.ndarray):
-                    ref_dict[rk] = torch.from_numpy(ref_dict[rk])
-                if torch.is_tensor(ref_dict[rk]):
-                    ref_dict[rk] = ref_dict[rk].to(self.device)
+            self._cast_ref_dict(ref_dict)
 
         if len(speech_tokens.shape) == 1:
             speech_tokens = speech_tokens.unsqueeze(0)
@@ -204,10 +220,59 @@ class S3Token2Mel(torch.nn.Module):
             token=speech_tokens,
             token_len=speech_token_lens,
             finalize=finalize,
+            n_timesteps=n_cfm_timesteps,
+            solver=cfm_solver,
+            noise_seeds=None if noise_seed is None else [noise_seed],
             **ref_dict,
         )
         return output_mels
 
+    def forward_batch(
+        self,
+        speech_tokens: List[torch.Tensor],
+        ref_dicts: List[dict],
+        finalize: bool = True,
+        n_cfm_timesteps: int = 10,
+        cfm_solver: Optional[str] = None,
+        noise_seeds: Optional[List[Optional[int]]] = None,
+    ):
+        """
+        Batched `forward` over utterances of different lengths and speakers: `speech_tokens[k]` is rendered with the
+        pre-computed reference `ref_dicts[k]` (and the noise seed `noise_seeds[k]`, if given). The inputs are
+        right-padded and masked, so the flow encoder and the CFM decoder run once for the whole batch, and each row
+        comes out as it would on its own.
+
+        Returns:
+            (B, 80, T) mels, right-padded, and their lengths (B,)
+        """
+        assert len(speech_tokens) == len(ref_dicts)
+        ref_dicts = [self._cast_ref_dict(ref_dict) for ref_dict in ref_dicts]
+        speech_tokens = [tokens.view(-1).to(self.device) for tokens in speech_tokens]
+        prompt_feats = [ref_dict["prompt_feat"][0] for ref_dict in ref_dicts]
+        output_mels, output_mel_lens = self.flow.inference(
+            token=pad_sequence(speech_tokens, batch_first=True),
+            token_len=torch.tensor([len(tokens) for tokens in speech_tokens], device=self.device),
+            prompt_token=pad_sequence([ref_dict["prompt_token"][0] for ref_dict in ref_dicts], batch_first=True),
+            prompt_token_len=torch.cat([ref_dict["prompt_token_len"].view(-1) for ref_dict in ref_dicts]).to(self.device),
+            prompt_feat=pad_sequence(prompt_feats, batch_first=True),
+            prompt_feat_len=torch.tensor([len(feat) for feat in prompt_feats], device=self.device),
+            embedding=torch.cat([ref_dict["embedding"] for ref_dict in ref_dicts]),
+            finalize=finalize,
+            n_timesteps=n_cfm_timesteps,
+            solver=cfm_solver,
+            noise_seeds=noise_seeds,
+        )
+        return output_mels, output_mel_lens
+
+    def _cast_ref_dict(self, ref_dict: dict):
+        "type/device casting of a pre-computed ref dict, in place (all values will be numpy if it's from a prod API call)"
+        for rk in list(ref_dict):
+            if isinstance(ref_dict[rk], np.ndarray):
+                ref_dict[rk] = torch.from_numpy(ref_dict[rk])
+            if torch.is_tensor(ref_dict[rk]):
+                ref_dict[rk] = ref_dict[rk].to(self.device)
+        return ref_dict
+
 
 class S3Token2Wav(S3Token2Mel):
     """
@@ -235,6 +300,50 @@ class S3Token2Wav(S3Token2Mel):
         trim_fade[n_trim:] = (torch.cos(torch.linspace(torch.pi, 0, n_trim)) + 1) / 2
         self.register_buffer("trim_fade", trim_fade, persistent=False) # (buffers get automatic device casting)
 
+    def optimize_for_inference(self, fuse_snake: bool = True):
+        """
+        Fold the vocoder's weight norm into plain conv weights, so they aren't recomputed on every forward, and
+        optionally precompute its Snake activations (see `Snake.fuse`). Outputs are unchanged up to float rounding.
+
+        Call it after loading the weights: the state dict layout changes (no more weight norm parametrizations) and
+        the vocoder can't be trained afterwards.
+        """
+        self.mel2wav.remove_weight_norm()
+        if fuse_snake:
+            self.mel2wav.fuse_snake()
+        return self
+
+    def set_dtype(self, dtype: torch.dtype):
+        """
+        Run the flow and the vocoder in `dtype`, eg `torch.bfloat16` or `torch.float16`, for inference. The numerically
+        sensitive parts stay fp32: the reference embedding (mel extraction, speech tokenizer, CAMPPlus) and the
+        vocoder's f0 predictor, source excitation and STFTs. Mels and waveforms are returned as fp32.
+        """
+        self.flow.to(dtype)
+        self.flow.fp16 = dtype == torch.float16
+        self.mel2wav.to(dtype)
+        self.mel2wav.f0_predictor.float()
+        self.mel2wav.m_source.float()
+        return self
+
+    def enable_length_buckets(
+        self,
+        flow_buckets=FLOW_LENGTH_BUCKETS,
+        hift_buckets=HIFT_LENGTH_BUCKETS,
+        compile: bool = True,
+        mode=None,
+    ):
+        """
+        Run the CFM decoder and the vocoder on padded, fixed lengths only, compiled once per length (see
+        `ConditionalCFM.enable_length_buckets` and `HiFTGenerator.enable_length_buckets`), so that compiled backends
+        don't recompile for every new request length. Either can be left out by passing `None` for its buckets.
+        """
+        if flow_buckets is not None:
+            self.flow.decoder.enable_length_buckets(flow_buckets, compile=compile, mode=mode)
+        if hift_buckets is not None:
+            self.mel2wav.enable_length_buckets(hift_buckets, compile=compile, mode=mode)
+        return self
+
     def forward(
         self,
         speech_tokens,
@@ -268,14 +377,45 @@ class S3Token2Wav(S3Token2Mel):
         # pre-computed ref embedding (prod API)
         ref_dict: Optional[dict] = None,
         finalize: bool = False,
+        n_cfm_timesteps: int = 10,
+        cfm_solver: Optional[str] = None,
+        noise_seed: Optional[int] = None,
     ):
-        return super().forward(speech_tokens, ref_wav=ref_wav, ref_sr=ref_sr, ref_dict=ref_dict, finalize=finalize)
+        return super().forward(
+            speech_tokens,
+            ref_wav=ref_wav,
+            ref_sr=ref_sr,
+            ref_dict=ref_dict,
+            finalize=finalize,
+            n_cfm_timesteps=n_cfm_timesteps,
+            cfm_solver=cfm_solver,
+            noise_seed=noise_seed,
+        )
 
     @torch.inference_mode()
-    def hift_inference(self, speech_feat, cache_source: torch.Tensor = None):
+    def hift_inference(
+        self, speech_feat, cache_source: torch.Tensor = None, generator: Optional[torch.Generator] = None
+    ):
         if cache_source is None:
             cache_source = torch.zeros(1, 1, 0).to(self.device)
-        return self.mel2wav.inference(speech_feat=speech_feat, cache_source=cache_source)
+        return self.mel2wav.inference(speech_feat=speech_feat, cache_source=cache_source, generator=generator)
+
+    @torch.inference_mode()
+    def hift_inference_chunked(
+        self, speech_feat, chunk_len: int = HIFT_CHUNK_LEN, generator: Optional[torch.Generator] = None
+    ) -> Iterator[torch.Tensor]:
+        """
+        Vocode `speech_feat` `chunk_len` mel frames at a time (see `HiFTGenerator.inference_chunked`), yielding
+        (B, num_samples) waveform chunks whose concatenation is the full waveform.
+        """
+        trim_fade = self.trim_fade
+        for output_wavs in self.mel2wav.inference_chunked(speech_feat, chunk_len=chunk_len, generator=generator):
+            if len(trim_fade):
+                # NOTE: ad-hoc method to reduce "spillover" from the reference clip.
+                n = min(len(trim_fade), output_wavs.size(1))
+                output_wavs[:, :n] *= trim_fade[:n]
+                trim_fade = trim_fade[n:]
+            yield output_wavs
 
     @torch.inference_mode()
     def inference(
@@ -288,11 +428,163 @@ class S3Token2Wav(S3Token2Mel):
         ref_dict: Optional[dict] = None,
         cache_source: torch.Tensor = None, # NOTE: this arg is for streaming, it can probably be removed here
         finalize: bool = True,
+        n_cfm_timesteps: int = 10,
+        cfm_solver: Optional[str] = None,
+        hift_chunk_len: Optional[int] = None,
+        noise_seed: Optional[int] = None,
     ):
-        output_mels = self.flow_inference(speech_tokens, ref_wav=ref_wav, ref_sr=ref_sr, ref_dict=ref_dict, finalize=finalize)
-        output_wavs, output_sources = self.hift_inference(output_mels, cache_source)
+        """
+        Token-to-wav. If `hift_chunk_len` is given, the vocoder runs that many mel frames at a time, which bounds
+        its memory use on long outputs; no sources are returned then. `noise_seed` seeds the noise the CFM decoder
+        starts from (default: its fixed noise bank) and the vocoder's source excitation (default: the global RNG).
+        """
+        output_mels = self.flow_inference(
+            speech_tokens,
+            ref_wav=ref_wav,
+            ref_sr=ref_sr,
+            ref_dict=ref_dict,
+            finalize=finalize,
+            n_cfm_timesteps=n_cfm_timesteps,
+            cfm_solver=cfm_solver,
+            noise_seed=noise_seed,
+        )
+        generator = None
+        if noise_seed is not None:
+            generator = torch.Generator(device=self.device).manual_seed(noise_seed)
+        if hift_chunk_len is not None:
+            assert cache_source is None, "cache_source is not supported with hift_chunk_len"
+            chunks = self.hift_inference_chunked(output_mels, hift_chunk_len, generator=generator)
+            return torch.cat(list(chunks), dim=1), None
+
+        output_wavs, output_sources = self.hift_inference(output_mels, cache_source, generator=generator)
 
         # NOTE: ad-hoc method to reduce "spillover" from the reference clip.
         output_wavs[:, :len(self.trim_fade)] *= self.trim_fade
 
         return output_wavs, output_sources
+
+    @torch.inference_mode()
+    def inference_batch(
+        self,
+        speech_tokens: List[torch.Tensor],
+        ref_dicts: List[dict],
+        n_cfm_timesteps: int = 10,
+        cfm_solver: Optional[str] = None,
+        noise_seeds: Optional[List[Optional[int]]] = None,
+    ) -> List[torch.Tensor]:
+        """
+        Batched `inference` over utterances of different lengths and speakers (see `forward_batch`): the flow and
+        the vocoder each run once for the whole batch.
+
+        Returns:
+            a (1, num_samples) waveform per utterance
+        """
+        output_mels, output_mel_lens = self.forward_batch(
+            speech_tokens,
+            ref_dicts,
+            finalize=True,
+            n_cfm_timesteps=n_cfm_timesteps,
+            cfm_solver=cfm_solver,
+            noise_seeds=noise_seeds,
+        )
+        output_wavs, _ = self.hift_inference(output_mels)
+
+        wavs = []
+        for k, mel_len in enumerate(output_mel_lens.tolist()):
+            wav = output_wavs[k:k + 1, :mel_len * HIFT_HOP_LEN]
+            # NOTE: ad-hoc method to reduce "spillover" from the reference clip.
+            wav[:, :len(self.trim_fade)] *= self.trim_fade
+            wavs.append(wav)
+        return wavs
+
+    @torch.inference_mode()
+    def inference_stream(
+        self,
+        speech_tokens: Iterable[torch.Tensor],
+        # locally-computed ref embedding (mutex with ref_dict)
+        ref_wav: Optional[torch.Tensor] = None,
+        ref_sr: Optional[int] = None,
+        # pre-computed ref embedding (prod API)
+        ref_dict: Optional[dict] = None,
+        token_hop_len: int = STREAM_TOKEN_HOP_LEN,
+        n_cfm_timesteps: int = 10,
+        cfm_solver: Optional[str] = None,
+    ) -> Iterator[torch.Tensor]:
+        """
+        Incremental token-to-wav: consumes speech tokens as they are produced (eg by `T3.inference_stream`) and
+        yields (1, num_samples) waveform chunks whose concatenation is the full utterance.
+
+        Every `token_hop_len` new tokens (plus the flow's lookahead), the flow is run on all tokens so far with
+        `finalize=False` and only the mel frames of the new tokens are vocoded. The flow decoder starts from a
+        fixed noise bank, so frames already rendered come out (almost) the same on every pass. The HiFT cache
+        carries the last `STREAM_MEL_CACHE_LEN` mel frames and their source excitation into the next window,
+        which re-vocodes them and crossfades over the withheld tail of the previous window, so chunks join
+        without glitches.
+
+        Args:
+            speech_tokens: iterable of 1D or (1, n) tensors of new tokens. Invalid tokens (>= SPEECH_VOCAB_SIZE,
+                eg T3's EOS) are dropped.
+        """
+        if ref_dict is None:
+            ref_dict = self.embed_ref(ref_wav, ref_sr)
+
+        ratio = self.flow.token_mel_ratio
+        lookahead = self.flow.pre_lookahead_len
+        tokens = torch.zeros(0, dtype=torch.long, device=self.device)
+        token_offset = 0  # tokens whose audio has been rendered
+        hift_cache = None
+
+        for new_tokens in speech_tokens:
+            new_tokens = new_tokens.view(-1).to(self.device)
+            tokens = torch.cat([tokens, new_tokens[new_tokens < SPEECH_VOCAB_SIZE]])
+            while len(tokens) - token_offset >= token_hop_len + lookahead:
+                window = tokens[:token_offset + token_hop_len + lookahead]
+                output_mels = self.flow_inference(
+                    window, ref_dict=ref_dict, finalize=False, n_cfm_timesteps=n_cfm_timesteps, cfm_solver=cfm_solver
+                )
+                wav, hift_cache = self._hift_stream(output_mels[:, :, token_offset * ratio:], hift_cache, finalize=False)
+                token_offset += token_hop_len
+                yield wav
+
+        if len(tokens) > token_offset:
+            output_mels = self.flow_inference(
+                tokens, ref_dict=ref_dict, finalize=True, n_cfm_timesteps=n_cfm_timesteps, cfm_solver=cfm_solver
+            )
+            wav, _ = self._hift_stream(output_mels[:, :, token_offset * ratio:], hift_cache, finalize=True)
+            yield wav
+        elif hift_cache is not None:
+            yield hift_cache["speech"]
+
+    def _hift_stream(self, output_mels, hift_cache: Optional[dict], finalize: bool):
+        """
+        Vocode one streaming window of mel frames. Returns the audio to emit and the cache for the next window.
+        Unless `finalize`, the last `STREAM_SOURCE_CACHE_LEN` samples are withheld, to be crossfaded with the
+        next window.
+        """
+        if hift_cache is not None:
+            output_mels = torch.cat([hift_cache["mel"], output_mels], dim=2)
+            cache_source = hift_cache["source"]
+        else:
+            cache_source = torch.zeros(1, 1, 0, device=self.device)
+
+        output_wavs, output_sources = self.hift_inference(output_mels, cache_source)
+
+        if hift_cache is None:
+            # NOTE: ad-hoc method to reduce "spillover" from the reference clip.
+            output_wavs[:, :len(self.trim_fade)] *= self.trim_fade
+        else:
+            # crossfade the re-vocoded cache frames with the withheld end of the previous window
+            prev_speech = hift_cache["speech"]
+            n = min(prev_speech.size(1), output_wavs.size(1))
+            window = torch.hamming_window(2 * n, periodic=False, device=output_wavs.device, dtype=output_wavs.dtype)
+            output_wavs[:, :n] = output_wavs[:, :n] * window[:n] + prev_speech[:, -n:] * window[n:]
+
+        if finalize:
+            return output_wavs, None
+
+        hift_cache = dict(
+            mel=output_mels[:, :, -STREAM_MEL_CACHE_LEN:],
+            source=output_sources[:, :, -STREAM_SOURCE_CACHE_LEN:],
+            speech=output_wavs[:, -STREAM_SOURCE_CACHE_LEN:],
+        )
+        return output_wavs[:, :-STREAM_SOURCE_CACHE_LEN], hift_cache
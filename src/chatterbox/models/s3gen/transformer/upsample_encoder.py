@@ -15,7 +15,7 @@
 # limitations under the License.
 # Modified from ESPnet(https://github.com/espnet/espnet)
 """Encoder definition."""
-from typing import Tuple
+from typing import Dict, Optional, Tuple
 
 import torch
 from torch import nn
@@ -240,6 +240,7 @@ class UpsampleConformerEncoder(torch.nn.Module):
         xs_lens: torch.Tensor,
         decoding_chunk_size: int = 0,
         num_decoding_left_chunks: int = -1,
+        prefix: Optional[Dict[str, torch.Tensor]] = None,
     ) -> Tuple[torch.Tensor, torch.Tensor]:
         """Embed positions in tensor.
 
@@ -254,6 +255,9 @@ class UpsampleConformerEncoder(torch.nn.Module):
             the chunk size is decoding_chunk_size.
                 >=0: use num_decoding_left_chunks
                 <0: use all left chunks
+            prefix: states of an input prefix from `prefix_states`, for batch
+                size 1. `xs` and `xs_lens` are then what follows the prefix only,
+                and the output covers the whole sequence.
         Returns:
             encoder output tensor xs, and subsampled masks
             xs: padded output tensor (B, T' ~= T/subsample_rate, D)
@@ -264,11 +268,17 @@ class UpsampleConformerEncoder(torch.nn.Module):
             checkpointing API because `__call__` attaches all the hooks of the module.
             https://discuss.pytorch.org/t/any-different-between-model-input-and-model-forward-input/3690/2
         """
-        T = xs.size(1)
-        masks = ~make_pad_mask(xs_lens, T).unsqueeze(1)  # (B, 1, T)
         if self.global_cmvn is not None:
             xs = self.global_cmvn(xs)
-        xs, pos_emb, masks = self.embed(xs, masks)
+        if prefix is None:
+            T = xs.size(1)
+            masks = ~make_pad_mask(xs_lens, T).unsqueeze(1)  # (B, 1, T)
+            xs, pos_emb, masks = self.embed(xs, masks)
+            # lookahead; padding is zeroed first, so that the lookahead of a row shorter than the batch sees the
+            # same zeros past its end as it would on its own
+            xs = self.pre_lookahead_layer(xs * masks.transpose(1, 2))
+        else:
+            xs, xs_lens, pos_emb, masks = self._lookahead_after_prefix(xs, xs_lens, prefix)
         mask_pad = masks  # (B, 1, T/subsample_rate)
         chunk_masks = add_optional_chunk_mask(xs, masks,
                                               self.use_dynamic_chunk,
@@ -276,8 +286,7 @@ class UpsampleConformerEncoder(torch.nn.Module):
                                               decoding_chunk_size,
                                               self.static_chunk_size,
                                               num_decoding_left_chunks)
-        # lookahead + conformer encoder
-        xs = self.pre_lookahead_layer(xs)
+        # conformer encoder
         xs = self.forward_layers(xs, chunk_masks, pos_emb, mask_pad)
 
         # upsample + conformer encoder
@@ -303,6 +312,37 @@ class UpsampleConformerEncoder(torch.nn.Module):
         # for cross attention with decoder later
         return xs, masks
 
+    def prefix_states(self, xs: torch.Tensor) -> Dict[str, torch.Tensor]:
+        """States of a (1, P, D) input prefix that don't depend on what follows it, for `forward(..., prefix=...)`:
+        the input layer output, and the lookahead layer output for all but the last positions, which look past
+        the prefix.
+
+        NOTE: the conformer layers attend to the whole sequence (with `static_chunk_size=0`, as in S3Gen), so their
+        states for the prefix do depend on what follows it, and are not part of this.
+        """
+        masks = torch.ones(1, 1, xs.size(1), dtype=torch.bool, device=xs.device)
+        xs, _, _ = self.embed(xs, masks)
+        lookahead = self.pre_lookahead_layer(xs)[:, :xs.size(1) - self.pre_lookahead_layer.pre_lookahead_len]
+        return {"embed": xs, "lookahead": lookahead}
+
+    def _lookahead_after_prefix(self, xs: torch.Tensor, xs_lens: torch.Tensor, prefix: Dict[str, torch.Tensor]):
+        """Input layer and lookahead of `xs`, which follows `prefix`. Returns the lookahead output, lengths,
+        positional embedding and mask of the whole sequence."""
+        assert xs.size(0) == 1, "prefix states are for batch size 1"
+        xs = xs[:, :xs_lens[0]]
+        P = prefix["embed"].size(1)
+        T = P + xs.size(1)
+        masks = torch.ones(1, 1, T, dtype=torch.bool, device=xs.device)
+        xs, _, _ = self.embed(xs, masks[:, :, P:])
+        # the first positions that look past the prefix, with enough context before them for the lookahead's causal
+        # conv, which is zero-padded on the left
+        start = prefix["lookahead"].size(1)
+        context = min(start, self.pre_lookahead_layer.conv2.kernel_size[0] - 1)
+        xs = torch.cat([prefix["embed"][:, start - context:], xs], dim=1)
+        xs = torch.cat([prefix["lookahead"], self.pre_lookahead_layer(xs)[:, context:]], dim=1)
+        pos_emb = self.embed.position_encoding(offset=0, size=T)
+        return xs, xs_lens + P, pos_emb, masks
+
     def forward_layers(self, xs: torch.Tensor, chunk_masks: torch.Tensor,
                        pos_emb: torch.Tensor,
                        mask_pad: torch.Tensor) -> torch.Tensor:
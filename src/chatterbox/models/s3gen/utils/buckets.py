@@ -0,0 +1,14 @@
+from typing import Optional, Sequence
+
+
+def length_bucket(length: int, buckets: Optional[Sequence[int]]) -> Optional[int]:
+    """
+    The smallest of the (sorted) `buckets` that fits `length`, or None if there are no buckets or `length` is
+    longer than all of them.
+    """
+    if buckets is None:
+        return None
+    for bucket in buckets:
+        if bucket >= length:
+            return bucket
+    return None
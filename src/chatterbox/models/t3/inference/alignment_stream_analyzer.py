@@ -2,9 +2,11 @@
 # Author: John Meade, Jeremy Hsu
 # MIT License
 import logging
+import math
 import torch
+import torch.nn.functional as F
 from dataclasses import dataclass
-from types import MethodType
+from transformers.models.llama.modeling_llama import rotate_half
 
 
 logger = logging.getLogger(__name__)
@@ -42,137 +44,213 @@ class AlignmentStreamAnalyzer:
         # self.queue = queue
         self.text_tokens_slice = (i, j) = text_tokens_slice
         self.eos_idx = eos_idx
-        self.alignment = torch.zeros(0, j-i)
-        # self.alignment_bin = torch.zeros(0, j-i)
         self.curr_frame_pos = 0
-        self.text_position = 0
+        self.num_frames = 0  # rows of the alignment (frames x text tokens) so far
 
-        self.started = False
-        self.started_at = None
+        # Running statistics of the alignment, kept on the attention's device so that a step costs O(S) whatever
+        # the number of frames so far, and the attention never leaves the device (see `_init_stats`).
+        self.stats = None
 
-        self.complete = False
+        # Flags of the generation, device tensors as well so that `step` never waits on the device; `started_at` and
+        # `completed_at` are frame counts, -1 until then. They are created with the statistics, on the first step.
+        self.started = None
+        self.started_at = None
+        self.complete = None
         self.completed_at = None
-        
-        # Track generated tokens for repetition detection
-        self.generated_tokens = []
+        # [long_tail, alignment_repetition, token_repetition]: why EOS was forced since the last `report`
+        self.forced_eos = None
+        self.num_generated_tokens = 0
 
-        # Using `output_attentions=True` is incompatible with optimized attention kernels, so
-        # using it for all layers slows things down too much. We can apply it to just one layer
-        # by intercepting the kwargs and adding a forward hook (credit: jrm)
+        # Row of the conditional sequence in the batch, and number of left-padding columns in the KV cache.
+        # Both are updated by `DecodeBatch` when several requests are decoded together.
+        self.batch_idx = 0
+        self.kv_offset = 0
+        # Number of leading positions (a cached conditioning prefix) that have no query rows in the first chunk.
+        self.query_offset = 0
+
+        # Using `output_attentions=True` is incompatible with optimized attention kernels, so using it for all
+        # layers slows things down too much. Instead, a forward hook on each aligned layer recomputes the attention
+        # weights of its aligned head, for the analyzed row, from that head's query and the cached keys; every
+        # layer keeps running SDPA.
         self.last_aligned_attns = []
+        self.hook_handles = []
         for i, (layer_idx, head_idx) in enumerate(LLAMA_ALIGNED_HEADS):
             self.last_aligned_attns += [None]
             self._add_attention_spy(tfmr, i, layer_idx, head_idx)
 
     def _add_attention_spy(self, tfmr, buffer_idx, layer_idx, head_idx):
         """
-        Adds a forward hook to a specific attention layer to collect outputs.
+        Adds a forward hook to a specific attention layer to collect the attention weights of one of its heads.
         """
-        def attention_forward_hook(module, input, output):
+        def attention_forward_hook(module, args, kwargs, output):
             """
-            See `LlamaAttention.forward`; the output is a 3-tuple: `attn_output, attn_weights, past_key_value`.
-            NOTE:
-            - When `output_attentions=True`, `LlamaSdpaAttention.forward` calls `LlamaAttention.forward`.
-            - `attn_output` has shape [B, H, T0, T0] for the 0th entry, and [B, H, 1, T0+i] for the rest i-th.
+            See `LlamaSdpaAttention.forward`, called by `LlamaDecoderLayer` with keyword arguments only. By the time
+            the hook runs, the layer's KV cache includes the keys of the new positions.
             """
-            if isinstance(output, tuple) and len(output) > 1 and output[1] is not None:
-                step_attention = output[1].cpu()  # (B, n_heads, T0, Ti)
-                self.last_aligned_attns[buffer_idx] = step_attention[0, head_idx]  # (T0, Ti)
+            hidden_states = kwargs["hidden_states"]  # (B, T0, dim), T0 is 1 after the first chunk
+            if self.batch_idx >= hidden_states.size(0):
+                return  # forward pass of another request's prefill
+            step_attention = self._head_attention(module, head_idx, hidden_states, kwargs)  # (T0, Ti)
+            i, j = self.text_tokens_slice
+            self.last_aligned_attns[buffer_idx] = step_attention[:, self.kv_offset + i:self.kv_offset + j]  # (T0, S)
 
         target_layer = tfmr.layers[layer_idx].self_attn
         # Register hook and store the handle
-        target_layer.register_forward_hook(attention_forward_hook)
-        if hasattr(tfmr, 'config') and hasattr(tfmr.config, 'output_attentions'):
-            self.original_output_attentions = tfmr.config.output_attentions
-            tfmr.config.output_attentions = True
+        self.hook_handles.append(target_layer.register_forward_hook(attention_forward_hook, with_kwargs=True))
+
+    def _head_attention(self, attn, head_idx, hidden_states, kwargs):
+        "The attention weights of head `head_idx` of `attn` for row `batch_idx`, as the eager attention computes them."
+        b, head_dim = self.batch_idx, attn.head_dim
+        x = hidden_states[b]
+        q_proj = slice(head_idx * head_dim, (head_idx + 1) * head_dim)
+        q = F.linear(x, attn.q_proj.weight[q_proj], None if attn.q_proj.bias is None else attn.q_proj.bias[q_proj])
+        cos, sin = kwargs["position_embeddings"]  # (B or 1, T0, head_dim)
+        cos, sin = cos[min(b, cos.size(0) - 1)], sin[min(b, sin.size(0) - 1)]
+        q = q * cos + rotate_half(q) * sin  # (T0, head_dim)
+
+        keys = kwargs["past_key_value"].key_cache[attn.layer_idx]  # (B, n_kv_heads, Ti, head_dim)
+        k = keys[b, head_idx // attn.num_key_value_groups]
+        scores = (q.float() @ k.float().T) / math.sqrt(head_dim)
+        mask = kwargs.get("attention_mask")
+        if mask is not None:
+            scores = scores + mask[b, 0, :, :k.size(0)]
+        else:
+            # no mask means plain causal attention over the whole cache
+            cache_position = kwargs["cache_position"]
+            future = torch.arange(k.size(0), device=k.device)[None] > cache_position[:, None]
+            scores = scores.masked_fill(future, -float("inf"))
+        return scores.softmax(dim=-1)
+
+    def remove_hooks(self):
+        "Detach the attention hooks once generation is over."
+        for handle in self.hook_handles:
+            handle.remove()
+        self.hook_handles = []
+
+    def _init_stats(self, S, device):
+        return dict(
+            # current position in the text, see `step`
+            text_position=torch.zeros((), dtype=torch.long, device=device),
+            # max of the last 2 columns over the previous frame
+            prev_tail_max=torch.zeros((), device=device),
+            # max of the first 4 columns over all frames
+            head_max=torch.zeros((), device=device),
+            # sums of the last 3 columns, and sum of the row maxima of all but the last 5 columns, over the frames
+            # after generation completed
+            tail_sums=torch.zeros(min(S, 3), device=device),
+            repetition=torch.zeros((), device=device),
+            # last 2 generated tokens
+            last_tokens=torch.full((2,), -1, dtype=torch.long, device=device),
+        )
 
     def step(self, logits, next_token=None):
         """
         Emits an AlignmentAnalysisResult into the output queue, and potentially modifies the logits to force an EOS.
         """
         # extract approximate alignment matrix chunk (1 frame at a time after the first chunk)
-        aligned_attn = torch.stack(self.last_aligned_attns).mean(dim=0) # (N, N)
+        aligned_attn = torch.stack(self.last_aligned_attns).mean(dim=0).float()  # (N, S)
         i, j = self.text_tokens_slice
         if self.curr_frame_pos == 0:
             # first chunk has conditioning info, text tokens, and BOS token
-            A_chunk = aligned_attn[j:, i:j].clone().cpu() # (T, S)
+            A_chunk = aligned_attn[j - self.query_offset:]  # (T, S)
         else:
             # subsequent chunks have 1 frame due to KV-caching
-            A_chunk = aligned_attn[:, i:j].clone().cpu() # (1, S)
+            A_chunk = aligned_attn  # (1, S)
 
         # TODO: monotonic masking; could have issue b/c spaces are often skipped.
         A_chunk[:, self.curr_frame_pos + 1:] = 0
 
+        S = A_chunk.size(1)
+        if self.stats is None:
+            device = A_chunk.device
+            self.stats = self._init_stats(S, device)
+            self.started = torch.zeros((), dtype=torch.bool, device=device)
+            self.started_at = torch.full((), -1, dtype=torch.long, device=device)
+            self.complete = torch.zeros((), dtype=torch.bool, device=device)
+            self.completed_at = torch.full((), -1, dtype=torch.long, device=device)
+            self.forced_eos = torch.zeros(3, dtype=torch.bool, device=device)
+        stats = self.stats
+        self.num_frames += A_chunk.size(0)
+        T = self.num_frames
 
-        self.alignment = torch.cat((self.alignment, A_chunk), dim=0)
-
-        A = self.alignment
-        T, S = A.shape
+        # Frames after generation completed feed the long-tail and repetition checks below.
+        stats["tail_sums"] += A_chunk[:, -3:].sum(dim=0) * self.complete
+        if S > 5:
+            stats["repetition"] += A_chunk[:, :-5].max(dim=1).values.sum() * self.complete
 
         # update position
         cur_text_posn = A_chunk[-1].argmax()
-        discontinuity = not(-4 < cur_text_posn - self.text_position < 7) # NOTE: very lenient!
-        if not discontinuity:
-            self.text_position = cur_text_posn
+        jump = cur_text_posn - stats["text_position"]
+        discontinuity = ~((-4 < jump) & (jump < 7))  # NOTE: very lenient!
+        stats["text_position"] = torch.where(discontinuity, stats["text_position"], cur_text_posn)
 
         # Hallucinations at the start of speech show up as activations at the bottom of the attention maps!
         # To mitigate this, we just wait until there are no activations far off-diagonal in the last 2 tokens,
         # and there are some strong activations in the first few tokens.
-        false_start = (not self.started) and (A[-2:, -2:].max() > 0.1 or A[:, :4].max() < 0.5)
-        self.started = not false_start
-        if self.started and self.started_at is None:
-            self.started_at = T
+        last_frames_tail_max = A_chunk[-2:, -2:].max()
+        if A_chunk.size(0) == 1:
+            last_frames_tail_max = torch.maximum(last_frames_tail_max, stats["prev_tail_max"])
+        stats["prev_tail_max"] = A_chunk[-1, -2:].max()
+        stats["head_max"] = torch.maximum(stats["head_max"], A_chunk[:, :4].max())
+        bad_start = (last_frames_tail_max > 0.1) | (stats["head_max"] < 0.5)
 
         # Is generation likely complete?
-        self.complete = self.complete or self.text_position >= S - 3
-        if self.complete and self.completed_at is None:
-            self.completed_at = T
-
-        # NOTE: EOS rarely assigned activations, and second-last token is often punctuation, so use last 3 tokens.
-        # NOTE: due to the false-start behaviour, we need to make sure we skip activations for the first few tokens.
-        last_text_token_duration = A[15:, -3:].sum()
+        reached_end = stats["text_position"] >= S - 3
 
         # Activations for the final token that last too long are likely hallucinations.
-        long_tail = self.complete and (A[self.completed_at:, -3:].sum(dim=0).max() >= 5) # 200ms
+        long_tail = stats["tail_sums"].max() >= 5  # 200ms
 
         # If there are activations in previous tokens after generation has completed, assume this is a repetition error.
-        alignment_repetition = self.complete and (A[self.completed_at:, :-5].max(dim=1).values.sum() > 5)
-        
-        # Track generated tokens for repetition detection
+        alignment_repetition = stats["repetition"] > 5
+
+        # Track the last generated tokens for repetition detection
         if next_token is not None:
-            # Convert tensor to scalar if needed
-            if isinstance(next_token, torch.Tensor):
-                token_id = next_token.item() if next_token.numel() == 1 else next_token.view(-1)[0].item()
-            else:
-                token_id = next_token
-            self.generated_tokens.append(token_id)
-            
-            # Keep only last 8 tokens to prevent memory issues
-            if len(self.generated_tokens) > 8:
-                self.generated_tokens = self.generated_tokens[-8:]
-            
+            token_id = next_token.view(-1)[0] if isinstance(next_token, torch.Tensor) else torch.tensor(next_token)
+            stats["last_tokens"] = torch.cat([stats["last_tokens"][1:], token_id.view(1).to(stats["last_tokens"])])
+            self.num_generated_tokens += 1
+
         # Check for excessive token repetition (3x same token in a row)
-        token_repetition = (
-            # self.complete and 
-            len(self.generated_tokens) >= 3 and
-            len(set(self.generated_tokens[-2:])) == 1
-        )
-        
-        if token_repetition:
-            repeated_token = self.generated_tokens[-1]
-            logger.warning(f"🚨 Detected 2x repetition of token {repeated_token}")
-            
+        token_repetition = stats["last_tokens"][0] == stats["last_tokens"][1]
+
+        # The flags below stay on the device, the step does not wait on it: see `report` for their host side.
+        false_start = ~self.started & bad_start
+        self.started = ~false_start
+        self.started_at = torch.where(self.started & (self.started_at < 0), T, self.started_at)
+
+        self.complete = self.complete | reached_end
+        self.completed_at = torch.where(self.complete & (self.completed_at < 0), T, self.completed_at)
+
+        long_tail = self.complete & long_tail
+        alignment_repetition = self.complete & alignment_repetition
+        # self.complete and
+        token_repetition = token_repetition & (self.num_generated_tokens >= 3)
+        forced = torch.stack([long_tail, alignment_repetition, token_repetition])
+        self.forced_eos |= forced
+        force_eos = forced.any()
+
         # Suppress EoS to prevent early termination
-        if cur_text_posn < S - 3 and S > 5:  # Only suppress if text is longer than 5 tokens
-            logits[..., self.eos_idx] = -2**15
+        if S > 5:  # Only suppress if text is longer than 5 tokens
+            logits[..., self.eos_idx].masked_fill_(cur_text_posn < S - 3, -2**15)
 
         # If a bad ending is detected, force emit EOS by modifying logits
         # NOTE: this means logits may be inconsistent with latents!
-        if long_tail or alignment_repetition or token_repetition:
-            logger.warning(f"forcing EOS token, {long_tail=}, {alignment_repetition=}, {token_repetition=}")
-            # (±2**15 is safe for all dtypes >= 16bit)
-            logits = -(2**15) * torch.ones_like(logits)
-            logits[..., self.eos_idx] = 2**15
+        # (±2**15 is safe for all dtypes >= 16bit)
+        logits = logits.masked_fill(force_eos, -2**15)
+        logits[..., self.eos_idx] = torch.where(force_eos, 2**15, logits[..., self.eos_idx])
 
         self.curr_frame_pos += 1
         return logits
+
+    def report(self):
+        """
+        Log why EOS was forced since the last call, if it was. This reads the flags of `step` on the host, ie waits
+        on the device: call it where the caller syncs anyway, eg when it checks for EOS.
+        """
+        if self.forced_eos is None:
+            return
+        long_tail, alignment_repetition, token_repetition = self.forced_eos.tolist()
+        if token_repetition:
+            logger.warning(f"🚨 Detected 2x repetition of token {int(self.stats['last_tokens'][1])}")
+        if long_tail or alignment_repetition or token_repetition:
+            logger.warning(f"forcing EOS token, {long_tail=}, {alignment_repetition=}, {token_repetition=}")
+            self.forced_eos.zero_()
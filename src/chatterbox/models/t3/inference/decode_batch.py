@@ -0,0 +1,172 @@
+from dataclasses import dataclass
+from typing import List, Optional
+
+import torch
+from torch import Tensor
+from transformers import DynamicCache
+
+from .sampling import TokenSampler
+
+
+@dataclass
+class DecodeRequest:
+    """
+    Per-request state for one CFG pair (a conditional and an unconditional row) decoded in a `DecodeBatch`.
+    """
+    max_new_tokens: int
+    temperature: float = 0.8
+    top_p: float = 0.95
+    min_p: float = 0.05
+    repetition_penalty: float = 1.2
+    cfg_weight: float = 0.5
+    alignment_stream_analyzer: Optional['AlignmentStreamAnalyzer'] = None
+    # RNG of this request's sampling, the global one if None
+    generator: Optional[torch.Generator] = None
+    # single-row sampling state, created at prefill and merged into `DecodeBatch.sampler`
+    sampler: Optional[TokenSampler] = None
+
+    # decoding progress
+    num_generated: int = 0
+    last_token: Optional[int] = None
+    # number of left-padding columns in front of this request's rows of the shared KV cache
+    kv_offset: int = 0
+    # (1, num_tokens) predicted tokens, including the final EOS, set once the request has finished
+    output: Optional[Tensor] = None
+
+    @property
+    def finished(self):
+        return self.output is not None
+
+
+class DecodeBatch:
+    """
+    A pool of CFG pairs that are decoded together, one token per step, with a single shared KV cache.
+
+    Rows are interleaved: request `k` owns row `2k` (conditional) and `2k + 1` (unconditional). Requests are
+    prefilled on their own and merged in by left-padding the KV cache along the sequence axis; the padding is
+    hidden by `attention_mask`, and each row keeps its own `position_ids` so RoPE sees unpadded positions.
+
+    Between steps, the last column of `generated_ids` holds the sampled token that still has to be fed through
+    the model.
+    """
+
+    def __init__(self, pad_token_id: int):
+        self.pad_token_id = pad_token_id
+        self.requests: List[DecodeRequest] = []
+        self.past: Optional[DynamicCache] = None
+        self.attention_mask: Optional[Tensor] = None  # (2N, S)
+        self.position_ids: Optional[Tensor] = None  # (2N, 1), position of the pending token
+        self.generated_ids: Optional[Tensor] = None  # (N, G), left-padded with `pad_token_id`
+        self.sampler: Optional[TokenSampler] = None  # one row per request
+
+    def __len__(self):
+        return len(self.requests)
+
+    @property
+    def seq_len(self):
+        return 0 if self.attention_mask is None else self.attention_mask.size(1)
+
+    def add(self, request: DecodeRequest, past: DynamicCache, generated_ids: Tensor):
+        """
+        Merge a prefilled request into the batch.
+
+        Args:
+            past: KV cache with the 2 CFG rows of the request.
+            generated_ids: (1, G) token ids sampled so far, starting with BOS.
+        """
+        seq_len = past.get_seq_length()
+        device = generated_ids.device
+        attention_mask = torch.ones(2, seq_len, dtype=torch.long, device=device)
+        position_ids = torch.full((2, 1), seq_len, dtype=torch.long, device=device)
+        request.kv_offset = 0
+
+        if not self.requests:
+            self.past = past
+            self.attention_mask = attention_mask
+            self.position_ids = position_ids
+            self.generated_ids = generated_ids
+            self.sampler = request.sampler
+        else:
+            S = max(self.seq_len, seq_len)
+            self._left_pad(S - self.seq_len)
+            pad = S - seq_len
+            request.kv_offset = pad
+            for layer_idx in range(len(self.past)):
+                k, v = past.key_cache[layer_idx], past.value_cache[layer_idx]
+                self.past.key_cache[layer_idx] = torch.cat([self.past.key_cache[layer_idx], _pad_seq(k, pad, dim=2)])
+                self.past.value_cache[layer_idx] = torch.cat([self.past.value_cache[layer_idx], _pad_seq(v, pad, dim=2)])
+            self.attention_mask = torch.cat([self.attention_mask, _pad_seq(attention_mask, pad, dim=1)])
+            self.position_ids = torch.cat([self.position_ids, position_ids])
+
+            G = max(self.generated_ids.size(1), generated_ids.size(1))
+            self.generated_ids = torch.cat([
+                _pad_seq(self.generated_ids, G - self.generated_ids.size(1), dim=1, value=self.pad_token_id),
+                _pad_seq(generated_ids, G - generated_ids.size(1), dim=1, value=self.pad_token_id),
+            ])
+            self.sampler = TokenSampler.cat([self.sampler, request.sampler])
+
+        self.requests.append(request)
+        self._sync_analyzers()
+
+    def append_tokens(self, next_tokens: Tensor):
+        "Append one sampled token per request, (N, 1)."
+        self.generated_ids = torch.cat([self.generated_ids, next_tokens], dim=1)
+
+    def remove(self, indices: List[int]):
+        "Drop the given requests (by index in `self.requests`) from the batch."
+        if not indices:
+            return
+        drop = set(indices)
+        keep = [k for k in range(len(self.requests)) if k not in drop]
+        self.requests = [self.requests[k] for k in keep]
+        if not keep:
+            self.past = self.attention_mask = self.position_ids = self.generated_ids = self.sampler = None
+            return
+
+        device = self.generated_ids.device
+        rows = torch.tensor([r for k in keep for r in (2 * k, 2 * k + 1)], device=device)
+        self.past.batch_select_indices(rows)
+        self.attention_mask = self.attention_mask[rows]
+        self.position_ids = self.position_ids[rows]
+        self.generated_ids = self.generated_ids[torch.tensor(keep, device=device)]
+        self.sampler = self.sampler.select(keep)
+
+        # cut away columns that are padding for every remaining row
+        trim = min(r.kv_offset for r in self.requests)
+        if trim > 0:
+            for layer_idx in range(len(self.past)):
+                self.past.key_cache[layer_idx] = self.past.key_cache[layer_idx][:, :, trim:]
+                self.past.value_cache[layer_idx] = self.past.value_cache[layer_idx][:, :, trim:]
+            self.attention_mask = self.attention_mask[:, trim:]
+            for request in self.requests:
+                request.kv_offset -= trim
+        G = max(r.num_generated for r in self.requests) + 1  # +1 for BOS
+        self.generated_ids = self.generated_ids[:, -G:]
+
+        self._sync_analyzers()
+
+    def _left_pad(self, pad: int):
+        if pad <= 0:
+            return
+        for layer_idx in range(len(self.past)):
+            self.past.key_cache[layer_idx] = _pad_seq(self.past.key_cache[layer_idx], pad, dim=2)
+            self.past.value_cache[layer_idx] = _pad_seq(self.past.value_cache[layer_idx], pad, dim=2)
+        self.attention_mask = _pad_seq(self.attention_mask, pad, dim=1)
+        for request in self.requests:
+            request.kv_offset += pad
+
+    def _sync_analyzers(self):
+        "Point each alignment analyzer at its conditional row and the unpadded part of the KV cache."
+        for k, request in enumerate(self.requests):
+            if request.alignment_stream_analyzer is not None:
+                request.alignment_stream_analyzer.batch_idx = 2 * k
+                request.alignment_stream_analyzer.kv_offset = request.kv_offset
+
+
+def _pad_seq(x: Tensor, pad: int, dim: int, value=0):
+    "Left-pad `x` along `dim`."
+    if pad <= 0:
+        return x
+    shape = list(x.shape)
+    shape[dim] = pad
+    return torch.cat([x.new_full(shape, value), x], dim=dim)
@@ -0,0 +1,149 @@
+from typing import List, Optional, Sequence, Union
+
+import torch
+from torch import Tensor
+
+
+Param = Union[float, Sequence[float]]
+
+
+class TokenSampler:
+    """
+    Fused, on-device sampling for N requests decoded with CFG.
+
+    Replaces the chain of HF logits processors (repetition penalty, min-p, top-p) with a single batched pass over
+    (N, V) logits, using per-row sampling parameters. Tokens seen so far are tracked in a fixed-size (N, V) count
+    tensor rather than a growing list of ids, and EOS is accumulated into an on-device `finished` flag, so nothing
+    here needs to synchronize with the host.
+
+    The math matches `RepetitionPenaltyLogitsProcessor`, `MinPLogitsWarper` and `TopPLogitsWarper` (with
+    `min_tokens_to_keep=1`), applied in that order after temperature scaling.
+
+    Rows draw from the global RNG, unless they were given a `torch.Generator` of their own: a seeded request then
+    samples the same tokens whatever else is decoded alongside it, or in other threads.
+    """
+
+    def __init__(
+        self,
+        *,
+        vocab_size: int,
+        eos_idx: int,
+        device,
+        cfg_weight: Param = 0.5,
+        temperature: Param = 0.8,
+        min_p: Param = 0.05,
+        top_p: Param = 0.95,
+        repetition_penalty: Param = 1.2,
+        num_rows: int = 1,
+        generator: Optional[torch.Generator] = None,
+    ):
+        self.eos_idx = eos_idx
+        self.generators = [generator] * num_rows
+        # plain python copies of the params, so the optional passes can be skipped without reading tensors back
+        self._params = {
+            name: _as_list(value, num_rows)
+            for name, value in dict(
+                cfg_weight=cfg_weight,
+                temperature=temperature,
+                min_p=min_p,
+                top_p=top_p,
+                repetition_penalty=repetition_penalty,
+            ).items()
+        }
+        self._build_tensors(device)
+        self.token_counts = torch.zeros(num_rows, vocab_size, dtype=torch.int32, device=device)
+        self.finished = torch.zeros(num_rows, dtype=torch.bool, device=device)
+
+    def __len__(self):
+        return self.token_counts.size(0)
+
+    def _build_tensors(self, device):
+        for name, values in self._params.items():
+            setattr(self, name, torch.tensor(values, dtype=torch.float32, device=device)[:, None])  # (N, 1)
+        # probability mass of the tail cut by top-p, computed in double like `TopPLogitsWarper` does
+        self.top_p_tail = torch.tensor([1 - p for p in self._params["top_p"]], device=device)[:, None]
+
+    @classmethod
+    def cat(cls, samplers: List['TokenSampler']) -> 'TokenSampler':
+        "Stack the rows of several samplers into one."
+        first = samplers[0]
+        sampler = cls.__new__(cls)
+        sampler.eos_idx = first.eos_idx
+        sampler.generators = sum((s.generators for s in samplers), [])
+        sampler._params = {name: sum((s._params[name] for s in samplers), []) for name in first._params}
+        sampler._build_tensors(first.token_counts.device)
+        sampler.token_counts = torch.cat([s.token_counts for s in samplers])
+        sampler.finished = torch.cat([s.finished for s in samplers])
+        return sampler
+
+    def select(self, rows: List[int]) -> 'TokenSampler':
+        "Keep only the given rows, in the given order."
+        sampler = self.__class__.__new__(self.__class__)
+        sampler.eos_idx = self.eos_idx
+        sampler.generators = [self.generators[k] for k in rows]
+        sampler._params = {name: [values[k] for k in rows] for name, values in self._params.items()}
+        sampler._build_tensors(self.token_counts.device)
+        index = torch.tensor(rows, dtype=torch.long, device=self.token_counts.device)
+        sampler.token_counts = self.token_counts[index]
+        sampler.finished = self.finished[index]
+        return sampler
+
+    def combine_cfg(self, logits_step: Tensor) -> Tensor:
+        "Interleaved (2N, V) conditional / unconditional logits -> (N, V) guided logits."
+        cond, uncond = logits_step[0::2], logits_step[1::2]
+        cfg = self.cfg_weight.to(cond.dtype)
+        return cond + cfg * (cond - uncond)
+
+    def update(self, tokens: Tensor):
+        "Record one sampled token per row, (N, 1)."
+        self.token_counts.scatter_add_(1, tokens, torch.ones_like(tokens, dtype=self.token_counts.dtype))
+        self.finished |= tokens.view(-1) == self.eos_idx
+
+    def sample(self, logits: Tensor) -> Tensor:
+        """
+        Apply repetition penalty, temperature, min-p and top-p to (N, V) logits, then draw one token per row.
+
+        Returns:
+            (N, 1) sampled token ids. Call `update` with them to feed the repetition penalty and EOS tracking.
+        """
+        logits = logits.float()  # softmax and top-p's cumulative sums are too coarse in half precision
+        dtype = logits.dtype
+
+        # repetition penalty, on every token that was seen at least once
+        if any(p != 1.0 for p in self._params["repetition_penalty"]):
+            penalty = self.repetition_penalty.to(dtype)
+            penalized = torch.where(logits < 0, logits * penalty, logits / penalty)
+            logits = torch.where(self.token_counts > 0, penalized, logits)
+
+        if any(t != 1.0 for t in self._params["temperature"]):
+            logits = logits / self.temperature.to(dtype)
+
+        # min-p: drop tokens whose probability is below `min_p` times the top probability (the top token stays)
+        if any(p > 0.0 for p in self._params["min_p"]):
+            probs = torch.softmax(logits, dim=-1)
+            top_probs = probs.amax(dim=-1, keepdim=True)
+            logits = logits.masked_fill(probs < self.min_p.to(dtype) * top_probs, -float("inf"))
+
+        # top-p: drop the low-probability tail whose cumulative mass is at most `1 - top_p` (the top token stays)
+        if any(p < 1.0 for p in self._params["top_p"]):
+            sorted_logits, sorted_indices = torch.sort(logits, descending=False)
+            cumulative_probs = sorted_logits.softmax(dim=-1).cumsum(dim=-1)
+            sorted_to_remove = cumulative_probs <= self.top_p_tail.to(dtype)
+            sorted_to_remove[..., -1:] = False
+            to_remove = sorted_to_remove.scatter(1, sorted_indices, sorted_to_remove)
+            logits = logits.masked_fill(to_remove, -float("inf"))
+
+        probs = torch.softmax(logits, dim=-1)
+        if all(g is None for g in self.generators):
+            return torch.multinomial(probs, num_samples=1)  # (N, 1)
+        return torch.cat([
+            torch.multinomial(probs[k:k + 1], num_samples=1, generator=g) for k, g in enumerate(self.generators)
+        ])
+
+
+def _as_list(value: Param, num_rows: int) -> List[float]:
+    if isinstance(value, (int, float)):
+        return [float(value)] * num_rows
+    values = [float(v) for v in value]
+    assert len(values) == num_rows, f"expected {num_rows} values, got {len(values)}"
+    return values
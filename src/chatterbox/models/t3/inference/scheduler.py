@@ -0,0 +1,148 @@
+import logging
+import queue
+import threading
+from concurrent.futures import Future
+from typing import Optional
+
+import torch
+from torch import Tensor
+
+from ..modules.cond_enc import T3Cond
+from .decode_batch import DecodeBatch, DecodeRequest
+
+
+logger = logging.getLogger(__name__)
+
+
+class T3Scheduler:
+    """
+    Continuous batching for `T3`.
+
+    A background thread keeps a pool of live decode slots (a `DecodeBatch`) and runs one forward pass per step for
+    all of them. New requests are admitted between decode steps, and each request is evicted and resolved as soon
+    as it emits `stop_speech_token`, so the per-step cost stays roughly constant no matter how many callers wait.
+
+    Usage:
+        scheduler = T3Scheduler(t3, max_batch_size=8)
+        speech_tokens = scheduler.submit(t3_cond=cond, text_tokens=tokens).result()
+    """
+
+    def __init__(self, t3: 'T3', max_batch_size=8):
+        assert max_batch_size >= 1
+        self.t3 = t3
+        self.max_batch_size = max_batch_size
+        self._pending = queue.Queue()
+        self._stop = threading.Event()
+        self._thread = None
+        self._thread_lock = threading.Lock()
+
+    def start(self):
+        with self._thread_lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._stop.clear()
+                self._thread = threading.Thread(target=self._run, name="t3-scheduler", daemon=True)
+                self._thread.start()
+        return self
+
+    def stop(self):
+        with self._thread_lock:
+            self._stop.set()
+            if self._thread is not None:
+                self._thread.join()
+                self._thread = None
+
+    def submit(
+        self,
+        *,
+        t3_cond: T3Cond,
+        text_tokens: Tensor,
+        max_new_tokens=None,
+        temperature=0.8,
+        top_p=0.95,
+        min_p=0.05,
+        repetition_penalty=1.2,
+        cfg_weight=0.5,
+        generator: Optional[torch.Generator] = None,
+    ) -> Future:
+        """
+        Queue one utterance for decoding. Thread-safe.
+
+        Args:
+            text_tokens: 1D tensor of text tokens, including the start / stop text tokens.
+            generator: RNG to sample this utterance's tokens from, on the model's device. Sampling otherwise
+                draws from the global RNG of the scheduler thread, shared by all requests.
+        Returns:
+            a `Future` resolving to a (1, num_tokens) tensor of speech tokens, like `T3.inference`.
+        """
+        request = DecodeRequest(
+            max_new_tokens=max_new_tokens or self.t3.hp.max_speech_tokens,
+            temperature=temperature,
+            top_p=top_p,
+            min_p=min_p,
+            repetition_penalty=repetition_penalty,
+            cfg_weight=cfg_weight,
+            generator=generator,
+        )
+        future = Future()
+        self.start()
+        self._pending.put((request, t3_cond, text_tokens, future))
+        return future
+
+    def _run(self):
+        batch = DecodeBatch(pad_token_id=self.t3.hp.start_speech_token)
+        futures = {}  # id(request) -> Future
+
+        while not self._stop.is_set():
+            # admit new requests between decode steps; block only when there is nothing to decode
+            while len(batch) < self.max_batch_size:
+                try:
+                    item = self._pending.get(block=len(batch) == 0, timeout=0.1)
+                except queue.Empty:
+                    break
+                request, t3_cond, text_tokens, future = item
+                if not future.set_running_or_notify_cancel():
+                    continue
+                try:
+                    past, generated_ids = self.t3.prefill(request, t3_cond=t3_cond, text_tokens=text_tokens)
+                except Exception as e:
+                    _release(request)
+                    future.set_exception(e)
+                    continue
+                if request.finished:
+                    future.set_result(request.output)
+                else:
+                    batch.add(request, past, generated_ids)
+                    futures[id(request)] = future
+
+            if len(batch) == 0:
+                continue
+
+            try:
+                done = self.t3.decode_step(batch)
+            except Exception as e:
+                logger.exception("T3 decode step failed, dropping %d requests", len(batch))
+                for request in batch.requests:
+                    _release(request)
+                    futures.pop(id(request)).set_exception(e)
+                batch = DecodeBatch(pad_token_id=self.t3.hp.start_speech_token)
+                continue
+
+            for request in done:
+                futures.pop(id(request)).set_result(request.output)
+
+        # shutting down: fail whatever is still in flight
+        for request in batch.requests:
+            _release(request)
+            futures.pop(id(request)).set_exception(RuntimeError("T3Scheduler stopped"))
+        while True:
+            try:
+                request, _, _, future = self._pending.get_nowait()
+            except queue.Empty:
+                break
+            if future.set_running_or_notify_cancel():
+                future.set_exception(RuntimeError("T3Scheduler stopped"))
+
+
+def _release(request: DecodeRequest):
+    if request.alignment_stream_analyzer is not None:
+        request.alignment_stream_analyzer.remove_hooks()
@@ -2,7 +2,7 @@ from typing import Optional
 
 import torch
 from torch import nn as nn
-from transformers import LlamaConfig, LlamaModel, LlamaPreTrainedModel, GenerationMixin
+from transformers import LlamaConfig, LlamaModel, LlamaPreTrainedModel, GenerationMixin, StaticCache
 from transformers.modeling_outputs import CausalLMOutputWithCrossAttentions
 
 
@@ -74,9 +74,12 @@ class T3HuggingfaceBackend(LlamaPreTrainedModel, GenerationMixin):
         self,
         inputs_embeds: torch.Tensor,
         past_key_values: Optional[torch.Tensor]=None,
+        attention_mask: Optional[torch.Tensor]=None,
+        position_ids: Optional[torch.Tensor]=None,
+        cache_position: Optional[torch.Tensor]=None,
         use_cache=True,
         output_attentions=False,
-        output_hidden_states=True,
+        output_hidden_states=False,
         return_dict=True,
     ):
         """
@@ -85,22 +88,30 @@ class T3HuggingfaceBackend(LlamaPreTrainedModel, GenerationMixin):
 
         :param inputs_embeds: (B, S, C) float32 tensor of conditioning inputs. If past key values are given,
         S should be 1.
+        :param attention_mask: optional (B, S_past + S) padding mask, used when decoding several left-padded
+        requests together.
+        :param position_ids: optional (B, S) RoPE positions, to skip over the padding.
+        :param cache_position: (S,) indices of the new tokens in the KV cache, required with a `StaticCache`.
         """
         is_large_input = inputs_embeds.size(1) != 1
-        has_cache = past_key_values is not None and len(past_key_values) > 0
-        assert not (is_large_input and has_cache)
+        # NOTE: a static cache is preallocated, so its length says nothing about what has been written to it
+        has_cache = past_key_values is not None and not isinstance(past_key_values, StaticCache) and len(past_key_values) > 0
+        # a multi-token input on top of a cache (eg a cached conditioning prefix) must say where it goes
+        assert not (is_large_input and has_cache) or cache_position is not None
         assert return_dict
-        assert output_hidden_states
 
         tfmr_out = self.model(
             inputs_embeds=inputs_embeds,
             past_key_values=past_key_values,
+            attention_mask=attention_mask,
+            position_ids=position_ids,
+            cache_position=cache_position,
             use_cache=use_cache,
             output_attentions=output_attentions,
             output_hidden_states=output_hidden_states,
             return_dict=True,
         )
-        hidden_states = tfmr_out.hidden_states[-1]  # (B, seq, dim)
+        hidden_states = tfmr_out.last_hidden_state  # (B, seq, dim)
 
         logits = self.speech_head(hidden_states)
         # assert inputs_embeds.size(0) == 1 # (disabled for CFG)
@@ -22,11 +22,10 @@ class T3Cond:
     emotion_adv: Optional[Tensor] = 0.5
 
     def to(self, *, device=None, dtype=None):
-        "Cast to a device and dtype. Dtype casting is ignored for long/int tensors."
+        "Cast to a device and dtype, in place. Dtype casting is ignored for long/int tensors."
         for k, v in self.__dict__.items():
             if torch.is_tensor(v):
-                is_fp = type(v.view(-1)[0].item()) is not int
-                setattr(self, k, v.to(device=device, dtype=dtype if is_fp else None))
+                setattr(self, k, v.to(device=device, dtype=dtype if v.is_floating_point() else None))
         return self
 
     def save(self, fpath):
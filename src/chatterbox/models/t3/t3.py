@@ -1,6 +1,9 @@
 # Copyright (c) 2025 Resemble AI
 # MIT License
 import logging
+import weakref
+from collections import OrderedDict
+from dataclasses import replace
 from typing import Union, Optional, List
 
 logger = logging.getLogger(__name__)
@@ -9,8 +12,7 @@ from tqdm import tqdm
 import torch
 import torch.nn.functional as F
 from torch import nn, Tensor
-from transformers import LlamaModel, LlamaConfig
-from transformers.generation.logits_process import TopPLogitsWarper, RepetitionPenaltyLogitsProcessor, MinPLogitsWarper
+from transformers import LlamaModel, LlamaConfig, DynamicCache, StaticCache
 
 from .modules.learned_pos_emb import LearnedPositionEmbeddings
 
@@ -19,11 +21,22 @@ from .modules.t3_config import T3Config
 from .llama_configs import LLAMA_CONFIGS
 from .inference.t3_hf_backend import T3HuggingfaceBackend
 from .inference.alignment_stream_analyzer import AlignmentStreamAnalyzer
+from .inference.decode_batch import DecodeBatch, DecodeRequest
+from .inference.sampling import TokenSampler
 from ..utils import AttrDict
 
 
 logger = logging.getLogger(__name__)
 
+# static KV caches are allocated in multiples of this many positions, so they can be reused across requests
+STATIC_CACHE_LEN_MULTIPLE = 256
+
+# number of conditioning prefixes (one per `T3Cond`) whose transformer KV states are kept around
+COND_PREFIX_CACHE_SIZE = 32
+
+# `inference` looks for EOS once every this many steps, instead of reading every sampled token back from the device
+EOS_CHECK_INTERVAL = 8
+
 
 def _ensure_BOT_EOT(text_tokens: Tensor, hp):
     B = text_tokens.size(0)
@@ -67,12 +80,26 @@ class T3(nn.Module):
         # logit projection
         self.text_head = nn.Linear(self.cfg.hidden_size, hp.text_tokens_dict_size, bias=False)
         self.speech_head = nn.Linear(self.cfg.hidden_size, hp.speech_tokens_dict_size, bias=False)
-        self.compiled = False
+
+        # compiled single-token decode step, see `enable_compiled_decode`
+        self._compiled_decode_step = None
+
+        # idle preallocated KV caches, keyed by (batch_size, dtype). Calls take theirs out while decoding, see
+        # `_get_static_cache`. Kept in a plain dict so they stay out of the state dict.
+        self._static_caches = {}
+
+        # LRU of the KV states of conditioning prefixes: id(t3_cond) -> (weakref(t3_cond), [(key, value), ...])
+        self.cond_prefix_cache_size = COND_PREFIX_CACHE_SIZE
+        self._cond_prefix_kv = OrderedDict()
 
     @property
     def device(self):
         return self.speech_head.weight.device
 
+    @property
+    def dtype(self):
+        return self.speech_head.weight.dtype
+
     def prepare_conditioning(self, t3_cond: T3Cond):
         """
         Token cond data needs to be embedded, so that needs to be here instead of in `T3CondEnc`.
@@ -80,6 +107,10 @@ class T3(nn.Module):
         if t3_cond.cond_prompt_speech_tokens is not None and t3_cond.cond_prompt_speech_emb is None:
             t3_cond.cond_prompt_speech_emb = self.speech_emb(t3_cond.cond_prompt_speech_tokens) + \
                 self.speech_pos_emb(t3_cond.cond_prompt_speech_tokens)
+        # conditionals are prepared in fp32 and shared across calls (`self.conds`, the conditionals cache), while the
+        # model may run in half precision: cast a copy
+        if self.dtype != torch.float32:
+            t3_cond = replace(t3_cond).to(dtype=self.dtype)
         return self.cond_enc(t3_cond)  # (B, len_cond, dim)
 
     def prepare_input_embeds(
@@ -227,15 +258,77 @@ class T3(nn.Module):
         length_penalty=1.0,
         repetition_penalty=1.2,
         cfg_weight=0.5,
+        cache_implementation="static",
+        generator: Optional[torch.Generator] = None,
     ):
         """
         Args:
             text_tokens: a 1D (unbatched) or 2D (batched) tensor.
+            cache_implementation: "static" decodes into a preallocated KV cache that is written in place and
+                reused by later calls (concurrent calls each get their own); "dynamic" grows the cache by
+                concatenation on every step.
+            generator: RNG to sample from, on the model's device; the global one by default.
+        Returns:
+            (1, num_tokens) predicted speech tokens, including the final EOS if one was emitted.
+        """
+        chunks = list(self.inference_stream(
+            t3_cond=t3_cond,
+            text_tokens=text_tokens,
+            initial_speech_tokens=initial_speech_tokens,
+            prepend_prompt_speech_tokens=prepend_prompt_speech_tokens,
+            num_return_sequences=num_return_sequences,
+            max_new_tokens=max_new_tokens,
+            stop_on_eos=stop_on_eos,
+            do_sample=do_sample,
+            temperature=temperature,
+            top_p=top_p,
+            min_p=min_p,
+            length_penalty=length_penalty,
+            repetition_penalty=repetition_penalty,
+            cfg_weight=cfg_weight,
+            cache_implementation=cache_implementation,
+            generator=generator,
+        ))
+        return torch.cat(chunks, dim=1)
+
+    @torch.inference_mode()
+    def inference_stream(
+        self,
+        *,
+        t3_cond: T3Cond,
+        text_tokens: Tensor,
+        initial_speech_tokens: Optional[Tensor]=None,
+
+        # misc conditioning
+        prepend_prompt_speech_tokens: Optional[Tensor]=None,
+
+        # HF generate args
+        num_return_sequences=1,
+        max_new_tokens=None,
+        stop_on_eos=True,
+        do_sample=True,
+        temperature=0.8,
+        top_p=0.95,
+        min_p=0.05,
+        length_penalty=1.0,
+        repetition_penalty=1.2,
+        cfg_weight=0.5,
+        cache_implementation="static",
+        generator: Optional[torch.Generator] = None,
+    ):
+        """
+        Generator version of `inference`, which yields the predicted speech tokens while decoding goes on, as
+        (1, n) tensors of `EOS_CHECK_INTERVAL` tokens (the last one may be shorter, and ends with EOS if one was
+        emitted). Tokens are handed out whenever the loop checks for EOS anyway, so streaming adds no device syncs.
+
+        The decoder state (including the static KV cache) stays in use until the generator is exhausted or closed;
+        generators that are consumed concurrently or interleaved each decode into a cache of their own.
         """
         # Validate / sanitize inputs
         assert prepend_prompt_speech_tokens is None, "not implemented"
         _ensure_BOT_EOT(text_tokens, self.hp)
         text_tokens = torch.atleast_2d(text_tokens).to(dtype=torch.long, device=self.device)
+        max_new_tokens = max_new_tokens or self.hp.max_speech_tokens
 
         # Default initial speech to a single start-of-speech token
         if initial_speech_tokens is None:
@@ -252,32 +345,27 @@ class T3(nn.Module):
         # In order to use the standard HF generate method, we need to extend some methods to inject our custom logic
         # Note the llama-specific logic. Other tfmr types can be added later.
 
-        self.compiled = False
-
-        # TODO? synchronize the expensive compile function
-        # with self.compile_lock:
-        if not self.compiled:
-            # Default to None for English models, only create for multilingual
-            alignment_stream_analyzer = None
-            if self.hp.is_multilingual:
-                alignment_stream_analyzer = AlignmentStreamAnalyzer(
-                    self.tfmr,
-                    None,
-                    text_tokens_slice=(len_cond, len_cond + text_tokens.size(-1)),
-                    alignment_layer_idx=9, # TODO: hparam or something?
-                    eos_idx=self.hp.stop_speech_token,
-                )
-                assert alignment_stream_analyzer.eos_idx == self.hp.stop_speech_token
-
-            patched_model = T3HuggingfaceBackend(
-                config=self.cfg,
-                llama=self.tfmr,
-                speech_enc=self.speech_emb,
-                speech_head=self.speech_head,
-                alignment_stream_analyzer=alignment_stream_analyzer,
+        # Default to None for English models, only create for multilingual
+        alignment_stream_analyzer = None
+        if self.hp.is_multilingual:
+            alignment_stream_analyzer = AlignmentStreamAnalyzer(
+                self.tfmr,
+                None,
+                text_tokens_slice=(len_cond, len_cond + text_tokens.size(-1)),
+                alignment_layer_idx=9, # TODO: hparam or something?
+                eos_idx=self.hp.stop_speech_token,
             )
-            self.patched_model = patched_model
-            self.compiled = True
+            assert alignment_stream_analyzer.eos_idx == self.hp.stop_speech_token
+
+        # the backend is built once and shared across calls; only the analyzer is per call
+        self._get_backend().alignment_stream_analyzer = alignment_stream_analyzer
+
+        # the compiled decode step needs fixed-shape inputs, and cannot serve the analyzer's attention hooks
+        use_compiled_step = (
+            self._compiled_decode_step is not None
+            and cache_implementation == "static"
+            and alignment_stream_analyzer is None
+        )
 
         # # Run normal generate method, which calls our custom extended methods
         # return self.patched_model.generate(
@@ -308,87 +396,424 @@ class T3(nn.Module):
         # Combine condition and BOS token for the initial input
         inputs_embeds = torch.cat([embeds, bos_embed], dim=1)
 
-        # Track generated token ids; start with the BOS token.
-        generated_ids = bos_token.clone()
-        predicted = []  # To store the predicted tokens
+        # Predicted tokens are written into a preallocated buffer; the sampler tracks seen tokens and EOS on device.
+        predicted = torch.empty(1, max_new_tokens, dtype=torch.long, device=device)
+        sampler = TokenSampler(
+            vocab_size=self.hp.speech_tokens_dict_size,
+            eos_idx=self.hp.stop_speech_token,
+            device=device,
+            cfg_weight=cfg_weight,
+            temperature=temperature,
+            min_p=min_p,
+            top_p=top_p,
+            repetition_penalty=float(repetition_penalty),
+            generator=generator,
+        )
+        sampler.update(bos_token)
+        last_token = bos_token
+
+        if cache_implementation == "static":
+            past = self._get_static_cache(
+                batch_size=inputs_embeds.size(0),
+                max_cache_len=inputs_embeds.size(1) + max_new_tokens,
+                dtype=inputs_embeds.dtype,
+            )
+        else:
+            past = DynamicCache()
 
-        # Instantiate the logits processors.
-        top_p_warper = TopPLogitsWarper(top_p=top_p)
-        min_p_warper = MinPLogitsWarper(min_p=min_p)
-        top_p_warper = TopPLogitsWarper(top_p=top_p)
-        repetition_penalty_processor = RepetitionPenaltyLogitsProcessor(penalty=float(repetition_penalty))
+        # Reuse the KV states of the conditioning prefix, so only text and speech tokens need prefilling
+        prefix_len = self._load_cond_prefix(past, t3_cond, embeds[:1, :len_cond], batch_size=inputs_embeds.size(0))
+        if self.patched_model.alignment_stream_analyzer is not None:
+            self.patched_model.alignment_stream_analyzer.query_offset = prefix_len
+        cache_position = torch.arange(prefix_len, inputs_embeds.size(1), device=device)
 
         # ---- Initial Forward Pass (no kv_cache yet) ----
         output = self.patched_model(
-            inputs_embeds=inputs_embeds,
-            past_key_values=None,
+            inputs_embeds=inputs_embeds[:, prefix_len:],
+            past_key_values=past,
+            cache_position=cache_position,
             use_cache=True,
-            output_attentions=True,
-            output_hidden_states=True,
+            output_attentions=False,
+            output_hidden_states=False,
             return_dict=True,
         )
         # Initialize kv_cache with the full context.
         past = output.past_key_values
+        logits_step = output.logits[:, -1, :]
 
         # ---- Generation Loop using kv_cache ----
-        for i in tqdm(range(max_new_tokens), desc="Sampling", dynamic_ncols=True):
-            logits_step = output.logits[:, -1, :]                
-            # CFG combine  → (1, V)
-            cond   = logits_step[0:1, :]
-            uncond = logits_step[1:2, :]
-            cfg = torch.as_tensor(cfg_weight, device=cond.device, dtype=cond.dtype)
-            logits = cond + cfg * (cond - uncond)
-            
-            # Apply alignment stream analyzer integrity checks
+        num_yielded = 0
+        speech_position = torch.zeros(1, dtype=torch.long, device=device)  # BOS
+        try:
+            for i in tqdm(range(max_new_tokens), desc="Sampling", dynamic_ncols=True):
+                # CFG combine  → (1, V)
+                logits = sampler.combine_cfg(logits_step[:2])
+
+                # Apply alignment stream analyzer integrity checks
+                if self.patched_model.alignment_stream_analyzer is not None:
+                    # Pass the last generated token for repetition tracking
+                    logits = self.patched_model.alignment_stream_analyzer.step(logits, next_token=last_token)  # (1, V)
+
+                # Repetition penalty, temperature, min_p and top_p, then sample the next token.
+                next_token = sampler.sample(logits)  # shape: (1, 1)
+                sampler.update(next_token)
+                predicted[:, i] = next_token[:, 0]
+                last_token = next_token
+                num_steps = i + 1
+
+                # Check for EOS token, a few steps at a time so the loop does not wait on the device every token,
+                # and hand out the tokens decoded since the last check. Tokens sampled after EOS are dropped.
+                if num_steps % EOS_CHECK_INTERVAL == 0 or num_steps == max_new_tokens:
+                    new_tokens = predicted[:, num_yielded:num_steps]
+                    num_yielded = num_steps
+                    if self.patched_model.alignment_stream_analyzer is not None:
+                        self.patched_model.alignment_stream_analyzer.report()
+                    if sampler.finished.any():
+                        # earlier checks came out negative, so the EOS is among the new tokens
+                        eos_step = (new_tokens[0] == self.hp.stop_speech_token).nonzero()[0, 0].item()
+                        logger.info(f"✅ EOS token detected! Stopping generation at step {num_steps - len(new_tokens[0]) + eos_step + 1}")
+                        yield new_tokens[:, :eos_step + 1]
+                        break
+                    yield new_tokens
+                    if num_steps == max_new_tokens:
+                        break
+
+                cache_position = cache_position[-1:] + 1
+                speech_position = speech_position + 1
+                if use_compiled_step:
+                    # outputs of the previous replay have been consumed, the graph may overwrite them
+                    torch.compiler.cudagraph_mark_step_begin()
+                    logits_step = self._compiled_decode_step(next_token, speech_position, cache_position, past)
+                    continue
+
+                # Get embedding for the new token.
+                next_token_embed = self.speech_emb(next_token)
+                next_token_embed = next_token_embed + self.speech_pos_emb.get_fixed_embedding(i + 1)
+
+                #  For CFG
+                next_token_embed = torch.cat([next_token_embed, next_token_embed])
+
+                # Forward pass with only the new token and the cached past.
+                output = self.patched_model(
+                    inputs_embeds=next_token_embed,
+                    past_key_values=past,
+                    cache_position=cache_position,
+                    output_attentions=False,
+                    output_hidden_states=False,
+                    return_dict=True,
+                )
+                # Update the kv_cache.
+                past = output.past_key_values
+                logits_step = output.logits[:, -1, :]
+        finally:
             if self.patched_model.alignment_stream_analyzer is not None:
-                if logits.dim() == 1:            # guard in case something upstream squeezed
-                    logits = logits.unsqueeze(0) # (1, V)
-                # Pass the last generated token for repetition tracking
-                last_token = generated_ids[0, -1].item() if len(generated_ids[0]) > 0 else None
-                logits = self.patched_model.alignment_stream_analyzer.step(logits, next_token=last_token)  # (1, V)
-
-            # Apply repetition penalty
-            ids_for_proc = generated_ids[:1, ...]   # batch = 1
-            logits = repetition_penalty_processor(ids_for_proc, logits)  # expects (B,V)
-            
-            # Apply temperature scaling.
-            if temperature != 1.0:
-                logits = logits / temperature
-                
-            # Apply min_p and top_p filtering
-            logits = min_p_warper(ids_for_proc, logits)
-            logits = top_p_warper(ids_for_proc, logits)
-
-            # Convert logits to probabilities and sample the next token.
-            probs = torch.softmax(logits, dim=-1)
-            next_token = torch.multinomial(probs, num_samples=1)  # shape: (B, 1)
-
-            predicted.append(next_token)
-            generated_ids = torch.cat([generated_ids, next_token], dim=1)
-
-            # Check for EOS token.
-            if next_token.view(-1) == self.hp.stop_speech_token:
-                logger.info(f"✅ EOS token detected! Stopping generation at step {i+1}")
-                break
-
-            # Get embedding for the new token.
-            next_token_embed = self.speech_emb(next_token)
-            next_token_embed = next_token_embed + self.speech_pos_emb.get_fixed_embedding(i + 1)
-
-            #  For CFG
-            next_token_embed = torch.cat([next_token_embed, next_token_embed])
-
-            # Forward pass with only the new token and the cached past.
-            output = self.patched_model(
-                inputs_embeds=next_token_embed,
-                past_key_values=past,
-                output_attentions=True,
-                output_hidden_states=True,
+                self.patched_model.alignment_stream_analyzer.remove_hooks()
+            if isinstance(past, StaticCache):
+                self._release_static_cache(past)
+
+    @torch.inference_mode()
+    def _load_cond_prefix(self, past, t3_cond: T3Cond, cond_emb: Tensor, batch_size: int):
+        """
+        Write the transformer KV states of the conditioning prefix (speaker embedding, perceiver-resampled prompt,
+        emotion) into the empty cache `past`, for all `batch_size` rows.
+
+        The prefix only depends on `t3_cond`, so its KV states are computed once per `T3Cond` object and kept in an
+        LRU cache. `T3Cond`s are assumed not to be modified in place once they have been used for inference.
+
+        Returns:
+            the number of positions written, ie the prefix length (0 if prefix caching is disabled).
+        """
+        if self.cond_prefix_cache_size <= 0:
+            return 0
+
+        key = id(t3_cond)
+        entry = self._cond_prefix_kv.get(key)
+        if entry is not None and entry[0]() is t3_cond and entry[1][0][0].device == self.device:
+            self._cond_prefix_kv.move_to_end(key)
+            prefix_kv = entry[1]
+        else:
+            prefix_out = self.tfmr(
+                inputs_embeds=cond_emb,
+                past_key_values=DynamicCache(),
+                use_cache=True,
+                output_attentions=False,
+                output_hidden_states=False,
                 return_dict=True,
             )
-            # Update the kv_cache.
-            past = output.past_key_values
+            cache = prefix_out.past_key_values
+            prefix_kv = list(zip(cache.key_cache, cache.value_cache))
+            self._cond_prefix_kv[key] = (weakref.ref(t3_cond), prefix_kv)
+            while len(self._cond_prefix_kv) > self.cond_prefix_cache_size:
+                self._cond_prefix_kv.popitem(last=False)
+
+        prefix_len = cond_emb.size(1)
+        for layer_idx, (k, v) in enumerate(prefix_kv):
+            k, v = k.expand(batch_size, -1, -1, -1), v.expand(batch_size, -1, -1, -1)
+            if isinstance(past, StaticCache):
+                past.key_cache[layer_idx][:, :, :prefix_len] = k
+                past.value_cache[layer_idx][:, :, :prefix_len] = v
+            else:
+                past.update(k.contiguous(), v.contiguous(), layer_idx)
+        return prefix_len
+
+    def _get_static_cache(self, batch_size, max_cache_len, dtype):
+        """
+        Takes a preallocated KV cache with room for at least `max_cache_len` positions out of the idle ones, or
+        allocates one if there is none, e.g. because a concurrent or interleaved call is using it. Hand it back
+        with `_release_static_cache` once done, so later calls reuse it.
+        Entries left over from a previous call need no clearing: positions past `cache_position` are masked out.
+        """
+        max_cache_len = STATIC_CACHE_LEN_MULTIPLE * -(-max_cache_len // STATIC_CACHE_LEN_MULTIPLE)
+        # `pop` is atomic, so two calls never get the same cache
+        cache = self._static_caches.pop((batch_size, dtype), None)
+        if cache is None or cache.max_cache_len < max_cache_len or cache.key_cache[0].device != self.device:
+            cache = None  # free the old one first
+            cache = StaticCache(
+                config=self.cfg,
+                batch_size=batch_size,
+                max_cache_len=max_cache_len,
+                device=self.device,
+                dtype=dtype,
+            )
+        return cache
+
+    def _release_static_cache(self, cache: StaticCache):
+        "Returns a cache taken with `_get_static_cache` to the idle ones (the larger one, if a concurrent call did too)."
+        key = (cache.batch_size, cache.dtype)
+        idle = self._static_caches.get(key)
+        if idle is None or idle.max_cache_len < cache.max_cache_len:
+            self._static_caches[key] = cache
+
+    def enable_compiled_decode(self, mode=None):
+        """
+        Opt in to running the single-token decode step of `inference` through `torch.compile`. The step is
+        compiled on first use and then reused by every later call, so its Python and kernel-launch overhead is
+        paid once per process rather than once per token.
+
+        Only used with `cache_implementation="static"`, and only when no alignment stream analyzer is attached
+        (the analyzer hooks the attention maps of the eager implementation); other calls decode eagerly.
+
+        Args:
+            mode: `torch.compile` mode. Defaults to "reduce-overhead" on CUDA, which captures the step into a
+                CUDA graph, and to the default inductor mode elsewhere.
+        """
+        if self._compiled_decode_step is None:
+            if mode is None:
+                mode = "reduce-overhead" if self.device.type == "cuda" else "default"
+            self._compiled_decode_step = torch.compile(self._decode_step_static, mode=mode, dynamic=False)
+        return self._compiled_decode_step
+
+    def _decode_step_static(self, next_token: Tensor, speech_position: Tensor, cache_position: Tensor, past: StaticCache):
+        """
+        Single-token forward of a CFG pair into a static KV cache, with fixed-shape tensor inputs only, so it can
+        be compiled once and replayed.
+
+        Args:
+            next_token: (1, 1) token to feed.
+            speech_position: (1,) index of the token in the learned speech position embeddings.
+            cache_position: (1,) index of the token in the KV cache.
+        Returns:
+            (2, V) conditional and unconditional logits.
+        """
+        next_token_embed = self.speech_emb(next_token) + self.speech_pos_emb.get_fixed_embedding(speech_position)
+        next_token_embed = torch.cat([next_token_embed, next_token_embed])  # CFG pair
+        tfmr_out = self.tfmr(
+            inputs_embeds=next_token_embed,
+            past_key_values=past,
+            cache_position=cache_position,
+            use_cache=True,
+            return_dict=True,
+        )
+        return self.speech_head(tfmr_out.last_hidden_state[:, -1])
+
+    def _get_backend(self):
+        if getattr(self, "patched_model", None) is None:
+            self.patched_model = T3HuggingfaceBackend(
+                config=self.cfg,
+                llama=self.tfmr,
+                speech_enc=self.speech_emb,
+                speech_head=self.speech_head,
+            )
+        return self.patched_model
+
+    @torch.inference_mode()
+    def inference_batch(
+        self,
+        *,
+        t3_conds: List[T3Cond],
+        text_tokens: List[Tensor],
+        max_new_tokens=None,
+        temperature=0.8,
+        top_p=0.95,
+        min_p=0.05,
+        repetition_penalty=1.2,
+        cfg_weight=0.5,
+    ):
+        """
+        Batched counterpart of `inference`: decodes several utterances together, one CFG pair per request.
+
+        Each request is prefilled on its own, then all of them are decoded in a single batch of 2N rows sharing a
+        left-padded KV cache. A request leaves the batch as soon as it emits `stop_speech_token`.
+
+        Args:
+            t3_conds: one `T3Cond` per request.
+            text_tokens: one 1D tensor per request, including the start / stop text tokens.
+        Returns:
+            a list of (1, num_tokens) tensors of predicted speech tokens, in request order.
+        """
+        assert len(t3_conds) == len(text_tokens), "need one T3Cond per text"
+
+        batch = DecodeBatch(pad_token_id=self.hp.start_speech_token)
+        requests = []
+        for t3_cond, tokens in zip(t3_conds, text_tokens):
+            request = DecodeRequest(
+                max_new_tokens=max_new_tokens or self.hp.max_speech_tokens,
+                temperature=temperature,
+                top_p=top_p,
+                min_p=min_p,
+                repetition_penalty=repetition_penalty,
+                cfg_weight=cfg_weight,
+            )
+            past, generated_ids = self.prefill(request, t3_cond=t3_cond, text_tokens=tokens)
+            if not request.finished:
+                batch.add(request, past, generated_ids)
+            requests.append(request)
+
+        with tqdm(desc="Sampling", dynamic_ncols=True) as pbar:
+            while len(batch) > 0:
+                self.decode_step(batch)
+                pbar.update()
+
+        return [request.output for request in requests]
+
+    @torch.inference_mode()
+    def prefill(self, request: DecodeRequest, *, t3_cond: T3Cond, text_tokens: Tensor):
+        """
+        Run the initial forward pass of a single request (2 CFG rows) and sample its first token.
 
-        # Concatenate all predicted tokens along the sequence dimension.
-        predicted_tokens = torch.cat(predicted, dim=1)  # shape: (B, num_tokens)
-        return predicted_tokens
+        Returns:
+            the request's KV cache, and its (1, 2) generated ids (BOS and the first sampled token).
+        """
+        text_tokens = torch.atleast_2d(text_tokens)[:1].to(dtype=torch.long, device=self.device)
+        _ensure_BOT_EOT(text_tokens, self.hp)
+        text_tokens = text_tokens.expand(2, -1)  # CFG pair
+
+        initial_speech_tokens = self.hp.start_speech_token * torch.ones_like(text_tokens[:, :1])
+        embeds, len_cond = self.prepare_input_embeds(
+            t3_cond=t3_cond,
+            text_tokens=text_tokens,
+            speech_tokens=initial_speech_tokens,
+            cfg_weight=request.cfg_weight,
+        )
+
+        if self.hp.is_multilingual:
+            request.alignment_stream_analyzer = AlignmentStreamAnalyzer(
+                self.tfmr,
+                None,
+                text_tokens_slice=(len_cond, len_cond + text_tokens.size(-1)),
+                alignment_layer_idx=9,
+                eos_idx=self.hp.stop_speech_token,
+            )
+
+        bos_token = torch.tensor([[self.hp.start_speech_token]], dtype=torch.long, device=self.device)
+        bos_embed = self.speech_emb(bos_token) + self.speech_pos_emb.get_fixed_embedding(0)
+        inputs_embeds = torch.cat([embeds, bos_embed.expand(2, -1, -1)], dim=1)
+
+        past = DynamicCache()
+        prefix_len = self._load_cond_prefix(past, t3_cond, embeds[:1, :len_cond], batch_size=2)
+        if request.alignment_stream_analyzer is not None:
+            request.alignment_stream_analyzer.query_offset = prefix_len
+
+        output = self._get_backend()(
+            inputs_embeds=inputs_embeds[:, prefix_len:],
+            past_key_values=past,
+            cache_position=torch.arange(prefix_len, inputs_embeds.size(1), device=self.device),
+            use_cache=True,
+            output_attentions=False,
+            output_hidden_states=False,
+            return_dict=True,
+        )
+
+        request.sampler = TokenSampler(
+            vocab_size=self.hp.speech_tokens_dict_size,
+            eos_idx=self.hp.stop_speech_token,
+            device=self.device,
+            cfg_weight=request.cfg_weight,
+            temperature=request.temperature,
+            min_p=request.min_p,
+            top_p=request.top_p,
+            repetition_penalty=float(request.repetition_penalty),
+            generator=request.generator,
+        )
+        request.sampler.update(bos_token)
+        request.last_token = self.hp.start_speech_token
+        next_token = self._sample_next_tokens(request.sampler, [request], output.logits[:, -1, :])
+        generated_ids = torch.cat([bos_token, next_token], dim=1)
+        self._advance([request], generated_ids)
+        return output.past_key_values, generated_ids
+
+    @torch.inference_mode()
+    def decode_step(self, batch: DecodeBatch):
+        """
+        Feed the pending token of every request in `batch` through the model, sample the next ones, and drop
+        the requests that have finished.
+
+        Returns:
+            the requests that finished on this step.
+        """
+        requests = batch.requests
+        next_tokens = batch.generated_ids[:, -1:]
+        positions = torch.tensor([r.num_generated for r in requests], device=self.device)[:, None]
+        next_embeds = self.speech_emb(next_tokens) + self.speech_pos_emb.get_fixed_embedding(positions)
+        next_embeds = next_embeds.repeat_interleave(2, dim=0)  # CFG pairs
+
+        batch.attention_mask = F.pad(batch.attention_mask, (0, 1), value=1)
+        output = self._get_backend()(
+            inputs_embeds=next_embeds,
+            past_key_values=batch.past,
+            attention_mask=batch.attention_mask,
+            position_ids=batch.position_ids,
+            output_attentions=False,
+            output_hidden_states=False,
+            return_dict=True,
+        )
+        batch.past = output.past_key_values
+        batch.position_ids = batch.position_ids + 1
+
+        next_token = self._sample_next_tokens(batch.sampler, requests, output.logits[:, -1, :])
+        batch.append_tokens(next_token)
+        finished = self._advance(requests, batch.generated_ids)
+        done = [requests[k] for k in finished]
+        batch.remove(finished)
+        return done
+
+    def _sample_next_tokens(self, sampler: TokenSampler, requests: List[DecodeRequest], logits_step: Tensor):
+        """
+        Sample one token per request from interleaved (2N, V) CFG logits, with one row of `sampler` per request.
+        """
+        logits = sampler.combine_cfg(logits_step)  # (N, V)
+
+        for k, request in enumerate(requests):
+            if request.alignment_stream_analyzer is not None:
+                logits[k:k+1] = request.alignment_stream_analyzer.step(logits[k:k+1], next_token=request.last_token)
+
+        next_token = sampler.sample(logits)  # (N, 1)
+        sampler.update(next_token)
+        return next_token
+
+    def _advance(self, requests: List[DecodeRequest], generated_ids: Tensor):
+        """
+        Book-keeping after a token was appended to `generated_ids` for each request.
+        Returns the indices of the requests that are now finished.
+        """
+        finished = []
+        for k, (request, token) in enumerate(zip(requests, generated_ids[:, -1].tolist())):
+            request.num_generated += 1
+            request.last_token = token
+            if token == self.hp.stop_speech_token or request.num_generated >= request.max_new_tokens:
+                request.output = generated_ids[k:k+1, -request.num_generated:]
+                if request.alignment_stream_analyzer is not None:
+                    request.alignment_stream_analyzer.report()
+                    request.alignment_stream_analyzer.remove_hooks()
+                finished.append(k)
+        return finished
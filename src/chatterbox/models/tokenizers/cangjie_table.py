@@ -0,0 +1,115 @@
+import json
+import logging
+import mmap
+import os
+import struct
+import threading
+from array import array
+from bisect import bisect_left
+from pathlib import Path
+from typing import Optional
+
+
+logger = logging.getLogger(__name__)
+
+
+class CangjieTable:
+    """
+    Read-only glyph -> Cangjie code table, stored as a compact binary file that is built once from
+    `Cangjie5_TC.json` and then memory-mapped, so that processes on the same machine share its pages instead of
+    each parsing the JSON into dicts of their own.
+
+    The codes include the disambiguation index of glyphs that share a code, precomputed at build time. Layout, in
+    native byte order (the file is a local cache, it is not meant to be copied across machines): a header, the
+    sorted code points of the glyphs (uint32), the offsets of their codes (uint32, one more than glyphs) and the
+    concatenated ASCII codes.
+    """
+
+    MAGIC = b"CJ5T"
+    VERSION = 1
+    # magic, version, number of glyphs, size and mtime of the source JSON
+    _HEADER = struct.Struct("=4sIIqq")
+
+    def __init__(self, buf):
+        magic, version, n, self.src_size, self.src_mtime_ns = self._HEADER.unpack_from(buf)
+        if magic != self.MAGIC or version != self.VERSION:
+            raise ValueError("not a Cangjie table, or one from another version")
+        self._buf = buf  # keeps the mmap alive
+        view = memoryview(buf)
+        start = self._HEADER.size
+        self._glyphs = view[start:start + 4 * n].cast("I")
+        start += 4 * n
+        self._offsets = view[start:start + 4 * (n + 1)].cast("I")
+        start += 4 * (n + 1)
+        self._codes = view[start:start + self._offsets[n]]
+
+    def __len__(self):
+        return len(self._glyphs)
+
+    def get(self, glyph: str) -> Optional[str]:
+        "The Cangjie code of `glyph`, with its index among glyphs sharing the code appended if > 0, or None."
+        cp = ord(glyph)
+        i = bisect_left(self._glyphs, cp)
+        if i == len(self._glyphs) or self._glyphs[i] != cp:
+            return None
+        return str(self._codes[self._offsets[i]:self._offsets[i + 1]], "ascii")
+
+    @classmethod
+    def from_json(cls, json_fpath, table_fpath=None) -> "CangjieTable":
+        """
+        Opens the table built from `json_fpath` at `table_fpath` (by default next to it, with a .bin suffix),
+        building it first if it is missing or older than the JSON. If the table can't be written, it is built in
+        memory instead.
+        """
+        json_fpath = Path(json_fpath)
+        table_fpath = json_fpath.with_suffix(".bin") if table_fpath is None else Path(table_fpath)
+        src = os.stat(json_fpath)
+
+        try:
+            with open(table_fpath, "rb") as f:
+                table = cls(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+            if (table.src_size, table.src_mtime_ns) == (src.st_size, src.st_mtime_ns):
+                return table
+        except (OSError, ValueError, struct.error):
+            pass
+
+        data = cls.build(json_fpath, src)
+        try:
+            # write then rename, so that concurrent readers never see a partial file
+            tmp_fpath = table_fpath.with_suffix(f".{os.getpid()}.{threading.get_ident()}.tmp")
+            with open(tmp_fpath, "wb") as f:
+                f.write(data)
+            os.replace(tmp_fpath, table_fpath)
+        except OSError as e:
+            logger.warning(f"Could not save the Cangjie table to {table_fpath}: {e}")
+        return cls(data)
+
+    @classmethod
+    def build(cls, json_fpath, src: os.stat_result = None) -> bytes:
+        "Serializes the mapping in `json_fpath` (a list of 'word\\tcode...' entries) into the table format."
+        with open(json_fpath, "r", encoding="utf-8") as fp:
+            data = json.load(fp)
+
+        word2cj = {}
+        cj2word = {}
+        for entry in data:
+            word, code = entry.split("\t")[:2]
+            word2cj[word] = code
+            cj2word.setdefault(code, []).append(word)
+
+        # only single glyphs are ever looked up
+        codes = {}
+        for word, code in word2cj.items():
+            if len(word) == 1:
+                index = cj2word[code].index(word)
+                codes[ord(word)] = code + (str(index) if index > 0 else "")
+
+        glyphs = array("I", sorted(codes))
+        blob = b"".join(codes[cp].encode("ascii") for cp in glyphs)
+        offsets = array("I", [0])
+        for cp in glyphs:
+            offsets.append(offsets[-1] + len(codes[cp]))
+
+        src = os.stat(json_fpath) if src is None else src
+        header = cls._HEADER.pack(cls.MAGIC, cls.VERSION, len(glyphs), src.st_size, src.st_mtime_ns)
+        return header + glyphs.tobytes() + offsets.tobytes() + blob
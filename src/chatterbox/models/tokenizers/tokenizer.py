@@ -1,5 +1,10 @@
 import logging
-import json
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 
 import torch
 from pathlib import Path
@@ -7,6 +12,8 @@ from unicodedata import category, normalize
 from tokenizers import Tokenizer
 from huggingface_hub import hf_hub_download
 
+from .cangjie_table import CangjieTable
+
 
 # Special tokens
 SOT = "[START]"
@@ -56,10 +63,58 @@ class EnTokenizer:
 # Model repository
 REPO_ID = "ResembleAI/chatterbox"
 
-# Global instances for optional dependencies
+# Normalized sentence fragments kept per language by `MTLTokenizer`
+NORMALIZED_FRAGMENT_CACHE_SIZE = 4096
+# sentence-final punctuation, latin and CJK, with the whitespace after it (CJK marks are not followed by a space)
+_FRAGMENT_END = re.compile(r"((?<=[.!?…])\s+|(?<=[。！？]))")
+
+# Global instances for optional dependencies, each loaded once under its lock: concurrent requests (or
+# `MTLTokenizer.warm_up`) may ask for the same one at the same time
 _kakasi = None
 _dicta = None
 _russian_stresser = None
+_kakasi_lock = threading.Lock()
+_dicta_lock = threading.Lock()
+_russian_stresser_lock = threading.Lock()
+
+
+def _load_kakasi():
+    global _kakasi
+    if _kakasi is None:
+        with _kakasi_lock:
+            if _kakasi is None:
+                import pykakasi
+                _kakasi = pykakasi.kakasi()
+    return _kakasi
+
+
+def _load_dicta():
+    global _dicta
+    if _dicta is None:
+        with _dicta_lock:
+            if _dicta is None:
+                from dicta_onnx import Dicta
+                _dicta = Dicta()
+    return _dicta
+
+
+def _load_russian_stresser():
+    global _russian_stresser
+    if _russian_stresser is None:
+        with _russian_stresser_lock:
+            if _russian_stresser is None:
+                from russian_text_stresser.text_stresser import RussianTextStresser
+                _russian_stresser = RussianTextStresser()
+    return _russian_stresser
+
+
+def _rss_mb():
+    "Resident memory of this process in MB, or None where /proc is not available."
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2**20
+    except (OSError, ValueError, AttributeError):
+        return None
 
 
 def is_kanji(c: str) -> bool:
@@ -74,14 +129,8 @@ def is_katakana(c: str) -> bool:
 
 def hiragana_normalize(text: str) -> str:
     """Japanese text normalization: converts kanji to hiragana; katakana remains the same."""
-    global _kakasi
-    
     try:
-        if _kakasi is None:
-            import pykakasi
-            _kakasi = pykakasi.kakasi()
-        
-        result = _kakasi.convert(text)
+        result = _load_kakasi().convert(text)
         out = []
         
         for r in result:
@@ -116,14 +165,8 @@ def hiragana_normalize(text: str) -> str:
 
 def add_hebrew_diacritics(text: str) -> str:
     """Hebrew text normalization: adds diacritics to Hebrew text."""
-    global _dicta
-    
     try:
-        if _dicta is None:
-            from dicta_onnx import Dicta
-            _dicta = Dicta()
-        
-        return _dicta.add_diacritics(text)
+        return _load_dicta().add_diacritics(text)
         
     except ImportError:
         logger.warning("dicta_onnx not available - Hebrew text processing skipped")
@@ -158,59 +201,57 @@ class ChineseCangjieConverter:
     """Converts Chinese characters to Cangjie codes for tokenization."""
     
     def __init__(self, model_dir=None):
-        self.word2cj = {}
-        self.cj2word = {}
+        self.table = None
         self.segmenter = None
+        self._segmenter_loaded = False  # pkuseg is loaded on first use, or by `load_segmenter`
+        self._segmenter_lock = threading.Lock()
         self._load_cangjie_mapping(model_dir)
-        self._init_segmenter()
     
     def _load_cangjie_mapping(self, model_dir=None):
-        """Load Cangjie mapping from HuggingFace model repository."""        
+        """Load Cangjie mapping from HuggingFace model repository, as a memory-mapped `CangjieTable`."""
         try:
             cangjie_file = hf_hub_download(
                 repo_id=REPO_ID,
                 filename="Cangjie5_TC.json",
                 cache_dir=model_dir
             )
-            
-            with open(cangjie_file, "r", encoding="utf-8") as fp:
-                data = json.load(fp)
-            
-            for entry in data:
-                word, code = entry.split("\t")[:2]
-                self.word2cj[word] = code
-                if code not in self.cj2word:
-                    self.cj2word[code] = [word]
-                else:
-                    self.cj2word[code].append(word)
-                    
+            self.table = CangjieTable.from_json(cangjie_file)
+
         except Exception as e:
             logger.warning(f"Could not load Cangjie mapping: {e}")
     
     def _init_segmenter(self):
         """Initialize pkuseg segmenter."""
         try:
-            from spacy_pkuseg import pkuseg
-            self.segmenter = pkuseg()
+            self.load_segmenter()
         except ImportError:
             logger.warning("pkuseg not available - Chinese segmentation will be skipped")
             self.segmenter = None
+            self._segmenter_loaded = True
+
+    def load_segmenter(self):
+        """Load the pkuseg segmenter if it isn't yet. Raises ImportError if pkuseg is not installed."""
+        if not self._segmenter_loaded:
+            with self._segmenter_lock:
+                if not self._segmenter_loaded:
+                    from spacy_pkuseg import pkuseg
+                    self.segmenter = pkuseg()
+                    self._segmenter_loaded = True
+        return self.segmenter
     
     def _cangjie_encode(self, glyph: str):
         """Encode a single Chinese glyph to Cangjie code."""
-        normed_glyph = glyph
-        code = self.word2cj.get(normed_glyph, None)
-        if code is None:  # e.g. Japanese hiragana
+        if self.table is None:
             return None
-        index = self.cj2word[code].index(normed_glyph)
-        index = str(index) if index > 0 else ""
-        return code + str(index)
+        return self.table.get(glyph)  # None for e.g. Japanese hiragana
     
 
     
     def __call__(self, text):
         """Convert Chinese characters in text to Cangjie tokens."""
         output = []
+        if not self._segmenter_loaded:
+            self._init_segmenter()
         if self.segmenter is not None:
             segmented_words = self.segmenter.cut(text)
             full_text = " ".join(segmented_words)
@@ -236,14 +277,8 @@ class ChineseCangjieConverter:
 
 def add_russian_stress(text: str) -> str:
     """Russian text normalization: adds stress marks to Russian text."""
-    global _russian_stresser
-    
     try:
-        if _russian_stresser is None:
-            from russian_text_stresser.text_stresser import RussianTextStresser
-            _russian_stresser = RussianTextStresser()
-        
-        return _russian_stresser.stress_text(text)
+        return _load_russian_stresser().stress_text(text)
         
     except ImportError:
         logger.warning("russian_text_stresser not available - Russian stress labeling skipped")
@@ -259,6 +294,16 @@ class MTLTokenizer:
         model_dir = Path(vocab_file_path).parent
         self.cangjie_converter = ChineseCangjieConverter(model_dir)
         self.check_vocabset_sot_eot()
+        # the slower language normalizers run once per sentence fragment, their results are kept in an LRU cache
+        self.fragment_normalizers = {
+            'zh': self.cangjie_converter,
+            'ja': hiragana_normalize,
+            'he': add_hebrew_diacritics,
+            'ru': add_russian_stress,
+        }
+        self.fragment_cache_size = NORMALIZED_FRAGMENT_CACHE_SIZE
+        self._fragment_cache = {}  # language id -> OrderedDict of normalized fragments
+        self._fragment_cache_lock = threading.Lock()
 
     def check_vocabset_sot_eot(self):
         voc = self.tokenizer.get_vocab()
@@ -283,26 +328,111 @@ class MTLTokenizer:
         return text_tokens
 
     def encode(self, txt: str, language_id: str = None, lowercase: bool = True, nfkd_normalize: bool = True):
+        txt = self.prepare_text(txt, language_id=language_id, lowercase=lowercase, nfkd_normalize=nfkd_normalize)
+        return self.tokenizer.encode(txt).ids
+
+    def encode_batch(self, txts, language_id=None, lowercase: bool = True, nfkd_normalize: bool = True):
+        """
+        Batched `encode`. `language_id` is either one language for all of `txts` or a list with one per text.
+        """
+        if isinstance(language_id, (list, tuple)):
+            assert len(language_id) == len(txts), "need one language_id per text"
+            language_ids = language_id
+        else:
+            language_ids = [language_id] * len(txts)
+        txts = [
+            self.prepare_text(txt, language_id=lang, lowercase=lowercase, nfkd_normalize=nfkd_normalize)
+            for txt, lang in zip(txts, language_ids)
+        ]
+        return [code.ids for code in self.tokenizer.encode_batch(txts)]
+
+    def prepare_text(self, txt: str, language_id: str = None, lowercase: bool = True, nfkd_normalize: bool = True):
+        """
+        preprocess_text > language-specific normalization > prepend `[language_id]` > replace SPACE
+        """
         txt = self.preprocess_text(txt, language_id=language_id, lowercase=lowercase, nfkd_normalize=nfkd_normalize)
-        
+
         # Language-specific text processing
-        if language_id == 'zh':
-            txt = self.cangjie_converter(txt)
-        elif language_id == 'ja':
-            txt = hiragana_normalize(txt)
-        elif language_id == 'he':
-            txt = add_hebrew_diacritics(txt)
+        if language_id in self.fragment_normalizers:
+            txt = self._normalize_fragments(txt, language_id)
         elif language_id == 'ko':
             txt = korean_normalize(txt)
-        elif language_id == 'ru':
-            txt = add_russian_stress(txt)
-        
+
         # Prepend language token
         if language_id:
             txt = f"[{language_id.lower()}]{txt}"
-        
-        txt = txt.replace(' ', SPACE)
-        return self.tokenizer.encode(txt).ids
+
+        return txt.replace(' ', SPACE)
+
+    def warm_up(self, language_ids, max_workers=None):
+        """
+        Load the models behind the normalizers of `language_ids` (pkuseg for zh, pykakasi for ja, dicta for he and
+        the stresser for ru) on a thread pool, instead of on the first text that needs them, and run each normalizer
+        once. Languages without such a model are skipped.
+
+        Returns {language_id: {"load_s", "rss_mb", "error"}}: the load time, the growth of the process' resident
+        memory during the load (None where it can't be read), and the error message if the model could not be
+        loaded. Loads running at the same time all count in each other's memory; use `max_workers=1` to attribute
+        it exactly.
+        """
+        loaders = {
+            'zh': self.cangjie_converter.load_segmenter,
+            'ja': _load_kakasi,
+            'he': _load_dicta,
+            'ru': _load_russian_stresser,
+        }
+        samples = {'zh': "你好。", 'ja': "日本語。", 'he': "שלום.", 'ru': "привет."}
+        language_ids = [lang for lang in dict.fromkeys(language_ids) if lang in loaders]
+
+        def load(lang):
+            rss = _rss_mb()
+            start = time.perf_counter()
+            error = None
+            try:
+                loaders[lang]()
+                self.fragment_normalizers[lang](samples[lang])
+            except Exception as e:
+                logger.warning(f"Could not load the '{lang}' text normalizer: {e}")
+                error = str(e)
+            load_s = time.perf_counter() - start
+            rss_after = _rss_mb()
+            rss_mb = rss_after - rss if rss is not None and rss_after is not None else None
+            return {"load_s": load_s, "rss_mb": rss_mb, "error": error}
+
+        if not language_ids:
+            return {}
+        with ThreadPoolExecutor(max_workers=max_workers or len(language_ids), thread_name_prefix="warm-up") as pool:
+            return dict(zip(language_ids, pool.map(load, language_ids)))
+
+    def clear_cache(self):
+        "Drop all cached normalized fragments."
+        with self._fragment_cache_lock:
+            self._fragment_cache.clear()
+
+    def _normalize_fragments(self, txt: str, language_id: str):
+        """
+        Applies the normalizer of `language_id` to each sentence of `txt` separately, so that sentences that come
+        up again in other texts are served from the cache. The whitespace between sentences is kept as is.
+        """
+        parts = _FRAGMENT_END.split(txt)
+        # even indices are fragments, odd ones the separators after them
+        parts[::2] = [self._normalize_fragment(fragment, language_id) if fragment else "" for fragment in parts[::2]]
+        return "".join(parts)
+
+    def _normalize_fragment(self, fragment: str, language_id: str):
+        with self._fragment_cache_lock:
+            cache = self._fragment_cache.setdefault(language_id, OrderedDict())
+            normalized = cache.get(fragment)
+            if normalized is not None:
+                cache.move_to_end(fragment)
+                return normalized
+
+        normalized = self.fragment_normalizers[language_id](fragment)
+        with self._fragment_cache_lock:
+            cache[fragment] = normalized
+            while len(cache) > self.fragment_cache_size:
+                cache.popitem(last=False)
+        return normalized
 
     def decode(self, seq):
         if isinstance(seq, torch.Tensor):
@@ -0,0 +1,292 @@
+import asyncio
+import inspect
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+from dataclasses import dataclass, field
+from typing import Any, List, Optional
+
+import torch
+
+from .mtl_tts import _check_language_id
+
+
+logger = logging.getLogger(__name__)
+
+# arguments of `model.generate` that go to the S3Gen stage, the other ones (but the conditionals') are for T3
+_RENDER_ARGS = ("n_cfm_timesteps", "cfm_solver")
+
+
+@dataclass
+class _Job:
+    text_args: tuple
+    audio_prompt_path: Optional[str]
+    exaggeration: float
+    sampling: dict
+    render: dict
+    future: asyncio.Future
+    payload: Any = None  # output of the last stage the job went through
+
+
+@dataclass
+class _Stage:
+    name: str
+    fn: Any  # (jobs) -> a payload for the next stage per job, run on a worker thread
+    num_workers: int
+    queue_size: int
+    device: str
+    max_batch_size: int = 1  # jobs taken from the queue at once, if already waiting
+    queue: asyncio.Queue = None
+    executor: ThreadPoolExecutor = None
+    processed: int = 0
+    errors: int = 0
+    busy_s: float = 0.0
+    max_queue_depth: int = 0
+    _local: threading.local = field(default_factory=threading.local)
+
+    def open(self):
+        self.queue = asyncio.Queue(maxsize=self.queue_size)
+        self.executor = ThreadPoolExecutor(max_workers=self.num_workers, thread_name_prefix=f"tts-{self.name}")
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=True, cancel_futures=True)
+            self.executor = None
+
+    def call(self, jobs: List[_Job]):
+        "Runs on a worker thread. On CUDA, each worker thread queues its kernels on its own stream."
+        stream = self._stream()
+        with torch.cuda.stream(stream) if stream is not None else nullcontext():
+            payloads = self.fn(jobs)
+            if stream is not None:
+                # only hand the results over once they're computed, the next stage reads them from another stream
+                stream.synchronize()
+        return payloads
+
+    def _stream(self):
+        if not str(self.device).startswith("cuda"):
+            return None
+        if not hasattr(self._local, "stream"):
+            self._local.stream = torch.cuda.Stream(device=self.device)
+        return self._local.stream
+
+
+class TTSPipeline:
+    """
+    Asyncio front end that runs `generate` requests through a three-stage pipeline instead of one at a time:
+
+        T3 (conditionals + speech tokens) -> S3Gen (tokens to wav, copied to host) -> watermark
+
+    Each stage has its own worker threads (and CUDA stream), with bounded queues in between, so one request's T3
+    decoding overlaps another's vocoding and watermarking. A full queue holds back the stage feeding it, which in
+    turn holds back `generate`, so memory stays bounded under load.
+
+    T3 runs a single request at a time unless the model has `enable_batching` on, in which case it gets as many
+    workers as the scheduler has slots. S3Gen renders the requests waiting in its queue together, as one batch of
+    up to `s3gen_batch_size`.
+
+    Usage:
+        async with TTSPipeline(model) as pipeline:
+            wavs = await asyncio.gather(*(pipeline.generate(text) for text in texts))
+            print(pipeline.metrics())
+    """
+
+    def __init__(self, model, queue_size=4, t3_workers=None, s3gen_batch_size=4):
+        """
+        Args:
+            model: a `ChatterboxTTS` or `ChatterboxMultilingualTTS`.
+            queue_size: capacity of the queue in front of each stage.
+            t3_workers: number of requests decoded by T3 at once. Defaults to the batching scheduler's
+                `max_batch_size` if `model.enable_batching` was called, 1 otherwise. Without the scheduler, T3 can't
+                decode several requests at once.
+            s3gen_batch_size: maximum number of requests rendered by S3Gen at once. Only requests with the same
+                `n_cfm_timesteps` and `cfm_solver` are batched together.
+        """
+        self.model = model
+        if t3_workers is None:
+            t3_workers = model.t3_scheduler.max_batch_size if model.t3_scheduler is not None else 1
+        assert t3_workers == 1 or model.t3_scheduler is not None, "concurrent T3 workers need `enable_batching`"
+        # defaults are the ones of `model.generate`
+        self._defaults = {
+            name: param.default
+            for name, param in inspect.signature(model.generate).parameters.items()
+            if param.default is not param.empty and name not in ("audio_prompt_path", "exaggeration")
+        }
+        self.stages = [
+            _Stage("t3", self._run_t3, t3_workers, queue_size, model.device),
+            _Stage("s3gen", self._run_s3gen, 1, queue_size, model.device, max_batch_size=s3gen_batch_size),
+            _Stage("watermark", self._run_watermark, 1, queue_size, model.device),
+        ]
+        self._tasks = []
+        self._reset_counters()
+
+    def _reset_counters(self):
+        self._submitted = 0
+        self._completed = 0
+        self._failed = 0
+        self._audio_s = 0.0
+        self._started_at = None
+        for stage in self.stages:
+            stage.processed = stage.errors = stage.max_queue_depth = 0
+            stage.busy_s = 0.0
+
+    async def __aenter__(self):
+        await self.start()
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    async def start(self):
+        if self._tasks:
+            return self
+        for stage in self.stages:
+            stage.open()
+        for k, stage in enumerate(self.stages):
+            next_stage = self.stages[k + 1] if k + 1 < len(self.stages) else None
+            self._tasks.extend(
+                asyncio.create_task(self._work(stage, next_stage), name=f"tts-{stage.name}-{i}")
+                for i in range(stage.num_workers)
+            )
+        return self
+
+    async def close(self):
+        "Stop the workers. Requests still in the pipeline are cancelled."
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        for stage in self.stages:
+            if stage.queue is None:
+                continue
+            while not stage.queue.empty():
+                job = stage.queue.get_nowait()
+                job.future.cancel()
+            # waits for the jobs that are running on the worker threads
+            await asyncio.get_running_loop().run_in_executor(None, stage.close)
+
+    async def generate(self, *text_args, audio_prompt_path=None, exaggeration=0.5, **kwargs):
+        """
+        Pipelined counterpart of `model.generate`, with the same arguments: `text`, plus `language_id` for the
+        multilingual model. Returns a (1, num_samples) tensor of watermarked audio.
+        """
+        if len(text_args) > 1:
+            _check_language_id(text_args[1])
+        unknown = set(kwargs) - set(self._defaults)
+        if unknown:
+            raise TypeError(f"unexpected arguments: {', '.join(sorted(unknown))}")
+        kwargs = {**self._defaults, **kwargs}
+        await self.start()
+
+        loop = asyncio.get_running_loop()
+        job = _Job(
+            text_args=text_args,
+            audio_prompt_path=audio_prompt_path,
+            exaggeration=exaggeration,
+            sampling={k: v for k, v in kwargs.items() if k not in _RENDER_ARGS},
+            render={k: v for k, v in kwargs.items() if k in _RENDER_ARGS},
+            future=loop.create_future(),
+        )
+        if self._started_at is None:
+            self._started_at = time.perf_counter()
+        self._submitted += 1
+        await self._put(self.stages[0], job)
+        return await job.future
+
+    def metrics(self) -> dict:
+        """
+        Snapshot of the pipeline counters since it started (or since `reset_metrics`):
+        throughput in requests and audio seconds per wall-clock second, and for each stage the number of jobs
+        processed, the current and peak depth of its input queue, and the fraction of time its workers were busy.
+        """
+        elapsed = time.perf_counter() - self._started_at if self._started_at is not None else 0.0
+        return {
+            "elapsed_s": elapsed,
+            "submitted": self._submitted,
+            "completed": self._completed,
+            "failed": self._failed,
+            "in_flight": self._submitted - self._completed - self._failed,
+            "requests_per_s": self._completed / elapsed if elapsed > 0 else 0.0,
+            "audio_s": self._audio_s,
+            "audio_s_per_s": self._audio_s / elapsed if elapsed > 0 else 0.0,
+            "stages": {
+                stage.name: {
+                    "processed": stage.processed,
+                    "errors": stage.errors,
+                    "queue_depth": stage.queue.qsize() if stage.queue is not None else 0,
+                    "max_queue_depth": stage.max_queue_depth,
+                    "busy_s": stage.busy_s,
+                    "utilization": stage.busy_s / (elapsed * stage.num_workers) if elapsed > 0 else 0.0,
+                }
+                for stage in self.stages
+            },
+        }
+
+    def reset_metrics(self):
+        self._reset_counters()
+
+    async def _put(self, stage: _Stage, job: _Job):
+        await stage.queue.put(job)
+        stage.max_queue_depth = max(stage.max_queue_depth, stage.queue.qsize())
+
+    async def _work(self, stage: _Stage, next_stage: Optional[_Stage]):
+        loop = asyncio.get_running_loop()
+        while True:
+            jobs = [await stage.queue.get()]
+            while len(jobs) < stage.max_batch_size and not stage.queue.empty():
+                jobs.append(stage.queue.get_nowait())
+            jobs = [job for job in jobs if not job.future.done()]  # skip the ones cancelled by the caller
+            if not jobs:
+                continue
+            start = time.perf_counter()
+            try:
+                payloads = await loop.run_in_executor(stage.executor, stage.call, jobs)
+            except Exception as e:
+                stage.errors += len(jobs)
+                self._failed += len(jobs)
+                logger.exception(f"{stage.name} stage failed")
+                for job in jobs:
+                    if not job.future.done():
+                        job.future.set_exception(e)
+                continue
+            finally:
+                stage.busy_s += time.perf_counter() - start
+            stage.processed += len(jobs)
+
+            for job, payload in zip(jobs, payloads):
+                job.payload = payload
+                if next_stage is not None:
+                    await self._put(next_stage, job)
+                elif not job.future.done():
+                    self._completed += 1
+                    self._audio_s += len(payload) / self.model.sr
+                    job.future.set_result(torch.from_numpy(payload).unsqueeze(0))
+
+    def _run_t3(self, jobs: List[_Job]):
+        payloads = []
+        for job in jobs:
+            t3_cond, ref_dict = self.model._get_conditionals(job.audio_prompt_path, job.exaggeration)
+            speech_tokens = self.model._generate_speech_tokens(*job.text_args, t3_cond, **job.sampling)
+            payloads.append((speech_tokens, ref_dict))
+        return payloads
+
+    def _run_s3gen(self, jobs: List[_Job]):
+        # batch the jobs that render with the same settings
+        groups = {}
+        for k, job in enumerate(jobs):
+            groups.setdefault(tuple(sorted(job.render.items())), []).append(k)
+        wavs = [None] * len(jobs)
+        for render, ks in groups.items():
+            if len(ks) == 1:
+                speech_tokens, ref_dict = jobs[ks[0]].payload
+                wavs[ks[0]] = self.model._render_wav(speech_tokens, ref_dict, **dict(render))
+            else:
+                speech_tokens, ref_dicts = zip(*(jobs[k].payload for k in ks))
+                for k, wav in zip(ks, self.model._render_wavs(list(speech_tokens), list(ref_dicts), **dict(render))):
+                    wavs[k] = wav
+        return wavs
+
+    def _run_watermark(self, jobs: List[_Job]):
+        return [self.model._watermark(job.payload) for job in jobs]
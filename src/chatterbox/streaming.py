@@ -0,0 +1,101 @@
+import re
+from typing import Iterable, Iterator, List
+
+import numpy as np
+
+
+# sentence-final punctuation, latin and CJK; CJK marks are not followed by a space
+_SENTENCE_END = re.compile(r"(?<=[.!?…])\s+|(?<=[。！？])")
+# clause boundaries, used to break sentences that are too long on their own
+_CLAUSE_END = re.compile(r"(?<=[,;:，、；：])\s*")
+
+
+def split_text_into_chunks(text: str, max_chars=250, min_chars=30) -> List[str]:
+    """
+    Split `text` into sentence-sized chunks for streaming synthesis.
+
+    Sentences longer than `max_chars` are broken at clause punctuation, and failing that at spaces. A chunk shorter
+    than `min_chars` absorbs the next one, so T3 does not get fragments too short to phrase naturally.
+    """
+    pieces = []
+    for sentence in _SENTENCE_END.split(text.strip()):
+        sentence = sentence.strip()
+        if not sentence:
+            continue
+        if len(sentence) <= max_chars:
+            pieces.append(sentence)
+            continue
+        # pack clauses (or, for clauses that are too long themselves, words) into pieces of up to `max_chars`
+        parts = []
+        for clause in _CLAUSE_END.split(sentence):
+            clause = clause.strip()
+            parts.extend(clause.split(" ") if len(clause) > max_chars else [clause])
+        pieces.extend(_pack(parts, max_chars))
+
+    chunks = []
+    for piece in pieces:
+        if chunks and len(chunks[-1]) < min_chars and len(chunks[-1]) + len(piece) + 1 <= max_chars:
+            sep = "" if chunks[-1][-1] in "。！？" else " "
+            chunks[-1] = f"{chunks[-1]}{sep}{piece}"
+        else:
+            chunks.append(piece)
+    # don't leave a fragment on its own at the end either
+    if len(chunks) > 1 and len(chunks[-1]) < min_chars and len(chunks[-2]) + len(chunks[-1]) + 1 <= max_chars:
+        last = chunks.pop()
+        sep = "" if chunks[-1][-1] in "。！？" else " "
+        chunks[-1] = f"{chunks[-1]}{sep}{last}"
+    return chunks
+
+
+def _pack(parts: List[str], max_chars: int) -> List[str]:
+    packed = []
+    for part in parts:
+        if not part:
+            continue
+        if packed and len(packed[-1]) + len(part) + 1 <= max_chars:
+            packed[-1] = f"{packed[-1]} {part}"
+        else:
+            packed.append(part)
+    return packed
+
+
+def crossfade_chunks(chunks: Iterable[np.ndarray], overlap: int) -> Iterator[np.ndarray]:
+    """
+    Join consecutive 1D audio chunks with a linear crossfade over `overlap` samples, yielding each chunk as soon as
+    it is available. The last `overlap` samples of a chunk are held back until the next chunk arrives (or the stream
+    ends), so the concatenation of the yielded arrays is the crossfaded signal.
+    """
+    return crossfade_segments(([chunk] for chunk in chunks), overlap)
+
+
+def crossfade_segments(segments: Iterable[Iterable[np.ndarray]], overlap: int) -> Iterator[np.ndarray]:
+    """
+    Like `crossfade_chunks`, for segments that arrive in several pieces themselves (eg a sentence rendered
+    incrementally): pieces of the same segment are passed through as they are, and only consecutive segments are
+    crossfaded.
+    """
+    tail = None  # held back end of the previous segment, still to be crossfaded into the next one
+    for segment in segments:
+        pending = np.zeros(0, dtype=np.float32)  # held back end of this segment so far
+        for piece in segment:
+            pending = np.concatenate([pending, np.asarray(piece, dtype=np.float32)])
+            if tail is not None:
+                if len(pending) < len(tail):
+                    continue  # wait for enough audio to cover the crossfade
+                pending, tail = _crossfade(tail, pending), None
+            n = min(overlap, len(pending))
+            out, pending = pending[:len(pending) - n], pending[len(pending) - n:]
+            if len(out) > 0:
+                yield out
+        # a segment shorter than the crossfade gets crossfaded over its full length
+        tail = pending if tail is None else _crossfade(tail, pending)
+    if tail is not None and len(tail) > 0:
+        yield tail
+
+
+def _crossfade(a: np.ndarray, b: np.ndarray) -> np.ndarray:
+    "Concatenate `a` and `b`, overlapping the end of `a` with the start of `b` as far as the shorter one goes."
+    n = min(len(a), len(b))
+    fade_in = np.linspace(0.0, 1.0, n + 2, dtype=np.float32)[1:-1]
+    mixed = a[len(a) - n:] * (1.0 - fade_in) + b[:n] * fade_in
+    return np.concatenate([a[:len(a) - n], mixed, b[n:]])
@@ -1,5 +1,7 @@
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
 from pathlib import Path
+import threading
 
 import librosa
 import torch
@@ -9,11 +11,14 @@ from huggingface_hub import hf_hub_download
 from safetensors.torch import load_file
 
 from .models.t3 import T3
+from .models.t3.inference.scheduler import T3Scheduler
 from .models.s3tokenizer import S3_SR, drop_invalid_tokens
 from .models.s3gen import S3GEN_SR, S3Gen
 from .models.tokenizers import EnTokenizer
 from .models.voice_encoder import VoiceEncoder
 from .models.t3.modules.cond_enc import T3Cond
+from .conds_cache import ConditionalsCache
+from .streaming import split_text_into_chunks, crossfade_chunks, crossfade_segments
 
 
 REPO_ID = "ResembleAI/chatterbox"
@@ -124,9 +129,16 @@ class ChatterboxTTS:
         self.device = device
         self.conds = conds
         self.watermarker = perth.PerthImplicitWatermarker()
+        self.t3_scheduler = None
+        self.conds_cache = None
+        self._conds_lock = threading.Lock()
 
     @classmethod
-    def from_local(cls, ckpt_dir, device) -> 'ChatterboxTTS':
+    def from_local(cls, ckpt_dir, device, dtype=torch.float32) -> 'ChatterboxTTS':
+        """
+        `dtype` is the precision T3 and S3Gen run in; `torch.bfloat16` or `torch.float16` roughly halve their memory
+        and speed up inference on GPU. See `S3Token2Wav.set_dtype` for what stays fp32.
+        """
         ckpt_dir = Path(ckpt_dir)
 
         # Always load to CPU first for non-CUDA devices to handle CUDA-saved models
@@ -146,12 +158,14 @@ class ChatterboxTTS:
         if "model" in t3_state.keys():
             t3_state = t3_state["model"][0]
         t3.load_state_dict(t3_state)
-        t3.to(device).eval()
+        t3.to(device=device, dtype=dtype).eval()
 
         s3gen = S3Gen()
         s3gen.load_state_dict(
             load_file(ckpt_dir / "s3gen.safetensors"), strict=False
         )
+        s3gen.optimize_for_inference()
+        s3gen.set_dtype(dtype)
         s3gen.to(device).eval()
 
         tokenizer = EnTokenizer(
@@ -165,7 +179,7 @@ class ChatterboxTTS:
         return cls(t3, s3gen, ve, tokenizer, device, conds=conds)
 
     @classmethod
-    def from_pretrained(cls, device) -> 'ChatterboxTTS':
+    def from_pretrained(cls, device, dtype=torch.float32) -> 'ChatterboxTTS':
         # Check if MPS is available on macOS
         if device == "mps" and not torch.backends.mps.is_available():
             if not torch.backends.mps.is_built():
@@ -177,9 +191,50 @@ class ChatterboxTTS:
         for fpath in ["ve.safetensors", "t3_cfg.safetensors", "s3gen.safetensors", "tokenizer.json", "conds.pt"]:
             local_path = hf_hub_download(repo_id=REPO_ID, filename=fpath)
 
-        return cls.from_local(Path(local_path).parent, device)
+        return cls.from_local(Path(local_path).parent, device, dtype=dtype)
+
+    def enable_batching(self, max_batch_size=8):
+        """
+        Route T3 decoding of concurrent `generate` calls (from several threads) through a shared
+        continuous-batching scheduler, so that they run as one batch instead of one after the other.
+        """
+        if self.t3_scheduler is None:
+            self.t3_scheduler = T3Scheduler(self.t3, max_batch_size=max_batch_size).start()
+        return self.t3_scheduler
+
+    def enable_compiled_decode(self, mode=None):
+        """
+        Compile T3's single-token decode step with `torch.compile` (a CUDA graph on GPU). The first `generate`
+        call afterwards pays the compilation; later calls reuse it. See `T3.enable_compiled_decode`.
+        """
+        self.t3.enable_compiled_decode(mode=mode)
+
+    def enable_length_buckets(self, compile=True, mode=None):
+        """
+        Pad S3Gen's decoder and vocoder inputs to a few fixed lengths and compile them once per length, instead of
+        recompiling for every new output length. The first request of each length bucket pays the compilation. See
+        `S3Token2Wav.enable_length_buckets`.
+        """
+        self.s3gen.enable_length_buckets(compile=compile, mode=mode)
+
+    def enable_conditionals_cache(self, max_entries=64, cache_dir=None):
+        """
+        Cache the conditionals prepared from reference clips, in memory and optionally as files in `cache_dir`, so
+        that requests reusing a voice skip the reference embedding. See `ConditionalsCache`.
+        """
+        if self.conds_cache is None:
+            self.conds_cache = ConditionalsCache(Conditionals, self.device, max_entries=max_entries, cache_dir=cache_dir)
+        return self.conds_cache
 
     def prepare_conditionals(self, wav_fpath, exaggeration=0.5):
+        if self.conds_cache is not None:
+            key = self.conds_cache.key(
+                wav_fpath, type(self).__name__, self.ENC_COND_LEN, self.DEC_COND_LEN, self.t3.hp.speech_cond_prompt_len
+            )
+            if (conds := self.conds_cache.get(key)) is not None:
+                self.conds = Conditionals(self._with_exaggeration(conds.t3, exaggeration), conds.gen)
+                return
+
         ## Load reference wav
         s3gen_ref_wav, _sr = librosa.load(wav_fpath, sr=S3GEN_SR)
 
@@ -204,6 +259,9 @@ class ChatterboxTTS:
             emotion_adv=exaggeration * torch.ones(1, 1, 1),
         ).to(device=self.device)
         self.conds = Conditionals(t3_cond, s3gen_ref_dict)
+        if self.conds_cache is not None:
+            # a separate instance, `self.conds` gets updated in place
+            self.conds_cache.put(key, Conditionals(t3_cond, s3gen_ref_dict))
 
     def generate(
         self,
@@ -215,21 +273,139 @@ class ChatterboxTTS:
         exaggeration=0.5,
         cfg_weight=0.5,
         temperature=0.8,
+        n_cfm_timesteps=10,
+        cfm_solver=None,
+        seed=None,
     ):
-        if audio_prompt_path:
-            self.prepare_conditionals(audio_prompt_path, exaggeration=exaggeration)
-        else:
-            assert self.conds is not None, "Please `prepare_conditionals` first or specify `audio_prompt_path`"
+        """
+        `seed` makes the output reproducible: T3 samples from, and S3Gen draws its noise from, RNGs of this call
+        seeded with it, rather than from the global RNG, which concurrent calls share.
+        """
+        t3_cond, ref_dict = self._get_conditionals(audio_prompt_path, exaggeration)
+        generator = None if seed is None else torch.Generator(device=self.device).manual_seed(seed)
+        speech_tokens = self._generate_speech_tokens(
+            text,
+            t3_cond,
+            repetition_penalty=repetition_penalty,
+            min_p=min_p,
+            top_p=top_p,
+            cfg_weight=cfg_weight,
+            temperature=temperature,
+            generator=generator,
+        )
+        watermarked_wav = self._speech_tokens_to_wav(
+            speech_tokens, ref_dict, n_cfm_timesteps=n_cfm_timesteps, cfm_solver=cfm_solver, noise_seed=seed
+        )
+        return torch.from_numpy(watermarked_wav).unsqueeze(0)
 
-        # Update exaggeration if needed
-        if exaggeration != self.conds.t3.emotion_adv[0, 0, 0]:
-            _cond: T3Cond = self.conds.t3
-            self.conds.t3 = T3Cond(
-                speaker_emb=_cond.speaker_emb,
-                cond_prompt_speech_tokens=_cond.cond_prompt_speech_tokens,
-                emotion_adv=exaggeration * torch.ones(1, 1, 1),
-            ).to(device=self.device)
+    def generate_stream(
+        self,
+        text,
+        repetition_penalty=1.2,
+        min_p=0.05,
+        top_p=1.0,
+        audio_prompt_path=None,
+        exaggeration=0.5,
+        cfg_weight=0.5,
+        temperature=0.8,
+        n_cfm_timesteps=10,
+        cfm_solver=None,
+        max_chunk_chars=250,
+        crossfade_ms=20,
+        token_hop_len=None,
+    ):
+        """
+        Streaming counterpart of `generate`: splits `text` into sentence / clause chunks and yields watermarked
+        audio for each chunk as soon as it is ready, as (1, num_samples) tensors whose concatenation is the full
+        utterance. T3 keeps generating the speech tokens of the next chunks while S3Gen renders the current one,
+        and consecutive chunks are joined with a `crossfade_ms` crossfade.
+
+        With `token_hop_len` set, each chunk is also rendered incrementally: S3Gen turns every `token_hop_len`
+        speech tokens into audio while T3 is still decoding the rest (see `S3Token2Wav.inference_stream`), which
+        brings the first audio out well before the first sentence is complete. Not available with `enable_batching`.
+        """
+        t3_cond, ref_dict = self._get_conditionals(audio_prompt_path, exaggeration)
+        chunks = split_text_into_chunks(text, max_chars=max_chunk_chars) or [text]
+
+        overlap = int(self.sr * crossfade_ms / 1000)
+        if token_hop_len is not None:
+            if self.t3_scheduler is not None:
+                raise ValueError("token-level streaming (token_hop_len) does not support `enable_batching`")
+            segments = (
+                self._stream_wav(
+                    chunk,
+                    t3_cond,
+                    ref_dict,
+                    token_hop_len=token_hop_len,
+                    n_cfm_timesteps=n_cfm_timesteps,
+                    cfm_solver=cfm_solver,
+                    repetition_penalty=repetition_penalty,
+                    min_p=min_p,
+                    top_p=top_p,
+                    cfg_weight=cfg_weight,
+                    temperature=temperature,
+                )
+                for chunk in chunks
+            )
+            for wav in crossfade_segments(segments, overlap):
+                yield torch.from_numpy(wav).unsqueeze(0)
+            return
+
+        # T3 runs ahead on worker threads: one at a time, or all chunks at once when they can share the
+        # batching scheduler
+        num_workers = len(chunks) if self.t3_scheduler is not None else 1
+        executor = ThreadPoolExecutor(max_workers=num_workers, thread_name_prefix="t3-stream")
+        try:
+            speech_tokens = [
+                executor.submit(
+                    self._generate_speech_tokens,
+                    chunk,
+                    t3_cond,
+                    repetition_penalty=repetition_penalty,
+                    min_p=min_p,
+                    top_p=top_p,
+                    cfg_weight=cfg_weight,
+                    temperature=temperature,
+                )
+                for chunk in chunks
+            ]
+            wavs = (
+                self._speech_tokens_to_wav(
+                    future.result(), ref_dict, n_cfm_timesteps=n_cfm_timesteps, cfm_solver=cfm_solver
+                )
+                for future in speech_tokens
+            )
+            for wav in crossfade_chunks(wavs, overlap):
+                yield torch.from_numpy(wav).unsqueeze(0)
+        finally:
+            executor.shutdown(wait=True, cancel_futures=True)
+
+    def _get_conditionals(self, audio_prompt_path, exaggeration):
+        "Returns the `T3Cond` and S3Gen reference dict to synthesize with, preparing them first if needed."
+        with self._conds_lock:
+            if audio_prompt_path:
+                self.prepare_conditionals(audio_prompt_path, exaggeration=exaggeration)
+            else:
+                assert self.conds is not None, "Please `prepare_conditionals` first or specify `audio_prompt_path`"
+
+            # Update exaggeration if needed
+            self.conds.t3 = self._with_exaggeration(self.conds.t3, exaggeration)
+
+            # keep our own references, concurrent calls may swap `self.conds` from here on
+            return self.conds.t3, self.conds.gen
+
+    def _with_exaggeration(self, t3_cond: T3Cond, exaggeration):
+        "Returns `t3_cond`, or a copy of it with its emotion set to `exaggeration` if it differs."
+        # compare in fp32, the precision conditionals are kept in
+        if torch.tensor(float(exaggeration)).item() == t3_cond.emotion_adv[0, 0, 0].float().item():
+            return t3_cond
+        return T3Cond(
+            speaker_emb=t3_cond.speaker_emb,
+            cond_prompt_speech_tokens=t3_cond.cond_prompt_speech_tokens,
+            emotion_adv=exaggeration * torch.ones(1, 1, 1),
+        ).to(device=self.device)
 
+    def _prepare_text_tokens(self, text, cfg_weight):
         # Norm and tokenize text
         text = punc_norm(text)
         text_tokens = self.tokenizer.text_to_tokens(text).to(self.device)
@@ -241,10 +417,30 @@ class ChatterboxTTS:
         eot = self.t3.hp.stop_text_token
         text_tokens = F.pad(text_tokens, (1, 0), value=sot)
         text_tokens = F.pad(text_tokens, (0, 1), value=eot)
+        return text_tokens
+
+    @torch.inference_mode()
+    def _generate_speech_tokens(
+        self, text, t3_cond, *, repetition_penalty, min_p, top_p, cfg_weight, temperature, generator=None
+    ):
+        "Run T3 on `text`. Returns a 1D tensor of valid speech tokens."
+        text_tokens = self._prepare_text_tokens(text, cfg_weight)
 
-        with torch.inference_mode():
+        if self.t3_scheduler is not None:
+            speech_tokens = self.t3_scheduler.submit(
+                t3_cond=t3_cond,
+                text_tokens=text_tokens[0],
+                max_new_tokens=1000,  # TODO: use the value in config
+                temperature=temperature,
+                cfg_weight=cfg_weight,
+                repetition_penalty=repetition_penalty,
+                min_p=min_p,
+                top_p=top_p,
+                generator=generator,
+            ).result()
+        else:
             speech_tokens = self.t3.inference(
-                t3_cond=self.conds.t3,
+                t3_cond=t3_cond,
                 text_tokens=text_tokens,
                 max_new_tokens=1000,  # TODO: use the value in config
                 temperature=temperature,
@@ -252,21 +448,71 @@ class ChatterboxTTS:
                 repetition_penalty=repetition_penalty,
                 min_p=min_p,
                 top_p=top_p,
+                generator=generator,
             )
-            # Extract only the conditional batch.
-            speech_tokens = speech_tokens[0]
-
-            # TODO: output becomes 1D
-            speech_tokens = drop_invalid_tokens(speech_tokens)
-            
-            speech_tokens = speech_tokens[speech_tokens < 6561]
-
-            speech_tokens = speech_tokens.to(self.device)
-
-            wav, _ = self.s3gen.inference(
-                speech_tokens=speech_tokens,
-                ref_dict=self.conds.gen,
-            )
+        # Extract only the conditional batch.
+        speech_tokens = speech_tokens[0]
+
+        # TODO: output becomes 1D
+        speech_tokens = drop_invalid_tokens(speech_tokens)
+
+        speech_tokens = speech_tokens[speech_tokens < 6561]
+
+        return speech_tokens.to(self.device)
+
+    @torch.inference_mode()
+    def _stream_wav(self, text, t3_cond, ref_dict, *, token_hop_len, n_cfm_timesteps, cfm_solver, repetition_penalty, min_p, top_p, cfg_weight, temperature):
+        "Run T3 and S3Gen incrementally on `text`, yielding watermarked 1D numpy audio chunks."
+        text_tokens = self._prepare_text_tokens(text, cfg_weight)
+        speech_tokens = self.t3.inference_stream(
+            t3_cond=t3_cond,
+            text_tokens=text_tokens,
+            max_new_tokens=1000,  # TODO: use the value in config
+            temperature=temperature,
+            cfg_weight=cfg_weight,
+            repetition_penalty=repetition_penalty,
+            min_p=min_p,
+            top_p=top_p,
+        )
+        wavs = self.s3gen.inference_stream(
+            speech_tokens,
+            ref_dict=ref_dict,
+            token_hop_len=token_hop_len,
+            n_cfm_timesteps=n_cfm_timesteps,
+            cfm_solver=cfm_solver,
+        )
+        for wav in wavs:
             wav = wav.squeeze(0).detach().cpu().numpy()
-            watermarked_wav = self.watermarker.apply_watermark(wav, sample_rate=self.sr)
-        return torch.from_numpy(watermarked_wav).unsqueeze(0)
\ No newline at end of file
+            yield self.watermarker.apply_watermark(wav, sample_rate=self.sr)
+
+    def _speech_tokens_to_wav(self, speech_tokens, ref_dict, *, n_cfm_timesteps=10, cfm_solver=None, noise_seed=None):
+        "Render speech tokens with S3Gen and watermark the result. Returns a 1D numpy array."
+        return self._watermark(self._render_wav(
+            speech_tokens, ref_dict, n_cfm_timesteps=n_cfm_timesteps, cfm_solver=cfm_solver, noise_seed=noise_seed
+        ))
+
+    @torch.inference_mode()
+    def _render_wav(self, speech_tokens, ref_dict, *, n_cfm_timesteps=10, cfm_solver=None, noise_seed=None):
+        "Render speech tokens with S3Gen. Returns a 1D numpy array, without watermark."
+        wav, _ = self.s3gen.inference(
+            speech_tokens=speech_tokens,
+            ref_dict=ref_dict,
+            n_cfm_timesteps=n_cfm_timesteps,
+            cfm_solver=cfm_solver,
+            noise_seed=noise_seed,
+        )
+        return wav.squeeze(0).detach().cpu().numpy()
+
+    @torch.inference_mode()
+    def _render_wavs(self, speech_tokens, ref_dicts, *, n_cfm_timesteps=10, cfm_solver=None):
+        "Batched `_render_wav`, rendering `speech_tokens[k]` with `ref_dicts[k]` in a single S3Gen batch."
+        wavs = self.s3gen.inference_batch(
+            speech_tokens=speech_tokens,
+            ref_dicts=ref_dicts,
+            n_cfm_timesteps=n_cfm_timesteps,
+            cfm_solver=cfm_solver,
+        )
+        return [wav.squeeze(0).detach().cpu().numpy() for wav in wavs]
+
+    def _watermark(self, wav):
+        return self.watermarker.apply_watermark(wav, sample_rate=self.sr)
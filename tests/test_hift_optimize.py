@@ -0,0 +1,90 @@
+import pytest
+import torch
+from torch.nn.utils import parametrize
+
+from chatterbox.models.s3gen import S3Gen
+from chatterbox.models.s3gen.hifigan import HiFTGenerator, Snake
+from chatterbox.models.s3gen.f0_predictor import ConvRNNF0Predictor
+
+
+def make_hift():
+    "S3Gen's vocoder, with random weights and non-trivial weight norms and Snake alphas."
+    torch.manual_seed(0)
+    hift = HiFTGenerator(
+        sampling_rate=24000,
+        upsample_rates=[8, 5, 3],
+        upsample_kernel_sizes=[16, 11, 7],
+        source_resblock_kernel_sizes=[7, 7, 11],
+        source_resblock_dilation_sizes=[[1, 3, 5], [1, 3, 5], [1, 3, 5]],
+        f0_predictor=ConvRNNF0Predictor(),
+    ).eval()
+    perturb(hift)
+    return hift
+
+
+def perturb(module):
+    with torch.no_grad():
+        for name, p in module.named_parameters():
+            if name.endswith("original0"):  # weight norm magnitudes
+                p.mul_(torch.empty_like(p).uniform_(0.5, 1.5))
+            elif name.endswith("alpha"):
+                p.uniform_(0.2, 2.0)
+
+
+def vocode(inference, speech_feat, seed=0):
+    # the source excitation is random: draw it from the same seeded RNG on both sides
+    return inference(speech_feat, generator=torch.Generator().manual_seed(seed))  # (speech, source)
+
+
+def assert_parametrized(module, expected):
+    convs = [m for m in module.modules() if isinstance(m, (torch.nn.Conv1d, torch.nn.ConvTranspose1d))]
+    assert convs and all(parametrize.is_parametrized(m, "weight") == expected for m in convs)
+
+
+@pytest.mark.parametrize("fuse_snake", [False, True])
+def test_hift_optimizations_preserve_output(fuse_snake):
+    hift = make_hift()
+    speech_feat = torch.randn(1, 80, 60)
+    expected = vocode(hift.inference, speech_feat)
+
+    hift.remove_weight_norm()
+    if fuse_snake:
+        hift.fuse_snake()
+    assert_parametrized(hift, False)
+    # including the f0 predictor's convs
+    assert_parametrized(hift.f0_predictor, False)
+    assert all(m.fused == fuse_snake for m in hift.modules() if isinstance(m, Snake))
+
+    actual = vocode(hift.inference, speech_feat)
+    for a, e in zip(actual, expected):
+        assert torch.allclose(a, e, atol=1e-5, rtol=1e-4)
+
+
+@pytest.mark.parametrize("alpha_logscale", [False, True])
+def test_fused_snake_matches_snake(alpha_logscale):
+    torch.manual_seed(0)
+    snake = Snake(16, alpha_logscale=alpha_logscale)
+    low, high = (-1.0, 1.0) if alpha_logscale else (0.2, 2.0)
+    with torch.no_grad():
+        snake.alpha.uniform_(low, high)
+    x = 3 * torch.randn(2, 16, 50)
+    expected = snake(x)
+    snake.fuse()
+    assert torch.allclose(snake(x), expected, atol=1e-6, rtol=1e-5)
+
+
+def test_s3gen_optimize_for_inference_preserves_vocoder_output():
+    torch.manual_seed(0)
+    s3gen = S3Gen().eval()
+    perturb(s3gen.mel2wav)
+    assert_parametrized(s3gen.mel2wav.f0_predictor, True)
+    speech_feat = torch.randn(1, 80, 60)
+    expected = vocode(s3gen.hift_inference, speech_feat)
+
+    s3gen.optimize_for_inference()
+    assert_parametrized(s3gen.mel2wav, False)
+    assert_parametrized(s3gen.mel2wav.f0_predictor, False)
+
+    actual = vocode(s3gen.hift_inference, speech_feat)
+    for a, e in zip(actual, expected):
+        assert torch.allclose(a, e, atol=1e-5, rtol=1e-4)
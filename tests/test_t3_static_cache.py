@@ -0,0 +1,80 @@
+import torch
+
+from chatterbox.models.t3 import T3
+from chatterbox.models.t3.llama_configs import LLAMA_CONFIGS, LLAMA_520M_CONFIG_DICT
+from chatterbox.models.t3.modules.cond_enc import T3Cond
+from chatterbox.models.t3.modules.t3_config import T3Config
+
+
+# a shallow random-weight backbone (the conditioning encoder fixes the width): decodes are only compared to each other
+LLAMA_CONFIGS["test_tiny"] = dict(LLAMA_520M_CONFIG_DICT, num_hidden_layers=2, intermediate_size=256)
+MAX_NEW_TOKENS = 48
+
+
+def make_t3():
+    torch.manual_seed(0)
+    hp = T3Config.english_only()
+    hp.llama_config_name = "test_tiny"
+    # random weights rarely emit EOS, make sure they never do so both streams decode all their tokens
+    hp.stop_speech_token = hp.speech_tokens_dict_size - 1
+    t3 = T3(hp).eval()
+    with torch.no_grad():
+        t3.speech_head.weight[hp.stop_speech_token] = 0
+    return t3
+
+
+def make_inputs(t3, seed):
+    g = torch.Generator().manual_seed(seed)
+    t3_cond = T3Cond(
+        speaker_emb=torch.randn(1, 256, generator=g),
+        cond_prompt_speech_tokens=torch.randint(0, 6561, (1, 20), generator=g),
+        emotion_adv=0.5 * torch.ones(1, 1, 1),
+    )
+    text = torch.randint(1, 200, (10 + 5 * seed,), generator=g)
+    text = torch.cat([torch.tensor([t3.hp.start_text_token]), text, torch.tensor([t3.hp.stop_text_token])])
+    return t3_cond, torch.stack([text, text])  # CFG pair
+
+
+def stream(t3, t3_cond, text_tokens, cache_implementation="static"):
+    # min_p=1 keeps the most likely token only: greedy decoding, independent of the RNG
+    return t3.inference_stream(
+        t3_cond=t3_cond,
+        text_tokens=text_tokens,
+        max_new_tokens=MAX_NEW_TOKENS,
+        min_p=1.0,
+        top_p=1.0,
+        repetition_penalty=1.0,
+        temperature=1.0,
+        cache_implementation=cache_implementation,
+    )
+
+
+def test_static_cache_matches_dynamic():
+    t3 = make_t3()
+    t3_cond, text_tokens = make_inputs(t3, seed=0)
+    static = torch.cat(list(stream(t3, t3_cond, text_tokens)), dim=1)
+    dynamic = torch.cat(list(stream(t3, t3_cond, text_tokens, cache_implementation="dynamic")), dim=1)
+    assert static.size(1) == MAX_NEW_TOKENS
+    assert torch.equal(static, dynamic)
+
+
+def test_interleaved_streams_use_separate_static_caches():
+    t3 = make_t3()
+    inputs = [make_inputs(t3, seed) for seed in (0, 1)]
+    expected = [torch.cat(list(stream(t3, *args)), dim=1) for args in inputs]
+
+    # step both generators alternately, in the same batch size and dtype, so they would share a cache
+    streams = [stream(t3, *args) for args in inputs]
+    chunks = [[], []]
+    active = {0, 1}
+    while active:
+        for k in sorted(active):
+            try:
+                chunks[k].append(next(streams[k]))
+            except StopIteration:
+                active.discard(k)
+
+    for k in (0, 1):
+        assert torch.equal(torch.cat(chunks[k], dim=1), expected[k])
+    # both caches were handed back, the larger one is kept for later calls
+    assert len(t3._static_caches) == 1